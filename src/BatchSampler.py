@@ -0,0 +1,144 @@
+from __future__ import division
+
+import os
+import sys
+import random
+
+import numpy
+
+from CountStore import Vocabulary
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "BatchSampler"
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+def get_random_state(seed=None):
+    """NumPy random state for batch sampling. Without an explicit seed it is
+    seeded from the random module, so that seeding random once at startup
+    keeps batch generation reproducible too."""
+    if seed is None:
+        seed = random.getrandbits(32)
+    return numpy.random.RandomState(seed)
+
+class BatchSuccessorTable(object):
+    """A dictionary of CumulativeDistribution objects, one per context,
+    flattened into NumPy arrays so that the next token for any number of
+    contexts is drawn with a single numpy.searchsorted().
+
+    Every context is given a row number r. Its cumulative weights are
+    normalized to (0, 1] and offset by r, and the tables of all contexts
+    are concatenated into one sorted array of keys. Drawing from row r is
+    then a search for r + u with u uniform in [0, 1).
+
+    Each entry also records the row of the context that follows it, so that
+    a sequence is advanced without going back to the context tuples.
+    """
+
+    NO_CONTEXT = -1
+
+    def __init__(self, vocabulary, contexts, keys, tokens, next_rows):
+        self.vocabulary = vocabulary
+        self.contexts = contexts
+        self.context_rows = dict((context, row) for (row, context) in enumerate(contexts))
+        self.keys = keys
+        self.tokens = tokens
+        self.next_rows = next_rows
+
+    @staticmethod
+    def from_successor_tables(successors, next_context=None, vocabulary=None):
+        """successors maps a context to a CumulativeDistribution over
+        tokens. next_context, if given, is a function of (context, token)
+        returning the context that follows, or None if there isn't one."""
+        if vocabulary is None:
+            vocabulary = Vocabulary()
+        contexts = sorted(successors)
+        context_rows = dict((context, row) for (row, context) in enumerate(contexts))
+        keys = []
+        tokens = []
+        next_rows = []
+        for (row, context) in enumerate(contexts):
+            distribution = successors[context]
+            cumulative = numpy.array(distribution.cumulative_weights, dtype=numpy.float64)
+            cumulative /= distribution.total
+            # Guard against rounding leaving the last key just short of the
+            # next row.
+            cumulative[-1] = 1.0
+            keys.append(cumulative + row)
+            for token in distribution.items:
+                tokens.append(vocabulary.add(token))
+                if next_context is None:
+                    next_rows.append(BatchSuccessorTable.NO_CONTEXT)
+                else:
+                    next_rows.append(context_rows.get(next_context(context, token),
+                                                      BatchSuccessorTable.NO_CONTEXT))
+        if len(keys) == 0:
+            keys = numpy.array([], dtype=numpy.float64)
+        else:
+            keys = numpy.concatenate(keys)
+        return BatchSuccessorTable(vocabulary,
+                                   contexts,
+                                   keys,
+                                   numpy.array(tokens, dtype=numpy.int64),
+                                   numpy.array(next_rows, dtype=numpy.int64))
+
+    def get_row(self, context):
+        return self.context_rows[context]
+
+    def decode(self, token_ids):
+        """Object array of the tokens for an array of token ids."""
+        return self.vocabulary.decode(token_ids)
+
+    def sample(self, rows, random_state):
+        """Draw one token for each context row in rows. Returns the flat
+        table positions drawn; index self.tokens and self.next_rows with
+        them."""
+        targets = rows + random_state.random_sample(len(rows))
+        return numpy.searchsorted(self.keys, targets, side="right")
+
+    def sample_sequences(self, count, start_context, stop_token, random_state):
+        """Advance count sequences from start_context in lockstep, one
+        vectorized draw per step, retiring each sequence as it draws
+        stop_token. Returns a list of count lists of tokens, each ending
+        with stop_token."""
+        stop_id = self.vocabulary.get_id(stop_token)
+        rows = numpy.empty(count, dtype=numpy.int64)
+        rows.fill(self.get_row(start_context))
+        active = numpy.arange(count)
+        drawn_indices = []
+        drawn_tokens = []
+        while len(active) != 0:
+            positions = self.sample(rows[active], random_state)
+            tokens = self.tokens[positions]
+            drawn_indices.append(active)
+            drawn_tokens.append(tokens)
+            rows[active] = self.next_rows[positions]
+            active = active[tokens != stop_id]
+        return self.group_by_sequence(count, drawn_indices, drawn_tokens)
+
+    def group_by_sequence(self, count, drawn_indices, drawn_tokens):
+        """Turn per-step arrays of (sequence index, token id) into one list
+        of token strings per sequence, keeping the order they were drawn
+        in."""
+        if len(drawn_indices) == 0:
+            return [[] for i in xrange(count)]
+        indices = numpy.concatenate(drawn_indices)
+        tokens = numpy.concatenate(drawn_tokens)
+        order = numpy.argsort(indices, kind="mergesort")
+        lengths = numpy.bincount(indices, minlength=count)
+        strings = self.decode(tokens[order])
+        return [list(sequence) for sequence in numpy.split(strings, numpy.cumsum(lengths)[:-1])]
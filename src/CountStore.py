@@ -0,0 +1,464 @@
+from __future__ import division
+
+import os
+import sys
+import itertools
+
+import numpy
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "CountStore"
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+class Vocabulary(object):
+    """Two-way mapping between tokens (words or tags) and integer ids.
+
+    Id 0 is reserved for tokens that have never been seen, so that encoding
+    arbitrary text never fails; it simply produces keys that are not in any
+    count store.
+    """
+
+    UNKNOWN_ID = 0
+
+    def __init__(self, tokens=()):
+        self.tokens = [None]
+        self.ids = {}
+        for token in tokens:
+            self.add(token)
+
+    @staticmethod
+    def from_counts(*counts_dicts):
+        """Build a vocabulary over every token used in the tuple keys of
+        one or more count dictionaries. Tokens are added in sorted order so
+        the same counts always produce the same ids."""
+        tokens = set()
+        for counts in counts_dicts:
+            for phrase in counts:
+                if phrase is not None:
+                    tokens.update(phrase)
+        return Vocabulary(sorted(tokens))
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.ids
+
+    def add(self, token):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.tokens.append(token)
+            self.ids[token] = token_id
+        return token_id
+
+    def get_id(self, token):
+        return self.ids.get(token, self.UNKNOWN_ID)
+
+    def get_token(self, token_id):
+        return self.tokens[token_id]
+
+    def decode(self, token_ids):
+        """Convert an array of ids into an object array of tokens."""
+        token_array = getattr(self, "token_array", None)
+        if token_array is None or len(token_array) != len(self.tokens):
+            token_array = self.token_array = numpy.array(self.tokens, dtype=object)
+        return token_array[token_ids]
+
+    def encode(self, phrases):
+        """Convert an iterable of equal-length token tuples into a 2-D array
+        of ids, one row per phrase."""
+        ids = self.ids
+        rows = [[ids.get(token, self.UNKNOWN_ID) for token in phrase] for phrase in phrases]
+        return numpy.array(rows, dtype=numpy.int64).reshape(len(rows), -1)
+
+class RareCountOverlay(object):
+    """The counts of a count dictionary with infrequent tokens collapsed
+    into rare tokens, without copying the dictionary.
+
+    -   counts: the underlying count dictionary.
+    -   rare_tokens: dictionary mapping each infrequent token to the rare
+        token that replaces it.
+    -   collapsed: dictionary holding the counts of the phrases that
+        contain rare tokens, i.e. the sum of the counts of every phrase that
+        collapses into them.
+
+    Phrases in counts that contain an infrequent token do not exist in the
+    overlay; every other phrase is read through to counts.
+    """
+
+    def __init__(self, counts, rare_tokens, collapsed):
+        self.counts = counts
+        self.rare_tokens = rare_tokens
+        self.collapsed = collapsed
+
+    def is_collapsed(self, phrase):
+        return phrase is not None and any(token in self.rare_tokens for token in phrase)
+
+    def get(self, phrase, default=None):
+        value = self.collapsed.get(phrase)
+        if value is not None:
+            return value
+        if self.is_collapsed(phrase):
+            return default
+        return self.counts.get(phrase, default)
+
+    def __contains__(self, phrase):
+        return phrase in self.collapsed or \
+               (not self.is_collapsed(phrase) and phrase in self.counts)
+
+    def __getitem__(self, phrase):
+        value = self.get(phrase)
+        if value is None:
+            raise KeyError(phrase)
+        return value
+
+    def iteritems(self):
+        for item in self.collapsed.iteritems():
+            yield item
+        for (phrase, value) in self.counts.iteritems():
+            if not self.is_collapsed(phrase):
+                yield (phrase, value)
+
+    def __iter__(self):
+        return (phrase for (phrase, value) in self.iteritems())
+
+    def __len__(self):
+        return sum(1 for phrase in self)
+
+class NumpyCountStore(object):
+    """Read-only n-gram count table held as NumPy arrays.
+
+    Each n-gram order is kept as a sorted array of packed keys plus a
+    parallel array of values. A key packs the vocabulary ids of the n-gram's
+    tokens into a single unsigned 64-bit integer, most significant token
+    first, so that sorting the keys sorts the n-grams lexicographically by
+    id and any batch of n-grams is looked up with one numpy.searchsorted().
+
+    The store answers the same questions as the dictionaries it replaces
+    ("phrase in counts", "counts[phrase]", counts[None] for the total), so
+    code written against the dictionaries runs on it unchanged.
+    """
+
+    def __init__(self, vocabulary, keys, values, total):
+        """keys and values are dictionaries mapping n-gram order to
+        sorted packed keys and their values respectively. total is the
+        value stored under the None key."""
+        self.vocabulary = vocabulary
+        self.keys = keys
+        self.values = values
+        self.total = total
+        self.bits_per_id = max(1, (len(vocabulary) - 1).bit_length())
+        for order in keys:
+            self._check_order_fits(order)
+
+    @staticmethod
+    def from_dict(counts, vocabulary=None, dtype=numpy.float64):
+        """Compact a dictionary keyed by token tuples (plus None for the
+        total) into a NumpyCountStore."""
+        if vocabulary is None:
+            vocabulary = Vocabulary.from_counts(counts)
+        else:
+            for phrase in counts:
+                if phrase is not None:
+                    for token in phrase:
+                        vocabulary.add(token)
+        by_order = {}
+        for (phrase, value) in counts.iteritems():
+            if phrase is None:
+                continue
+            by_order.setdefault(len(phrase), []).append((phrase, value))
+
+        store = NumpyCountStore(vocabulary, {}, {}, counts.get(None))
+        for (order, phrases_and_values) in by_order.iteritems():
+            store._check_order_fits(order)
+            ids = vocabulary.encode(phrase for (phrase, value) in phrases_and_values)
+            packed = store.pack(ids)
+            values = numpy.fromiter((value for (phrase, value) in phrases_and_values),
+                                    dtype=dtype, count=len(phrases_and_values))
+            sort_order = numpy.argsort(packed, kind="mergesort")
+            store.keys[order] = packed[sort_order]
+            store.values[order] = values[sort_order]
+        return store
+
+    def _check_order_fits(self, order):
+        if self.bits_per_id * order > 64:
+            raise ValueError("vocabulary of %s tokens is too large to pack %s-grams into 64 bits" %
+                             (len(self.vocabulary), order))
+
+    def pack(self, ids):
+        """Pack a 2-D array of token ids, one n-gram per row, into a 1-D
+        array of uint64 keys."""
+        ids = numpy.asarray(ids, dtype=numpy.uint64)
+        packed = numpy.zeros(ids.shape[0], dtype=numpy.uint64)
+        for column in xrange(ids.shape[1]):
+            packed <<= numpy.uint64(self.bits_per_id)
+            packed |= ids[:, column]
+        return packed
+
+    def unpack(self, packed, order):
+        """Inverse of pack()."""
+        packed = numpy.asarray(packed, dtype=numpy.uint64)
+        mask = numpy.uint64((1 << self.bits_per_id) - 1)
+        ids = numpy.empty((packed.shape[0], order), dtype=numpy.int64)
+        for column in xrange(order - 1, -1, -1):
+            ids[:, column] = packed & mask
+            packed = packed >> numpy.uint64(self.bits_per_id)
+        return ids
+
+    def lookup_ids(self, ids):
+        """Vectorized lookup of a 2-D array of token ids, one n-gram per
+        row, all of the same order.
+
+        Returns (values, found): values holds the stored value where found
+        is True and NaN elsewhere."""
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        size = ids.shape[0]
+        values = numpy.empty(size, dtype=numpy.float64)
+        values.fill(numpy.nan)
+        found = numpy.zeros(size, dtype=bool)
+        order = ids.shape[1]
+        if order not in self.keys or size == 0 or len(self.keys[order]) == 0:
+            return (values, found)
+
+        # Ids added to a shared vocabulary after this store was built do not
+        # fit in bits_per_id, and are by definition not in this store.
+        in_range = numpy.all(ids < (1 << self.bits_per_id), axis=1)
+        keys = self.keys[order]
+        packed = self.pack(numpy.where(in_range[:, numpy.newaxis], ids, 0))
+        positions = numpy.searchsorted(keys, packed)
+        positions = numpy.minimum(positions, len(keys) - 1)
+        found = in_range & (keys[positions] == packed)
+        values[found] = self.values[order][positions[found]]
+        return (values, found)
+
+    def lookup(self, phrases):
+        """Vectorized lookup of an iterable of token tuples, all of the same
+        length. See lookup_ids()."""
+        return self.lookup_ids(self.vocabulary.encode(phrases))
+
+    # -------------------------------------------------------------------------
+    #   Dictionary-style access, so that code written against the count
+    #   dictionaries keeps working.
+    # -------------------------------------------------------------------------
+    def get(self, phrase, default=None):
+        if phrase is None:
+            return default if self.total is None else self.total
+        (values, found) = self.lookup([phrase])
+        if not found[0]:
+            return default
+        return values[0]
+
+    def __contains__(self, phrase):
+        if phrase is None:
+            return self.total is not None
+        (values, found) = self.lookup([phrase])
+        return bool(found[0])
+
+    def __getitem__(self, phrase):
+        value = self.get(phrase)
+        if value is None:
+            raise KeyError(phrase)
+        return value
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.keys.itervalues()) + \
+               (0 if self.total is None else 1)
+
+    def iteritems(self):
+        if self.total is not None:
+            yield (None, self.total)
+        tokens = self.vocabulary.tokens
+        for (order, keys) in sorted(self.keys.iteritems()):
+            ids = self.unpack(keys, order)
+            for (row, value) in itertools.izip(ids, self.values[order]):
+                yield (tuple(tokens[token_id] for token_id in row), value)
+
+    def __iter__(self):
+        return (phrase for (phrase, value) in self.iteritems())
+
+    def nbytes(self):
+        return sum(keys.nbytes for keys in self.keys.itervalues()) + \
+               sum(values.nbytes for values in self.values.itervalues())
+    # -------------------------------------------------------------------------
+
+class NGramTrie(object):
+    """Read-only n-gram count table held as a trie of NumPy arrays.
+
+    Rather than storing each n-gram as an independent key, so that a prefix
+    like ('__START__', 'He') is repeated inside every longer n-gram that
+    extends it, every distinct prefix is stored once as a node. Nodes of
+    each depth d are kept in arrays sorted by (parent, token id):
+
+    -   tokens[d]: the token id of each node.
+    -   values[d]: the value of the n-gram ending at each node, or NaN if
+        the node is only a prefix of longer n-grams.
+    -   child_starts[d]: the children of node i at depth d are the nodes
+        child_starts[d][i]:child_starts[d][i+1] at depth d+1.
+
+    The children of a node are hence contiguous and sorted by token id, so
+    a lookup is a binary search per token, and all continuations of a
+    context are one slice. Like NumpyCountStore, the trie answers the same
+    questions as the count dictionaries it replaces.
+    """
+
+    def __init__(self, vocabulary, tokens, values, child_starts, total):
+        self.vocabulary = vocabulary
+        self.tokens = tokens
+        self.values = values
+        self.child_starts = child_starts
+        self.total = total
+        self.max_order = max(tokens) if tokens else 0
+
+    @staticmethod
+    def from_dict(counts, vocabulary=None, dtype=numpy.float64):
+        """Build an NGramTrie from a dictionary keyed by token tuples (plus
+        None for the total)."""
+        if vocabulary is None:
+            vocabulary = Vocabulary.from_counts(counts)
+        values_by_ids = {}
+        for (phrase, value) in counts.iteritems():
+            if phrase is not None:
+                values_by_ids[tuple(vocabulary.add(token) for token in phrase)] = value
+        max_order = max(len(ids) for ids in values_by_ids) if values_by_ids else 0
+
+        nodes_by_depth = dict((depth, set()) for depth in xrange(1, max_order + 1))
+        for ids in values_by_ids:
+            for depth in xrange(1, len(ids) + 1):
+                nodes_by_depth[depth].add(ids[:depth])
+
+        tokens = {}
+        values = {}
+        child_starts = {}
+        node_indices = {}
+        for depth in xrange(1, max_order + 1):
+            nodes = sorted(nodes_by_depth.pop(depth))
+            tokens[depth] = numpy.array([node[-1] for node in nodes], dtype=numpy.int32)
+            values[depth] = numpy.fromiter((values_by_ids.get(node, numpy.nan) for node in nodes),
+                                           dtype=dtype, count=len(nodes))
+            parents = numpy.array([node_indices[node[:-1]] for node in nodes] if depth > 1 else [],
+                                  dtype=numpy.int64)
+            if depth > 1:
+                number_of_parents = len(tokens[depth - 1])
+                child_starts[depth - 1] = numpy.searchsorted(parents, numpy.arange(number_of_parents + 1))
+            node_indices = dict((node, index) for (index, node) in enumerate(nodes))
+        if max_order != 0:
+            child_starts[max_order] = numpy.zeros(len(tokens[max_order]) + 1, dtype=numpy.int64)
+        return NGramTrie(vocabulary, tokens, values, child_starts, counts.get(None))
+
+    def get_children(self, depth, index):
+        """(low, high) range of the children at depth + 1 of node index at
+        depth. Depth 0 is the root."""
+        if depth == 0:
+            return (0, len(self.tokens[1]) if self.max_order != 0 else 0)
+        child_starts = self.child_starts[depth]
+        return (child_starts[index], child_starts[index + 1])
+
+    def find(self, ids):
+        """Index of the node at depth len(ids) reached by following ids from
+        the root, or None. An empty ids is the root, index 0."""
+        if len(ids) > self.max_order:
+            return None
+        index = 0
+        for (depth, token_id) in enumerate(ids):
+            (low, high) = self.get_children(depth, index)
+            siblings = self.tokens[depth + 1]
+            index = low + numpy.searchsorted(siblings[low:high], token_id)
+            if index >= high or siblings[index] != token_id:
+                return None
+        return index
+
+    def continuations(self, context):
+        """List of (token, value) for every n-gram that extends the tuple
+        context by one token."""
+        ids = [self.vocabulary.get_id(token) for token in context]
+        index = self.find(ids)
+        if index is None or len(context) >= self.max_order:
+            return []
+        return self._continuations(len(context), index)
+
+    def _continuations(self, depth, index):
+        (low, high) = self.get_children(depth, index)
+        tokens = self.vocabulary.decode(self.tokens[depth + 1][low:high])
+        values = self.values[depth + 1][low:high]
+        return [(token, value) for (token, value) in zip(tokens, values) if not numpy.isnan(value)]
+
+    def iter_continuations(self, depth):
+        """Yield (context, continuations) for every node at depth, where
+        context is the tuple of tokens leading to it and continuations is
+        as returned by continuations()."""
+        if depth > self.max_order - 1:
+            return
+        for item in self._walk((), 0, 0, depth):
+            yield item
+
+    def _walk(self, prefix, depth, index, target_depth):
+        if depth == target_depth:
+            yield (prefix, self._continuations(depth, index))
+            return
+        (low, high) = self.get_children(depth, index)
+        for child in xrange(low, high):
+            token = self.vocabulary.get_token(self.tokens[depth + 1][child])
+            for item in self._walk(prefix + (token, ), depth + 1, child, target_depth):
+                yield item
+
+    # -------------------------------------------------------------------------
+    #   Dictionary-style access, so that code written against the count
+    #   dictionaries keeps working.
+    # -------------------------------------------------------------------------
+    def get(self, phrase, default=None):
+        if phrase is None:
+            return default if self.total is None else self.total
+        if len(phrase) == 0:
+            return default
+        index = self.find([self.vocabulary.get_id(token) for token in phrase])
+        if index is None:
+            return default
+        value = self.values[len(phrase)][index]
+        if numpy.isnan(value):
+            return default
+        return value
+
+    def __contains__(self, phrase):
+        return self.get(phrase) is not None
+
+    def __getitem__(self, phrase):
+        value = self.get(phrase)
+        if value is None:
+            raise KeyError(phrase)
+        return value
+
+    def __len__(self):
+        return sum(int(numpy.sum(~numpy.isnan(values))) for values in self.values.itervalues()) + \
+               (0 if self.total is None else 1)
+
+    def iteritems(self):
+        if self.total is not None:
+            yield (None, self.total)
+        for depth in xrange(0, self.max_order):
+            for (context, continuations) in self.iter_continuations(depth):
+                for (token, value) in continuations:
+                    yield (context + (token, ), value)
+
+    def __iter__(self):
+        return (phrase for (phrase, value) in self.iteritems())
+
+    def nbytes(self):
+        return sum(array.nbytes for arrays in (self.tokens, self.values, self.child_starts)
+                   for array in arrays.itervalues())
+    # -------------------------------------------------------------------------
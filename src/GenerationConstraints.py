@@ -0,0 +1,137 @@
+import os
+import sys
+import re
+
+from utilities import strip_leading_spaces_on_punctuation
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "GenerationConstraints"
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+def get_minimum_sentence_characters(settings):
+    """Fewest characters of a sentence that build_json publishes. The
+    builder's minimum_sentence_length counts the newline ending each line
+    of the output files, which sentences are read back without."""
+    return settings.builder_minimum_sentence_length - 1
+
+class GenerationConstraints(object):
+    """Requirements a generated sentence must meet, checked word by word
+    while it is sampled rather than once it is finished.
+
+    -   minimum_tokens, maximum_tokens: bounds on the number of words.
+    -   minimum_characters, maximum_characters: bounds on the length of the
+        rendered sentence.
+    -   re_reject: regular expression, as a string or compiled, that no
+        part of the rendered sentence may match. Each word is checked
+        rendered together with the word before it, so patterns spanning
+        two adjacent words, like the bracket patterns of the builder's
+        re_reject, are caught as soon as the second word is drawn.
+    -   start_word: word the sentence must begin with.
+    -   maximum_attempts: how many times a sentence is restarted after
+        sampling reaches a point where no word is allowed, before giving up.
+
+    None means no constraint.
+    """
+
+    def __init__(self,
+                 minimum_tokens=None,
+                 maximum_tokens=None,
+                 minimum_characters=None,
+                 maximum_characters=None,
+                 re_reject=None,
+                 start_word=None,
+                 maximum_attempts=20):
+        self.minimum_tokens = minimum_tokens
+        self.maximum_tokens = maximum_tokens
+        self.minimum_characters = minimum_characters
+        self.maximum_characters = maximum_characters
+        if isinstance(re_reject, basestring):
+            re_reject = re.compile(re_reject)
+        self.re_reject = re_reject
+        self.start_word = start_word
+        self.maximum_attempts = maximum_attempts
+
+    @staticmethod
+    def from_settings(settings):
+        """The constraints build_json applies to published sentences, plus
+        the generator's maximum_sentence_tokens."""
+        return GenerationConstraints(minimum_characters=get_minimum_sentence_characters(settings),
+                                     maximum_tokens=settings.generator_maximum_sentence_tokens,
+                                     re_reject=settings.builder_re_reject)
+
+    def start_sentence(self):
+        return ConstrainedSentence(self)
+
+    def allows_sentence(self, rendered_sentence):
+        """Final check of a finished, rendered sentence. Rendering can add
+        a trailing full stop, which the per-word checks do not see."""
+        length = len(rendered_sentence)
+        if self.minimum_characters is not None and length < self.minimum_characters:
+            return False
+        if self.maximum_characters is not None and length > self.maximum_characters:
+            return False
+        if self.re_reject is not None and self.re_reject.search(rendered_sentence) is not None:
+            return False
+        return True
+
+class ConstrainedSentence(object):
+    """The words of a sentence being sampled under GenerationConstraints,
+    with the length it renders to so far."""
+
+    def __init__(self, constraints):
+        self.constraints = constraints
+        self.words = []
+        self.characters = 0
+
+    def render_word(self, word):
+        """The previous word and word as they render next to each other."""
+        if len(self.words) == 0:
+            return word
+        return strip_leading_spaces_on_punctuation("%s %s" % (self.words[-1], word))
+
+    def allows_word(self, word):
+        constraints = self.constraints
+        if len(self.words) == 0 and constraints.start_word is not None and word != constraints.start_word:
+            return False
+        if constraints.maximum_tokens is not None and len(self.words) >= constraints.maximum_tokens:
+            return False
+        rendered = self.render_word(word)
+        if constraints.maximum_characters is not None and \
+           self.get_characters_after(rendered) > constraints.maximum_characters:
+            return False
+        if constraints.re_reject is not None and constraints.re_reject.search(rendered) is not None:
+            return False
+        return True
+
+    def allows_stop(self):
+        constraints = self.constraints
+        if constraints.minimum_tokens is not None and len(self.words) < constraints.minimum_tokens:
+            return False
+        # Rendering may add a full stop, so allow for one character more.
+        if constraints.minimum_characters is not None and self.characters + 1 < constraints.minimum_characters:
+            return False
+        return True
+
+    def get_characters_after(self, rendered):
+        if len(self.words) == 0:
+            return len(rendered)
+        return self.characters + len(rendered) - len(self.words[-1])
+
+    def append(self, word):
+        self.characters = self.get_characters_after(self.render_word(word))
+        self.words.append(word)
@@ -6,12 +6,21 @@ import math
 import itertools
 import operator
 import random
-import copy
 import re
 import string
 import pprint
+import heapq
+import multiprocessing
 
-from utilities import weighted_choice, strip_leading_spaces_on_punctuation, memoize
+from utilities import strip_leading_spaces_on_punctuation, memoize, \
+                      CumulativeDistribution, LRUCache, get_memoize_caches, clear_memoize_caches
+from CountStore import Vocabulary, NumpyCountStore, RareCountOverlay, NGramTrie
+from BatchSampler import BatchSuccessorTable, get_random_state
+from TagLattice import TagLattice
+from Metrics import metrics, timed, timed_per_item, counted_tokens, records_cache_statistics, \
+                    enable_from_settings
+
+import numpy
 
 # -----------------------------------------------------------------------------
 #   Constants.
@@ -19,6 +28,10 @@ from utilities import weighted_choice, strip_leading_spaces_on_punctuation, memo
 APP_NAME = "LanguageModel"
 LOG_PATH = os.path.abspath(os.path.join(__file__, os.pardir, os.pardir, "logs"))
 LOG_FILEPATH = os.path.abspath(os.path.join(LOG_PATH, "%s.log" % APP_NAME))
+
+# Plain draws tried by choose_constrained() before it filters the
+# distribution down to the allowed choices.
+CONSTRAINED_DRAW_ATTEMPTS = 5
 # -----------------------------------------------------------------------------
 
 # -----------------------------------------------------------------------------
@@ -34,11 +47,101 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 # -----------------------------------------------------------------------------
 
+def count_training_texts(arguments):
+    """Count the n-grams in a list of ProcessedText objects. This is a
+    module-level function so that it can be used as a multiprocessing.Pool
+    worker, hence the single tuple of arguments:
+
+    -   texts: the ProcessedText objects.
+    -   ngram_attribute: "ngram_words" or "ngram_tags".
+    -   ngram_count: highest n-gram size to count.
+    -   start_symbol: start of sentence symbol.
+    -   count_emissions: whether to also gather the (tag, word) emission
+        counts from tags_words_counts.
+
+    Returns a dictionary of count tables, with keys "counts",
+    "vocabulary" and, if requested, "emissions". See merge_count_tables().
+    """
+    (texts, ngram_attribute, ngram_count, start_symbol, count_emissions) = arguments
+    vocabulary = set()
+    counts = {}
+    for text in texts:
+        # Get a token count using the unigram counts.
+        unigrams = getattr(text, ngram_attribute)[1]
+        token_count = sum(v for (k, v) in unigrams.iteritems() if k != start_symbol)
+        counts[None] = counts.get(None, 0) + token_count
+        vocabulary.update(elem for elem in unigrams if elem != start_symbol)
+
+        # Get counts for the actual tokens.
+        for i in xrange(1, ngram_count + 1):
+            ngrams = getattr(text, ngram_attribute)[i]
+            for (phrase, count) in ngrams.iteritems():
+                counts[phrase] = counts.get(phrase, 0) + count
+
+        # Start of sentence indicators are:
+        # - for unigram, Count(('__START__', )) = number of sentences.
+        # - for bigram, Count(('__START__', '__START__')) = number of sentences.
+        # etc.
+        number_of_sentences = len(text.tagged_sentences)
+        for i in xrange(1, ngram_count + 1):
+            start_key = tuple([start_symbol] * i)
+            counts[start_key] = counts.get(start_key, 0) + number_of_sentences
+    tables = {"counts": counts, "vocabulary": vocabulary}
+
+    # -------------------------------------------------------------------------
+    #   Gather the emission bigram counts.
+    # -------------------------------------------------------------------------
+    if count_emissions:
+        emissions = {}
+        for text in texts:
+            for (tag, words_and_counts) in text.tags_words_counts.iteritems():
+                for (word, count) in words_and_counts.iteritems():
+                    key = (tag, word)
+                    emissions[key] = emissions.get(key, 0) + count
+        tables["emissions"] = emissions
+    # -------------------------------------------------------------------------
+
+    return tables
+
+def merge_count_tables(pair):
+    """Merge the second of a pair of count table dictionaries, as returned
+    by count_training_texts(), into the first and return it. Count
+    dictionaries are summed and sets are unioned."""
+    (tables, other_tables) = pair
+    for (name, other_table) in other_tables.iteritems():
+        if name not in tables:
+            tables[name] = other_table
+        elif isinstance(other_table, set):
+            tables[name].update(other_table)
+        else:
+            table = tables[name]
+            for (key, count) in other_table.iteritems():
+                table[key] = table.get(key, 0) + count
+    return tables
+
+def subtract_count_tables(tables, other_tables):
+    """New count tables holding the counts of tables less those of
+    other_tables, as returned by count_training_texts() for a subset of the
+    texts counted in tables. Entries whose count drops to zero are left out
+    and the vocabulary is rebuilt from what remains of the unigram counts,
+    so the result is what count_training_texts() would return for the rest
+    of the texts."""
+    result = {}
+    for (name, table) in tables.iteritems():
+        if isinstance(table, set):
+            continue
+        other_table = other_tables.get(name, {})
+        result[name] = dict((key, count - other_table.get(key, 0)) for (key, count) in table.iteritems()
+                            if count > other_table.get(key, 0))
+    result["vocabulary"] = set(phrase for phrase in result["counts"]
+                               if phrase is not None and len(phrase) == 1)
+    return result
+
 class LanguageModel(object):
     """Base class of a general language model. The flow is to:
        - Pass in an interable of ProcessedText objects.
        - Call train().
-       - Call get_perplexity() to see how good your model is. This
+       - Call perplexity() to see how good your model is. This
          value makes more sense when comparing it to the perplexities
          of other language models.
        - Call generate() to create a random sentence that is "likely"
@@ -57,20 +160,448 @@ class LanguageModel(object):
     stop_symbol = "__STOP__"
     sentinels = set([start_symbol, stop_symbol])
 
+    # ProcessedText attribute holding the n-grams the model counts, and
+    # whether it also counts (tag, word) emissions.
+    ngram_attribute = "ngram_words"
+    count_emissions = False
+
     def __init__(self, processed_texts, settings):
         self.processed_texts = processed_texts
         self.settings = settings
+        enable_from_settings(settings)
+        metrics.track(self)
+
+    def __getstate__(self):
+        """Pickle everything training produced: counts, rare counts,
+        vocabulary and sampling tables. The processed texts and settings
+        are left out, as are memoize caches; see ModelSnapshot."""
+        state = dict((k, v) for (k, v) in self.__dict__.iteritems()
+                     if not isinstance(v, LRUCache))
+        state["processed_texts"] = None
+        state["settings"] = None
+        return state
 
     def train(self):
         raise NotImplementedError("should have implemented this")
 
+    def train_from_counts(self, tables):
+        """Everything train() does after counting its training set, given
+        the count tables of that set as returned by count_training_texts(),
+        except measuring perplexity. Lets cross_validation train a model
+        per fold from counts it has already gathered."""
+        raise NotImplementedError("should have implemented this")
+
     def generate(self):
         raise NotImplementedError("should have implemented this")
 
+    def generate_many(self, n, seed=None, constraints=None):
+        """Generate n sentences. Subclasses that can sample many sentences
+        in lockstep override this; this fallback calls generate() n times,
+        with the random module temporarily seeded from seed if given.
+
+        If constraints, a GenerationConstraints, is given it is passed on
+        to generate(), and sentences that could not be generated within
+        the constraints are left out, so fewer than n may be returned."""
+        if seed is None:
+            return self._generate_sentences(n, constraints)
+        state = random.getstate()
+        random.seed(seed)
+        try:
+            return self._generate_sentences(n, constraints)
+        finally:
+            random.setstate(state)
+
+    def iter_generate(self, batch_size=100, seed=None, constraints=None):
+        """Yield sentences without end, generating them batch_size at a time
+        with generate_many(). If seed is given the sequence is
+        reproducible: each batch is seeded from a random.Random seeded with
+        it."""
+        seeds = None if seed is None else random.Random(seed)
+        while True:
+            batch_seed = None if seeds is None else seeds.getrandbits(32)
+            for sentence in self.generate_many(batch_size, seed=batch_seed, constraints=constraints):
+                yield sentence
+
+    def _generate_sentences(self, n, constraints):
+        if constraints is None:
+            return [self.generate() for i in xrange(n)]
+        sentences = (self.generate(constraints=constraints) for i in xrange(n))
+        return [sentence for sentence in sentences if sentence is not None]
+
+    def render_sentence(self, words):
+        """Join generated tokens, less any start and stop symbols, into a
+        sentence."""
+        joined_sentence = ' '.join([word for word in words if word not in self.sentinels])
+        if not joined_sentence.endswith("."):
+            joined_sentence += "."
+        return strip_leading_spaces_on_punctuation(joined_sentence)
+
     def _check_invariants(self):
         assert(self.processed_texts is not None)
         assert(self.settings is not None)
 
+    @timed("train.rare_collapse_and_log_conversion")
+    def collapse_rare_tokens(self):
+        """Build self.rare_counts, a view of self.counts in which every token
+        whose unigram count is at most infrequent_count_threshold is
+        replaced by its rare token, and convert both to log2 counts.
+
+        Whether a token is rare is decided once per vocabulary entry. A
+        single pass over self.counts then converts each count to a log in
+        place and adds the counts of phrases with rare tokens into their
+        collapsed phrase. Only the collapsed phrases are stored; see
+        RareCountOverlay.
+        """
+        rare_tokens = {}
+        for phrase in self.vocabulary:
+            if self.counts[phrase] <= self.infrequent_count_threshold:
+                rare_tokens[phrase[0]] = self.convert_tokens_to_rare_tokens(phrase)[0]
+
+        collapsed = {}
+        self.rare_token_phrases = None
+        for (phrase, phrase_count) in self.counts.iteritems():
+            if phrase is not None and any(token in rare_tokens for token in phrase):
+                new_phrase = tuple(rare_tokens.get(token, token) for token in phrase)
+                collapsed[new_phrase] = collapsed.get(new_phrase, 0) + phrase_count
+            self.counts[phrase] = math.log(phrase_count, 2)
+        for (phrase, phrase_count) in collapsed.iteritems():
+            collapsed[phrase] = math.log(phrase_count, 2)
+        self.rare_counts = RareCountOverlay(self.counts, rare_tokens, collapsed)
+
+    def index_rare_token_phrases(self):
+        """Build self.rare_token_phrases, mapping every rare token to the
+        phrases of self.counts it is in, so that update_counts() can find
+        them again if the token stops being rare. Built on the first
+        update rather than in training, as most models are never
+        updated."""
+        rare_tokens = self.rare_counts.rare_tokens
+        self.rare_token_phrases = {}
+        for phrase in self.counts:
+            if phrase is not None:
+                self.index_rare_token_phrase(phrase, rare_tokens)
+
+    def index_rare_token_phrase(self, phrase, rare_tokens):
+        for token in phrase:
+            if token in rare_tokens:
+                self.rare_token_phrases.setdefault(token, set()).add(phrase)
+
+    def update_counts(self, new_processed_texts, ngram_attribute, count_emissions=False):
+        """Add the counts of new_processed_texts to the counts of a trained
+        model: self.counts, self.rare_counts, self.vocabulary and, if
+        count_emissions, self.emissions. Returns the count tables of the new
+        texts, as returned by count_training_texts().
+
+        This takes time proportional to the new texts rather than to
+        everything trained on so far. Counts are log2 counts after
+        training, so each count that changes is converted back into a
+        whole count, added to, and converted again.
+
+        Counts only ever grow, so the only tokens whose rare status changes
+        are new tokens that are already rare, whose phrases are all new,
+        and rare tokens whose count now exceeds infrequent_count_threshold.
+        The phrases of the latter are found through self.rare_token_phrases
+        and moved out of the collapsed phrases they were counted in.
+        """
+        logger = logging.getLogger("%s.LanguageModel.update_counts" % APP_NAME)
+        if not isinstance(self.counts, dict) or not isinstance(self.rare_counts, RareCountOverlay):
+            raise TypeError("updating requires the dict count store, not %s" %
+                            self.counts.__class__.__name__)
+        if getattr(self, "rare_token_phrases", None) is None:
+            self.index_rare_token_phrases()
+        tables = self.count_training_set(new_processed_texts, ngram_attribute, count_emissions)
+        counts = self.counts
+        rare_tokens = self.rare_counts.rare_tokens
+        collapsed = self.rare_counts.collapsed
+
+        def get_whole_count(table, phrase):
+            if phrase not in table:
+                return 0
+            return int(round(math.pow(2, table[phrase])))
+
+        def collapse(phrase):
+            return tuple(rare_tokens.get(token, token) for token in phrase)
+
+        def is_rare(phrase):
+            return phrase is not None and any(token in rare_tokens for token in phrase)
+
+        # ---------------------------------------------------------------------
+        #   Find the tokens whose rare status changes.
+        # ---------------------------------------------------------------------
+        new_rare_tokens = {}
+        promoted_tokens = set()
+        for phrase in tables["vocabulary"]:
+            new_count = get_whole_count(counts, phrase) + tables["counts"][phrase]
+            if new_count <= self.infrequent_count_threshold:
+                if phrase not in counts:
+                    new_rare_tokens[phrase[0]] = self.convert_tokens_to_rare_tokens(phrase)[0]
+            elif phrase[0] in rare_tokens:
+                promoted_tokens.add(phrase[0])
+        logger.debug("%s new rare tokens, %s tokens no longer rare" %
+                     (len(new_rare_tokens), len(promoted_tokens)))
+        # ---------------------------------------------------------------------
+
+        # ---------------------------------------------------------------------
+        #   Take the phrases of tokens that are no longer rare out of their
+        #   collapsed phrases, then update the rare tokens, add in the new
+        #   counts, and put the taken phrases back in under what they now
+        #   collapse to, if anything. Changes to collapsed phrases are
+        #   gathered as whole counts and applied at the end.
+        # ---------------------------------------------------------------------
+        collapsed_changes = {}
+        reclassified = set()
+        for token in promoted_tokens:
+            reclassified.update(self.rare_token_phrases.pop(token, ()))
+        for phrase in reclassified:
+            key = collapse(phrase)
+            collapsed_changes[key] = collapsed_changes.get(key, 0) - get_whole_count(counts, phrase)
+        for token in promoted_tokens:
+            del rare_tokens[token]
+        rare_tokens.update(new_rare_tokens)
+
+        for (phrase, count) in tables["counts"].iteritems():
+            old_count = get_whole_count(counts, phrase)
+            counts[phrase] = math.log(old_count + count, 2)
+            if phrase not in reclassified and is_rare(phrase):
+                key = collapse(phrase)
+                collapsed_changes[key] = collapsed_changes.get(key, 0) + count
+                if old_count == 0:
+                    self.index_rare_token_phrase(phrase, rare_tokens)
+        for phrase in reclassified:
+            if is_rare(phrase):
+                key = collapse(phrase)
+                collapsed_changes[key] = collapsed_changes.get(key, 0) + get_whole_count(counts, phrase)
+
+        for (key, change) in collapsed_changes.iteritems():
+            new_count = get_whole_count(collapsed, key) + change
+            if new_count == 0:
+                collapsed.pop(key, None)
+            else:
+                collapsed[key] = math.log(new_count, 2)
+        # ---------------------------------------------------------------------
+
+        self.vocabulary.update(tables["vocabulary"])
+        if count_emissions:
+            for (key, count) in tables["emissions"].iteritems():
+                self.emissions[key] = self.emissions.get(key, 0) + count
+        return tables
+
+    def update_successor_tables(self, successors, counts, phrases):
+        """Rebuild the entries of successors, as returned by
+        build_successor_tables(), for the contexts of the highest order
+        n-grams in phrases, whose counts have changed. Tokens already in a
+        distribution keep their place and new ones are added at the end, in
+        sorted order."""
+        new_tokens = {}
+        for phrase in phrases:
+            if phrase is None or len(phrase) != self.ngram_count:
+                continue
+            if all(elem == self.start_symbol for elem in phrase):
+                continue
+            new_tokens.setdefault(phrase[:-1], []).append(phrase[-1])
+        for (context, tokens) in new_tokens.iteritems():
+            tokens = sorted(tokens)
+            if context in successors:
+                existing_tokens = successors[context].items
+                existing = set(existing_tokens)
+                tokens = existing_tokens + [token for token in tokens if token not in existing]
+            successors[context] = CumulativeDistribution([(token, math.pow(2, counts[context + (token, )]))
+                                                          for token in tokens])
+
+    @timed("train.counting")
+    def count_training_set(self, training_set, ngram_attribute, count_emissions=False):
+        """Count the n-grams of training_set; see count_training_texts().
+
+        If the generator training_workers setting is more than one the
+        training set is split into that many shards, each shard is counted
+        in a worker process, and the partial count tables are merged
+        pairwise in the pool until one remains."""
+        logger = logging.getLogger("%s.LanguageModel.count_training_set" % APP_NAME)
+        workers = min(self.settings.generator_training_workers, len(training_set))
+        if workers <= 1:
+            return count_training_texts((training_set, ngram_attribute, self.ngram_count,
+                                         self.start_symbol, count_emissions))
+
+        shard_size = int(math.ceil(len(training_set) / workers))
+        shards = [(training_set[i:i+shard_size], ngram_attribute, self.ngram_count,
+                   self.start_symbol, count_emissions)
+                  for i in xrange(0, len(training_set), shard_size)]
+        logger.debug("counting %s shards over %s workers" % (len(shards), workers))
+        pool = multiprocessing.Pool(workers)
+        try:
+            tables = pool.map(count_training_texts, shards)
+            while len(tables) > 1:
+                pairs = [(tables[i], tables[i+1]) for i in xrange(0, len(tables) - 1, 2)]
+                merged = pool.map(merge_count_tables, pairs)
+                if len(tables) % 2 == 1:
+                    merged.append(tables[-1])
+                tables = merged
+        finally:
+            pool.close()
+            pool.join()
+        return tables[0]
+
+    @timed("train.compaction")
+    def compact_counts(self, *attribute_names):
+        """Once training has finished with the count dictionaries, replace
+        them with the more compact store named by the generator count_store
+        setting. "dict" leaves them as they are; "numpy" and "trie" convert
+        them into NumpyCountStore or NGramTrie objects that share one
+        Vocabulary."""
+        count_store = self.settings.generator_count_store
+        if count_store == "dict":
+            return
+        store_cls = {"numpy": NumpyCountStore, "trie": NGramTrie}[count_store]
+        counts_dicts = [getattr(self, name) for name in attribute_names]
+        self.token_vocabulary = Vocabulary.from_counts(*counts_dicts)
+        for (name, counts) in zip(attribute_names, counts_dicts):
+            setattr(self, name, store_cls.from_dict(counts, self.token_vocabulary))
+
+    @timed("train.successor_tables")
+    def build_successor_tables(self, counts, order=None):
+        """Group the n-grams of one order, by default the highest, in
+        counts, which are log2 counts, by their context, the tokens before
+        the last. Returns a dictionary mapping each context tuple to a
+        CumulativeDistribution over the token that follows it, weighted by
+        the n-gram count.
+
+        Chunks made up of nothing but start symbols are padding and are
+        never generated, so they are left out.
+
+        The choices of each context are sorted by token. Iteration order of
+        the count dictionaries differs between processes, as hash(None)
+        does, and sorting keeps seeded generation reproducible across runs.
+        """
+        if order is None:
+            order = self.ngram_count
+        successors = {}
+        if isinstance(counts, NGramTrie):
+            # The trie already holds the successors of each context together.
+            for (context, continuations) in counts.iter_continuations(order - 1):
+                choices = [(token, math.pow(2, count)) for (token, count) in continuations
+                           if not all(elem == self.start_symbol for elem in context + (token, ))]
+                if len(choices) != 0:
+                    successors[context] = choices
+        else:
+            for (phrase, count) in counts.iteritems():
+                if phrase is None or len(phrase) != order:
+                    continue
+                if all(elem == self.start_symbol for elem in phrase):
+                    continue
+                successors.setdefault(phrase[:-1], []).append((phrase[-1], math.pow(2, count)))
+        return dict((context, CumulativeDistribution(sorted(choices)))
+                    for (context, choices) in successors.iteritems())
+
+    def choose_constrained(self, distribution, allows):
+        """Draw a choice from distribution, a CumulativeDistribution, for
+        which allows(choice) is true, or return None if there is none.
+
+        Most draws are usually allowed, so a few plain draws are tried
+        first. After that the disallowed choices are filtered out and the
+        draw is made from the rest, which samples from the same
+        distribution conditioned on being allowed."""
+        for i in xrange(CONSTRAINED_DRAW_ATTEMPTS):
+            choice = distribution.choice()
+            if allows(choice):
+                if metrics.enabled:
+                    metrics.observe("%s.candidates_per_token" % self.__class__.__name__, i + 1)
+                return choice
+        choices = [(choice, weight) for (choice, weight) in distribution.iter_choices()
+                   if allows(choice)]
+        if metrics.enabled:
+            metrics.observe("%s.candidates_per_token" % self.__class__.__name__,
+                            CONSTRAINED_DRAW_ATTEMPTS + len(distribution))
+        if len(choices) == 0:
+            return None
+        return CumulativeDistribution(choices).choice()
+
+    def next_context(self, context, token):
+        """The (n-1)-token context that follows context once token has been
+        drawn, or None if token ends the sentence."""
+        if token == self.stop_symbol:
+            return None
+        return (context + (token, ))[1:]
+
+    def get_batch_successors(self):
+        """self.successors flattened into a BatchSuccessorTable for
+        generate_many(). Built on first use."""
+        if getattr(self, "batch_successors", None) is None:
+            self.batch_successors = BatchSuccessorTable.from_successor_tables(self.successors,
+                                                                              next_context=self.next_context)
+        return self.batch_successors
+
+    def get_cache_statistics(self):
+        """Hit, miss and eviction counts of this model's memoized methods,
+        keyed by cache name."""
+        return dict((name, cache.get_statistics())
+                    for (name, cache) in get_memoize_caches(self).iteritems())
+
+    def clear_caches(self):
+        clear_memoize_caches(self)
+
+    def get_scoring_counts(self):
+        """self.rare_counts as a NumpyCountStore, for score_sentences(). If
+        the model keeps dictionaries a NumpyCountStore copy is made on first
+        use."""
+        if isinstance(self.rare_counts, NumpyCountStore):
+            return self.rare_counts
+        if getattr(self, "scoring_counts", None) is None:
+            self.scoring_counts = NumpyCountStore.from_dict(self.rare_counts)
+        return self.scoring_counts
+
+    def get_rare_ids_by_id(self, counts):
+        """Array mapping every token id in the vocabulary of counts to the id
+        of its rare token, or Vocabulary.UNKNOWN_ID if that isn't in the
+        vocabulary."""
+        vocabulary = counts.vocabulary
+        rare_ids_by_id = getattr(self, "rare_ids_by_id", None)
+        if rare_ids_by_id is None or len(rare_ids_by_id) != len(vocabulary):
+            rare_ids_by_id = [Vocabulary.UNKNOWN_ID] + \
+                             [vocabulary.get_id(self.convert_tokens_to_rare_tokens((vocabulary.get_token(token_id), ))[0])
+                              for token_id in xrange(1, len(vocabulary))]
+            rare_ids_by_id = self.rare_ids_by_id = numpy.array(rare_ids_by_id, dtype=numpy.int64)
+        return rare_ids_by_id
+
+    def encode_chunks(self, sentences, vocabulary):
+        """Encode a list of sentences, each a list of tokens without start or
+        stop symbols, into the chunks of ngram_count tokens that end at
+        every token of the padded sentences. Returns a triple of arrays:
+
+        -   chunks: the token ids of each chunk, one chunk per row.
+        -   rare_chunks: the same with every token converted to its rare
+            token.
+        -   chunk_sentences: the index of each chunk's sentence.
+        """
+        # ---------------------------------------------------------------------
+        #   Encode the padded sentences, and the same sentences with every
+        #   token converted to its rare token, into two flat id arrays, and
+        #   note where each chunk starts.
+        # ---------------------------------------------------------------------
+        padding = [self.start_symbol] * (self.ngram_count - 1)
+        token_ids = []
+        rare_token_ids = []
+        rare_token_ids_cache = {}
+        chunk_starts = []
+        chunk_sentences = []
+        for (index, sentence) in enumerate(sentences):
+            padded_words = padding + list(sentence) + [self.stop_symbol]
+            number_of_chunks = len(padded_words) - (self.ngram_count - 1)
+            chunk_starts.extend(xrange(len(token_ids), len(token_ids) + number_of_chunks))
+            chunk_sentences.extend([index] * number_of_chunks)
+            for word in padded_words:
+                token_ids.append(vocabulary.get_id(word))
+                rare_token_id = rare_token_ids_cache.get(word)
+                if rare_token_id is None:
+                    rare_token = self.convert_tokens_to_rare_tokens((word, ))[0]
+                    rare_token_id = rare_token_ids_cache[word] = vocabulary.get_id(rare_token)
+                rare_token_ids.append(rare_token_id)
+        # ---------------------------------------------------------------------
+
+        positions = numpy.array(chunk_starts, dtype=numpy.int64).reshape(-1, 1) + \
+                    numpy.arange(self.ngram_count)
+        chunks = numpy.array(token_ids, dtype=numpy.int64)[positions]
+        rare_chunks = numpy.array(rare_token_ids, dtype=numpy.int64)[positions]
+        return (chunks, rare_chunks, numpy.array(chunk_sentences, dtype=numpy.int64))
+
     @memoize
     def convert_tokens_to_rare_tokens(self, tokens):
         rare_tokens = []
@@ -109,10 +640,18 @@ class HMMTrigramMaximumLikelihoodModel(LanguageModel):
     """
 
     ngram_count = 3
+    ngram_attribute = "ngram_tags"
+    count_emissions = True
+
+    # (trigram, bigram, unigram) weights of the interpolated tag transitions
+    # used for scoring; see TagLattice.from_counts().
+    transition_lambdas = (0.9, 0.09, 0.01)
 
     def _check_invariants(self):
         pass
 
+    @records_cache_statistics
+    @timed("train")
     def train(self):
         logger = logging.getLogger("%s.HMMTrigramMaximumLikelihoodModel.train" % APP_NAME)
 
@@ -145,39 +684,22 @@ class HMMTrigramMaximumLikelihoodModel(LanguageModel):
         #   We'll also need a vocabulary to use for later geneartion.
         # ---------------------------------------------------------------------
         logger.debug("calculating counts...")
-        self.vocabulary = set()
-        self.counts = {}
-        for training_text in training_set:
-            # Get a word count using the unigram counts.
-            unigram_tags = training_text.ngram_tags[1]
-            tag_count = sum(v for (k, v) in unigram_tags.iteritems() if k != self.start_symbol)
-            self.counts[None] = self.counts.get(None, 0) + tag_count
-            self.vocabulary.update(elem for elem in unigram_tags if elem != self.start_symbol)
-
-            # Get counts for the actual tags.
-            for i in xrange(1, self.ngram_count + 1):
-                ngram_tags = training_text.ngram_tags[i]
-                for (phrase, count) in ngram_tags.iteritems():
-                    self.counts[phrase] = self.counts.get(phrase, 0) + count
-
-            # Start of sentence indicators are:
-            # - for unigram, Count(('__START__', )) = number of sentences.
-            # - for bigram, Count(('__START__', '__START__')) = number of sentences.
-            # etc.
-            number_of_sentences = len(training_text.tagged_sentences)
-            for i in xrange(1, self.ngram_count + 1):
-                start_key = tuple([self.start_symbol] * i)
-                self.counts[start_key] = self.counts.get(start_key, 0) + number_of_sentences
-
-        # ---------------------------------------------------------------------
-        #   Gather the emission bigram counts.
-        # ---------------------------------------------------------------------
-        self.emissions = {}
-        for training_text in training_set:
-            for (tag, words_and_counts) in training_text.tags_words_counts.iteritems():
-                for (word, count) in words_and_counts.iteritems():
-                    key = (tag, word)
-                    self.emissions[key] = self.emissions.get(key, 0) + count
+        self.train_from_counts(self.count_training_set(training_set, self.ngram_attribute, self.count_emissions))
+
+        # ---------------------------------------------------------------------
+        #   Calculate the perplexity of the language model over the testing
+        #   set, summing over every tag sequence with the forward algorithm.
+        # ---------------------------------------------------------------------
+        logger.debug("calculating perplexity...")
+        self.testing_perplexity = self.perplexity(testing_set)
+        logger.debug("self.testing_perplexity: %s" % self.testing_perplexity)
+        # ---------------------------------------------------------------------
+
+    def train_from_counts(self, tables):
+        logger = logging.getLogger("%s.HMMTrigramMaximumLikelihoodModel.train_from_counts" % APP_NAME)
+        self.counts = tables["counts"]
+        self.vocabulary = tables["vocabulary"]
+        self.emissions = tables["emissions"]
 
         # ---------------------------------------------------------------------
         #   Out-of-vocabulary words are a big problem when evaluating
@@ -190,111 +712,43 @@ class HMMTrigramMaximumLikelihoodModel(LanguageModel):
         #   for the purposes of training.
         # ---------------------------------------------------------------------
         logger.debug("fixing up rare tokens in training set...")
-        self.rare_counts = copy.copy(self.counts)
-        for (phrase, phrase_count) in self.counts.iteritems():
-            #logger.debug('phrase: "%s", phrase_count: "%s"' % (phrase, phrase_count))
-            if phrase is None:
-                continue
-            new_phrase = []
-            for tag in phrase:
-                count = self.counts[(tag, )]
-                if count <= self.infrequent_count_threshold:
-                    rare_token = self.convert_tokens_to_rare_tokens((tag, ))
-                    new_phrase.append(rare_token[0])
-                else:
-                    new_phrase.append(tag)
-            new_phrase = tuple(new_phrase)
-            if new_phrase == phrase:
-                #logger.debug("phrase unchanged, no parts of it are rare.")
-                continue
-            #logger.debug("before: new_phrase: '%s', self.rare_counts[new_phrase]: '%s'" % (new_phrase, self.rare_counts.get(new_phrase, 0)))
-            self.rare_counts[new_phrase] = self.rare_counts.get(new_phrase, 0) + phrase_count
-            #logger.debug("after: new_phrase: '%s', self.rare_counts[new_phrase]: '%s'" % (new_phrase, self.rare_counts.get(new_phrase, 0)))
-            del self.rare_counts[phrase]
-
-        # Convert all the counts to a log count; we don't need raw counts
-        # any more.
-        for (k, v) in self.rare_counts.iteritems():
-            self.rare_counts[k] = math.log(v, 2)
-        for (k, v) in self.counts.iteritems():
-            self.counts[k] = math.log(v, 2)
-        # ---------------------------------------------------------------------
-
-        # ---------------------------------------------------------------------
-        #   Calculate the perplexity of the language model over the testing
-        #   set.
-        #
-        #   !!AI TODO
-        # ---------------------------------------------------------------------
-        logger.debug("calculating perplexity...")
+        self.collapse_rare_tokens()
+        self.tag_lattice = None
         # ---------------------------------------------------------------------
 
-    def transmission_tags(self, chunk, counts):
-        logger = logging.getLogger("%s.transmission_tags" % APP_NAME)
-
-        # ---------------------------------------------------------------------
-        #   Determine the q_ML numerator.
-        # ---------------------------------------------------------------------
-        numerator = None
-        numerator_keys = [chunk,
-                          self.convert_tokens_to_rare_tokens(chunk)]
-                          #self.convert_tokens_to_basic_rare_tokens(chunk)]
-        for numerator_key in numerator_keys:
-            if numerator_key in counts:
-                numerator = counts[numerator_key]
-                break
-        if numerator is None:
-            logger.error("no numerator found for chunk: '%s'" % (chunk, ))
-        assert(numerator is not None)
         # ---------------------------------------------------------------------
-
-        # ---------------------------------------------------------------------
-        #   Determine the q_ML denomenator.
+        #   Group the tag transitions by their (n-1)-tag context and the
+        #   emissions by their tag once, so that generation can sample
+        #   each tag and each word directly.
         # ---------------------------------------------------------------------
-        denomenator = None
-        if len(chunk) == 1:
-            denomenator_keys = [None]
-        else:
-            denomenator_keys = [numerator_key[:-1],
-                                self.convert_tokens_to_rare_tokens(numerator_key[:-1])]
-                                #self.convert_tokens_to_basic_rare_tokens(chunk[:-1])]
-        for denomenator_key in denomenator_keys:
-            if denomenator_key in counts:
-                denomenator = counts[denomenator_key]
-                break
-        if denomenator is None:
-            logger.error("no denomenator found for chunk: '%s', numerator_key: '%s'" % (chunk, numerator_key))
-        assert(denomenator is not None)
+        logger.debug("building transition and emission tables...")
+        self.successors = self.build_successor_tables(self.counts)
+        emissions_by_tag = {}
+        for ((tag, word), count) in self.emissions.iteritems():
+            emissions_by_tag.setdefault(tag, []).append((word, count))
+        self.emission_tables = dict((tag, CumulativeDistribution(sorted(words_and_counts)))
+                                    for (tag, words_and_counts) in emissions_by_tag.iteritems())
         # ---------------------------------------------------------------------
 
-        return numerator - denomenator
+        self.compact_counts("counts", "rare_counts", "emissions")
 
-    def generate(self):
+    @timed("generate")
+    def generate(self, constraints=None):
         logger = logging.getLogger("%s.HMMTrigramMaximumLikelihoodModel.generate" % APP_NAME)
         logger.debug("entry.")
+        if constraints is not None:
+            return self.generate_constrained(constraints)
 
         # ---------------------------------------------------------------------
         #   First, "transmit" a series of tags using trigram counts.
-        #
-        #   !!AI almost a total copy-paste of other code, what a waste.
         # ---------------------------------------------------------------------
         sentence_of_tags = [self.start_symbol] * (self.ngram_count - 1)
         while True:
             #logger.debug("top of loop, sentence so far: %s" % (sentence, ))
             if len(sentence_of_tags) != 0 and sentence_of_tags[-1] == self.stop_symbol:
                 break
-            if self.ngram_count == 1:
-                chunk_contents = (tag for tag in self.vocabulary)
-            else:
-                chunk_contents = (tuple(sentence_of_tags[-(self.ngram_count - 1):] + list(tag))
-                                  for tag in self.vocabulary)
-            valid_chunk_contents = [chunk for chunk in chunk_contents
-                                    if chunk in self.counts
-                                    and not all(elem == self.start_symbol for elem in chunk)]
-            chunk_contents_and_probabilities = [(chunk, math.pow(2, self.transmission_tags(chunk, self.counts)))
-                                                for chunk in valid_chunk_contents]
-            next_chunk = weighted_choice(chunk_contents_and_probabilities)
-            next_tag = next_chunk[-1]
+            context = tuple(sentence_of_tags[len(sentence_of_tags) - (self.ngram_count - 1):])
+            next_tag = self.successors[context].choice()
             sentence_of_tags.append(next_tag)
         # ---------------------------------------------------------------------
 
@@ -308,17 +762,164 @@ class HMMTrigramMaximumLikelihoodModel(LanguageModel):
         for current_tag in sentence_of_tags:
             if current_tag in self.sentinels:
                 continue
-            emissions = [ (word, count)
-                          for ((tag, word), count) in self.emissions.iteritems()
-                          if current_tag == tag ]
-            emitted_word = weighted_choice(emissions)
+            emitted_word = self.emission_tables[current_tag].choice()
             sentence.append(emitted_word)
         # ---------------------------------------------------------------------
 
-        joined_sentence = ' '.join(word for word in sentence)
-        if not joined_sentence.endswith("."):
-            joined_sentence += "."
-        return strip_leading_spaces_on_punctuation(joined_sentence)
+        return self.render_sentence(sentence)
+
+    def generate_constrained(self, constraints):
+        """Sample a sentence meeting constraints, a GenerationConstraints,
+        or return None if that fails constraints.maximum_attempts times.
+
+        The tag sequence is drawn first, with the stop tag allowed only
+        once there are enough tags for the minimum number of words and
+        other tags only while there is room for more words. If the
+        sentence must start with a given word the first tag is drawn from
+        the tags that emit it. Each word is then emitted from only the
+        words its tag allows at that point; if there are none, the
+        sentence is started again."""
+        start_tags = None
+        if constraints.start_word is not None:
+            start_tags = set(tag for tag in self.emission_tables
+                             if (tag, constraints.start_word) in self.emissions)
+            if len(start_tags) == 0:
+                return None
+
+        for attempt in xrange(constraints.maximum_attempts):
+            tags = []
+            def allows_tag(tag):
+                if len(tags) == 0 and start_tags is not None and tag not in start_tags:
+                    return False
+                if tag == self.stop_symbol:
+                    return constraints.minimum_tokens is None or len(tags) >= constraints.minimum_tokens
+                return constraints.maximum_tokens is None or len(tags) < constraints.maximum_tokens
+
+            context = tuple([self.start_symbol] * (self.ngram_count - 1))
+            while True:
+                tag = self.choose_constrained(self.successors[context], allows_tag)
+                if tag is None or tag == self.stop_symbol:
+                    break
+                tags.append(tag)
+                context = self.next_context(context, tag)
+            if tag is None:
+                continue
+
+            sentence = constraints.start_sentence()
+            for tag in tags:
+                word = self.choose_constrained(self.emission_tables[tag], sentence.allows_word)
+                if word is None:
+                    break
+                sentence.append(word)
+            else:
+                rendered_sentence = self.render_sentence(sentence.words)
+                if constraints.allows_sentence(rendered_sentence):
+                    return rendered_sentence
+        return None
+
+    @timed_per_item("generate_many")
+    def generate_many(self, n, seed=None, constraints=None):
+        """Generate n sentences together. All n tag sequences are advanced in
+        lockstep, one vectorized draw per step, and then every word of
+        every sentence is emitted in a single vectorized draw.
+
+        Sentences under constraints are generated one at a time; see
+        LanguageModel.generate_many()."""
+        if constraints is not None:
+            return super(HMMTrigramMaximumLikelihoodModel, self).generate_many(n, seed, constraints)
+        if n <= 0:
+            return []
+        random_state = get_random_state(seed)
+        start_context = tuple([self.start_symbol] * (self.ngram_count - 1))
+        sequences_of_tags = self.get_batch_successors().sample_sequences(n,
+                                                                         start_context,
+                                                                         self.stop_symbol,
+                                                                         random_state)
+
+        emissions = self.get_batch_emissions()
+        tags = [tag for sequence in sequences_of_tags for tag in sequence
+                if tag not in self.sentinels]
+        lengths = [sum(1 for tag in sequence if tag not in self.sentinels)
+                   for sequence in sequences_of_tags]
+        rows = numpy.array([emissions.get_row(tag) for tag in tags], dtype=numpy.int64)
+        positions = emissions.sample(rows, random_state)
+        words = emissions.decode(emissions.tokens[positions])
+        sentences = numpy.split(words, numpy.cumsum(lengths)[:-1])
+        return [self.render_sentence(sentence) for sentence in sentences]
+
+    @timed("update")
+    def update(self, new_processed_texts):
+        """Fold new_processed_texts into the trained model without
+        retraining it; see update_counts(). Only the transition and emission
+        tables whose counts changed are rebuilt, and the tag lattice is
+        rebuilt on next use. testing_perplexity is left as it was measured
+        at training time."""
+        logger = logging.getLogger("%s.HMMTrigramMaximumLikelihoodModel.update" % APP_NAME)
+        logger.debug("entry. len(new_processed_texts): %s" % len(new_processed_texts))
+        tables = self.update_counts(new_processed_texts, "ngram_tags", count_emissions=True)
+        self.update_successor_tables(self.successors, self.counts, tables["counts"])
+
+        new_words_by_tag = {}
+        for (tag, word) in tables["emissions"]:
+            new_words_by_tag.setdefault(tag, []).append(word)
+        for (tag, words) in new_words_by_tag.iteritems():
+            words = sorted(words)
+            if tag in self.emission_tables:
+                existing_words = self.emission_tables[tag].items
+                existing = set(existing_words)
+                words = existing_words + [word for word in words if word not in existing]
+            self.emission_tables[tag] = CumulativeDistribution([(word, self.emissions[(tag, word)])
+                                                                for word in words])
+        self.batch_successors = None
+        self.batch_emissions = None
+        self.tag_lattice = None
+
+    @timed("perplexity")
+    def perplexity(self, processed_texts):
+        """Perplexity of the language model over the sentences of an
+        iterable of ProcessedText objects, normalized by the same word count
+        as NGramMaximumLikelihoodLanguageModel.perplexity() so the two can
+        be compared."""
+        M = 0
+        sentences = []
+        for text in processed_texts:
+            M += sum(v for v in text.ngram_words[1].itervalues())
+            sentences.extend([word for (word, tag) in sentence]
+                             for sentence in text.tagged_sentences)
+        L = numpy.sum(self.score_sentences(sentences)) / M
+        return math.pow(2, -L)
+
+    @counted_tokens("tokens_scored")
+    def score_sentences(self, sentences):
+        """log2 probability of each of a list of sentences, each a list of
+        word tokens without start or stop symbols, summed over every tag
+        sequence. Returns a NumPy array."""
+        return self.get_tag_lattice().score_sentences(sentences)
+
+    def viterbi_tags(self, sentences):
+        """Most likely tag sequence of each of a list of sentences, each a
+        list of word tokens, or None for a sentence the model cannot
+        emit."""
+        return self.get_tag_lattice().decode(sentences)
+
+    def get_tag_lattice(self):
+        """The model as a TagLattice, for score_sentences() and
+        viterbi_tags(). Built on first use."""
+        if getattr(self, "tag_lattice", None) is None:
+            self.tag_lattice = TagLattice.from_counts(self.counts,
+                                                      self.emissions,
+                                                      self.start_symbol,
+                                                      self.stop_symbol,
+                                                      self.infrequent_count_threshold,
+                                                      self.transition_lambdas)
+        return self.tag_lattice
+
+    def get_batch_emissions(self):
+        """self.emission_tables flattened into a BatchSuccessorTable, with
+        one row per tag. Built on first use."""
+        if getattr(self, "batch_emissions", None) is None:
+            self.batch_emissions = BatchSuccessorTable.from_successor_tables(self.emission_tables)
+        return self.batch_emissions
 
 class NGramMaximumLikelihoodLanguageModel(LanguageModel):
     """Maximum Likelihood language models use one particular n-gram size with
@@ -334,10 +935,16 @@ class NGramMaximumLikelihoodLanguageModel(LanguageModel):
     would never end!).
     """
 
+    # Defaults for beam_search() and restricted sampling in generate().
+    beam_width = 16
+    maximum_sentence_length = 60
+
     def _check_invariants(self):
         assert(hasattr(self, "ngram_count"))
         super(NGramMaximumLikelihoodLanguageModel, self)._check_invariants()
 
+    @records_cache_statistics
+    @timed("train")
     def train(self):
         self._check_invariants()
         logger = logging.getLogger("%s.NGramMaximumLikelihoodLanguageModel.train" % APP_NAME)
@@ -378,29 +985,21 @@ class NGramMaximumLikelihoodLanguageModel(LanguageModel):
         #   We'll also need a vocabulary to use for later geneartion.
         # ---------------------------------------------------------------------
         logger.debug("calculating counts...")
-        self.vocabulary = set()
-        self.counts = {}
-        for training_text in training_set:
-            # Get a word count using the unigram counts.
-            unigram_words = training_text.ngram_words[1]
-            word_count = sum(v for (k, v) in unigram_words.iteritems() if k != self.start_symbol)
-            self.counts[None] = self.counts.get(None, 0) + word_count
-            self.vocabulary.update(elem for elem in unigram_words if elem != self.start_symbol)
-
-            # Get counts for the actual words.
-            for i in xrange(1, self.ngram_count + 1):
-                ngram_words = training_text.ngram_words[i]
-                for (phrase, count) in ngram_words.iteritems():
-                    self.counts[phrase] = self.counts.get(phrase, 0) + count
-
-            # Start of sentence indicators are:
-            # - for unigram, Count(('__START__', )) = number of sentences.
-            # - for bigram, Count(('__START__', '__START__')) = number of sentences.
-            # etc.
-            number_of_sentences = len(training_text.tagged_sentences)
-            for i in xrange(1, self.ngram_count + 1):
-                start_key = tuple([self.start_symbol] * i)
-                self.counts[start_key] = self.counts.get(start_key, 0) + number_of_sentences
+        self.train_from_counts(self.count_training_set(training_set, self.ngram_attribute))
+
+        # ---------------------------------------------------------------------
+        #   Calculate the perplexity of the language model over the testing
+        #   set.
+        # ---------------------------------------------------------------------
+        logger.debug("calculating perplexity...")
+        self.testing_perplexity = self.perplexity(testing_set)
+        logger.debug("self.testing_perplexity: %s" % self.testing_perplexity)
+        # ---------------------------------------------------------------------
+
+    def train_from_counts(self, tables):
+        logger = logging.getLogger("%s.NGramMaximumLikelihoodLanguageModel.train_from_counts" % APP_NAME)
+        self.counts = tables["counts"]
+        self.vocabulary = tables["vocabulary"]
 
         # ---------------------------------------------------------------------
         #   Out-of-vocabulary words are a big problem when evaluating
@@ -413,138 +1012,265 @@ class NGramMaximumLikelihoodLanguageModel(LanguageModel):
         #   for the purposes of training.
         # ---------------------------------------------------------------------
         logger.debug("fixing up rare tokens in training set...")
-        self.rare_counts = copy.copy(self.counts)
-        for (phrase, phrase_count) in self.counts.iteritems():
-            #logger.debug('phrase: "%s", phrase_count: "%s"' % (phrase, phrase_count))
-            if phrase is None:
-                continue
-            new_phrase = []
-            for word in phrase:
-                count = self.counts[(word, )]
-                if count <= self.infrequent_count_threshold:
-                    rare_token = self.convert_tokens_to_rare_tokens((word, ))
-                    new_phrase.append(rare_token[0])
-                else:
-                    new_phrase.append(word)
-            new_phrase = tuple(new_phrase)
-            if new_phrase == phrase:
-                #logger.debug("phrase unchanged, no parts of it are rare.")
-                continue
-            #logger.debug("before: new_phrase: '%s', self.rare_counts[new_phrase]: '%s'" % (new_phrase, self.rare_counts.get(new_phrase, 0)))
-            self.rare_counts[new_phrase] = self.rare_counts.get(new_phrase, 0) + phrase_count
-            #logger.debug("after: new_phrase: '%s', self.rare_counts[new_phrase]: '%s'" % (new_phrase, self.rare_counts.get(new_phrase, 0)))
-            del self.rare_counts[phrase]
-
-        # Convert all the counts to a log count; we don't need raw counts
-        # any more.
-        for (k, v) in self.rare_counts.iteritems():
-            self.rare_counts[k] = math.log(v, 2)
-        for (k, v) in self.counts.iteritems():
-            self.counts[k] = math.log(v, 2)
+        self.collapse_rare_tokens()
+        self.compact_counts("counts", "rare_counts")
         # ---------------------------------------------------------------------
 
         # ---------------------------------------------------------------------
-        #   Calculate the perplexity of the language model over the testing
-        #   set.
+        #   Index the successors of every (n-1)-word context once, so that
+        #   generation draws each word with one lookup and one random
+        #   number instead of probing the whole vocabulary.
         # ---------------------------------------------------------------------
-        logger.debug("calculating perplexity...")
-
-        # This will be the sum of all log2 probabilities of all sentences in
-        # the testing set under this language model.
-        testing_probability = 0
-
-        # Need M, total number of words in testing set, to normalize the
-        # probabilities.
-        # See 'Evaluating Language Models: Perplexity' in NLP notes.
-        M = 0
-        for testing_text in testing_set:
-            unigram_words = testing_text.ngram_words[1]
-            word_count = sum(v for v in unigram_words.itervalues())
-            M += word_count
-
-            for sentence in testing_text.tagged_sentences:
-                words = [word for (word, tag) in sentence]
-                padded_words = [testing_text.START_SYMBOL] * (self.ngram_count - 1) + words + [testing_text.STOP_SYMBOL]
-                chunked_words = [tuple(padded_words[i:i+self.ngram_count])
-                                 for i in xrange(len(padded_words) - (self.ngram_count - 1))]
-                transmissions = [self.transmission_words(chunk, self.rare_counts) for chunk in chunked_words]
-                testing_probability += sum(transmissions)
-        L = testing_probability / M
-        self.perplexity = math.pow(2, -L)
-        logger.debug("self.perplexity: %s" % self.perplexity)
+        logger.debug("building successor tables...")
+        self.successors = self.build_successor_tables(self.counts)
         # ---------------------------------------------------------------------
 
-    def generate(self):
+    @timed("generate")
+    def generate(self, top_k=None, top_p=None, constraints=None):
+        """Sample a sentence. By default every word is drawn from all of its
+        successors; top_k and top_p restrict the draw as in
+        choose_restricted(). A restricted draw may never pick the stop
+        symbol, so restricted sentences are ended after
+        maximum_sentence_length words. See generate_constrained() for
+        constraints."""
         logger = logging.getLogger("%s.NGramMaximumLikelihoodLanguageModel.generate" % APP_NAME)
         logger.debug("entry.")
+        if constraints is not None:
+            return self.generate_constrained(constraints, top_k, top_p)
 
         sentence = [self.start_symbol] * (self.ngram_count - 1)
         while True:
             #logger.debug("top of loop, sentence so far: %s" % (sentence, ))
             if len(sentence) != 0 and sentence[-1] == self.stop_symbol:
                 break
-            if self.ngram_count == 1:
-                chunk_contents = (word for word in self.vocabulary)
+            context = tuple(sentence[len(sentence) - (self.ngram_count - 1):])
+            if top_k is None and top_p is None:
+                next_word = self.successors[context].choice()
+            elif len(sentence) - (self.ngram_count - 1) >= self.maximum_sentence_length:
+                next_word = self.stop_symbol
             else:
-                chunk_contents = (tuple(sentence[-(self.ngram_count - 1):] + list(word))
-                                  for word in self.vocabulary)
-            valid_chunk_contents = [chunk for chunk in chunk_contents
-                                    if chunk in self.counts
-                                    and not all(elem == self.start_symbol for elem in chunk)]
-            chunk_contents_and_probabilities = [(chunk, math.pow(2, self.transmission_words(chunk, self.counts)))
-                                                for chunk in valid_chunk_contents]
-            next_chunk = weighted_choice(chunk_contents_and_probabilities)
-            next_word = next_chunk[-1]
+                next_word = self.choose_restricted(context, top_k, top_p)
             sentence.append(next_word)
 
-        joined_sentence = ' '.join([word for word in sentence if word not in self.sentinels])
-        if not joined_sentence.endswith("."):
-            joined_sentence += "."
-        return strip_leading_spaces_on_punctuation(joined_sentence)
-
-    def transmission_words(self, chunk, counts):
-        logger = logging.getLogger("%s.transmission_words" % APP_NAME)
+        return self.render_sentence(sentence)
+
+    def generate_constrained(self, constraints, top_k=None, top_p=None):
+        """Sample a sentence meeting constraints, a GenerationConstraints,
+        or return None if that fails constraints.maximum_attempts times.
+
+        Each word, and the stop symbol, is drawn from only the successors
+        that keep the sentence within the constraints. If there are none
+        the sentence is started again."""
+        restricted = (top_k is not None or top_p is not None)
+        for attempt in xrange(constraints.maximum_attempts):
+            sentence = constraints.start_sentence()
+            def allows(word):
+                if word == self.stop_symbol:
+                    return sentence.allows_stop()
+                return sentence.allows_word(word)
+
+            context = tuple([self.start_symbol] * (self.ngram_count - 1))
+            while True:
+                if restricted and len(sentence.words) >= self.maximum_sentence_length:
+                    word = self.stop_symbol if sentence.allows_stop() else None
+                elif restricted:
+                    word = self.choose_constrained(self.get_restricted_distribution(context, top_k, top_p), allows)
+                else:
+                    word = self.choose_constrained(self.successors[context], allows)
+                if word is None or word == self.stop_symbol:
+                    break
+                sentence.append(word)
+                context = self.next_context(context, word)
+            if word is not None:
+                rendered_sentence = self.render_sentence(sentence.words)
+                if constraints.allows_sentence(rendered_sentence):
+                    return rendered_sentence
+        return None
+
+    def choose_restricted(self, context, top_k=None, top_p=None):
+        """Draw the word following context from its top_k most likely
+        successors and, if top_p is given, from only the fewest most likely
+        of those whose probabilities sum to at least top_p. Probabilities
+        are renormalized over the words kept."""
+        return self.get_restricted_distribution(context, top_k, top_p).choice()
+
+    def get_restricted_distribution(self, context, top_k=None, top_p=None):
+        """CumulativeDistribution over the successors of context that
+        choose_restricted() draws from."""
+        choices = self.get_successor_log_probabilities()[context]
+        if top_k is not None:
+            choices = choices[:top_k]
+        if top_p is not None:
+            cumulative_probability = 0
+            for (i, (log_probability, token)) in enumerate(choices):
+                cumulative_probability += math.pow(2, log_probability)
+                if cumulative_probability >= top_p:
+                    choices = choices[:i+1]
+                    break
+        if metrics.enabled:
+            metrics.observe("%s.restricted_candidates_per_token" % self.__class__.__name__, len(choices))
+        return CumulativeDistribution([(token, math.pow(2, log_probability))
+                                       for (log_probability, token) in choices])
+
+    def beam_search(self, k=1, beam_width=None, maximum_length=None):
+        """The k most likely sentences of at most maximum_length words under
+        the model, as a list of (log2 probability, sentence) pairs, most
+        likely first.
+
+        Sentences are extended one word at a time. At each step only the
+        beam_width most likely partial sentences are kept, and each is only
+        extended by its beam_width most likely next words. A log
+        probability only falls as a sentence grows, so the search stops as
+        soon as no partial sentence can beat the k-th finished one. Fewer
+        than k sentences are returned if fewer finish within
+        maximum_length words.
+        """
+        logger = logging.getLogger("%s.NGramMaximumLikelihoodLanguageModel.beam_search" % APP_NAME)
+        if beam_width is None:
+            beam_width = self.beam_width
+        beam_width = max(beam_width, k)
+        if maximum_length is None:
+            maximum_length = self.maximum_sentence_length
+        logger.debug("entry. k: %s, beam_width: %s, maximum_length: %s" % (k, beam_width, maximum_length))
+
+        log_probabilities = self.get_successor_log_probabilities()
+        beam = [(0, tuple([self.start_symbol] * (self.ngram_count - 1)))]
+        finished = []
+        for length in xrange(maximum_length + 1):
+            candidates = []
+            for (score, sentence) in beam:
+                context = sentence[len(sentence) - (self.ngram_count - 1):]
+                for (log_probability, token) in log_probabilities[context][:beam_width]:
+                    candidates.append((score + log_probability, sentence + (token, )))
+            beam = []
+            for candidate in heapq.nlargest(beam_width, candidates):
+                if candidate[1][-1] == self.stop_symbol:
+                    finished.append(candidate)
+                elif length < maximum_length:
+                    beam.append(candidate)
+            finished = heapq.nlargest(k, finished)
+            if len(beam) == 0 or (len(finished) == k and beam[0][0] <= finished[-1][0]):
+                break
+        return [(score, self.render_sentence(sentence)) for (score, sentence) in finished]
+
+    def get_successor_log_probabilities(self):
+        """For each context in self.successors, its successors as a list of
+        (log2 probability, word) pairs, most likely first. Built on first
+        use."""
+        if getattr(self, "successor_log_probabilities", None) is None:
+            self.successor_log_probabilities = {}
+            for (context, distribution) in self.successors.iteritems():
+                log_total = math.log(distribution.total, 2)
+                choices = [(self.counts[context + (token, )] - log_total, token)
+                           for token in distribution.items]
+                choices.sort(reverse=True)
+                self.successor_log_probabilities[context] = choices
+        return self.successor_log_probabilities
+
+    @timed_per_item("generate_many")
+    def generate_many(self, n, seed=None, constraints=None):
+        """Generate n sentences together. All n sentences are advanced in
+        lockstep, drawing the next word for every unfinished sentence in one
+        vectorized step and retiring each as it reaches the stop symbol.
+
+        Sentences under constraints are generated one at a time; see
+        LanguageModel.generate_many()."""
+        if constraints is not None:
+            return super(NGramMaximumLikelihoodLanguageModel, self).generate_many(n, seed, constraints)
+        if n <= 0:
+            return []
+        start_context = tuple([self.start_symbol] * (self.ngram_count - 1))
+        sequences = self.get_batch_successors().sample_sequences(n,
+                                                                 start_context,
+                                                                 self.stop_symbol,
+                                                                 get_random_state(seed))
+        return [self.render_sentence(words) for words in sequences]
+
+    @timed("update")
+    def update(self, new_processed_texts):
+        """Fold new_processed_texts into the trained model without
+        retraining it; see update_counts(). Only the successor tables whose
+        counts changed are rebuilt. testing_perplexity is left as it was
+        measured at training time."""
+        logger = logging.getLogger("%s.NGramMaximumLikelihoodLanguageModel.update" % APP_NAME)
+        logger.debug("entry. len(new_processed_texts): %s" % len(new_processed_texts))
+        tables = self.update_counts(new_processed_texts, "ngram_words")
+        self.update_successor_tables(self.successors, self.counts, tables["counts"])
+        self.batch_successors = None
+        self.scoring_counts = None
+        self.successor_log_probabilities = None
+
+    @timed("perplexity")
+    def perplexity(self, processed_texts):
+        """Perplexity of the language model over the sentences of an
+        iterable of ProcessedText objects, scored in one batch."""
+        # Need M, total number of words in the texts, to normalize the
+        # probabilities.
+        # See 'Evaluating Language Models: Perplexity' in NLP notes.
+        M = 0
+        sentences = []
+        for text in processed_texts:
+            M += sum(v for v in text.ngram_words[1].itervalues())
+            sentences.extend([word for (word, tag) in sentence]
+                             for sentence in text.tagged_sentences)
+        L = numpy.sum(self.score_sentences(sentences)) / M
+        return math.pow(2, -L)
+
+    @counted_tokens("tokens_scored")
+    def score_sentences(self, sentences):
+        """log2 probability of each of a list of sentences, each a list of
+        word tokens without start or stop symbols. Returns a NumPy array.
+
+        Each chunk's q_ML numerator is its count in self.rare_counts,
+        falling back to the count of the chunk with every token converted
+        to its rare token, and its denomenator is the count of whichever of
+        the two was found, less its last token. The whole batch is encoded
+        into token ids and every chunk looked up in one vectorized pass
+        over a NumpyCountStore.
+        """
+        logger = logging.getLogger("%s.NGramMaximumLikelihoodLanguageModel.score_sentences" % APP_NAME)
+        counts = self.get_scoring_counts()
+        vocabulary = counts.vocabulary
+        rare_ids_by_id = self.get_rare_ids_by_id(counts)
+        (chunks, rare_chunks, chunk_sentences) = self.encode_chunks(sentences, vocabulary)
+        if len(chunks) == 0:
+            return numpy.zeros(len(sentences), dtype=numpy.float64)
 
         # ---------------------------------------------------------------------
-        #   Determine the q_ML numerator.
+        #   Determine the q_ML numerators, falling back to the rare chunk.
         # ---------------------------------------------------------------------
-        numerator = None
-        numerator_keys = [chunk,
-                          self.convert_tokens_to_rare_tokens(chunk)]
-                          #self.convert_tokens_to_basic_rare_tokens(chunk)]
-        for numerator_key in numerator_keys:
-            if numerator_key in counts:
-                numerator = counts[numerator_key]
-                break
-        if numerator is None:
-            logger.error("no numerator found for chunk: '%s'" % (chunk, ))
-        assert(numerator is not None)
+        (numerators, found) = counts.lookup_ids(chunks)
+        (rare_numerators, rare_found) = counts.lookup_ids(rare_chunks)
+        missing = ~(found | rare_found)
+        if missing.any():
+            chunk = tuple(vocabulary.get_token(token_id) for token_id in chunks[missing][0])
+            logger.error("no numerator found for %s chunks, e.g.: '%s'" % (missing.sum(), chunk))
+        assert(not missing.any())
+        numerators = numpy.where(found, numerators, rare_numerators)
         # ---------------------------------------------------------------------
 
         # ---------------------------------------------------------------------
-        #   Determine the q_ML denomenator.
+        #   Determine the q_ML denomenators, from whichever numerator key
+        #   was used.
         # ---------------------------------------------------------------------
-        denomenator = None
-        if len(chunk) == 1:
-            denomenator_keys = [None]
+        if self.ngram_count == 1:
+            denomenators = counts[None]
         else:
-            denomenator_keys = [numerator_key[:-1],
-                                self.convert_tokens_to_rare_tokens(numerator_key[:-1])]
-                                #self.convert_tokens_to_basic_rare_tokens(chunk[:-1])]
-        for denomenator_key in denomenator_keys:
-            if denomenator_key in counts:
-                denomenator = counts[denomenator_key]
-                break
-        if denomenator is None:
-            logger.error("no denomenator found for chunk: '%s', numerator_key: '%s'" % (chunk, numerator_key))
-        assert(denomenator is not None)
+            numerator_keys = numpy.where(found[:, numpy.newaxis], chunks, rare_chunks)
+            denomenator_keys = numerator_keys[:, :-1]
+            (denomenators, found) = counts.lookup_ids(denomenator_keys)
+            (rare_denomenators, rare_found) = counts.lookup_ids(rare_ids_by_id[denomenator_keys])
+            missing = ~(found | rare_found)
+            if missing.any():
+                chunk = tuple(vocabulary.get_token(token_id) for token_id in denomenator_keys[missing][0])
+                logger.error("no denomenator found for %s chunks, e.g.: '%s'" % (missing.sum(), chunk))
+            assert(not missing.any())
+            denomenators = numpy.where(found, denomenators, rare_denomenators)
         # ---------------------------------------------------------------------
 
-        #if self.ngram_count == 2:
-        #    import ipdb; ipdb.set_trace()
-        #    pass
-
-        return numerator - denomenator
+        return numpy.bincount(chunk_sentences,
+                              weights=numerators - denomenators,
+                              minlength=len(sentences))
 
 class UnigramMaximumLikelihoodLanguageModel(NGramMaximumLikelihoodLanguageModel):
     ngram_count = 1
@@ -559,3 +1285,535 @@ class QuadgramMaximumLikelihoodLanguageModel(NGramMaximumLikelihoodLanguageModel
     ngram_count = 4
 
 
+class LinearInterpolationLanguageModel(LanguageModel):
+    """Linearly interpolated n-gram language model over words. The
+    probability of a word is a weighted sum of its maximum likelihood
+    probabilities under every order from unigram up to ngram_count:
+
+        q(w | u, v) = lambda_3 q_ML(w | u, v) + lambda_2 q_ML(w | v) + lambda_1 q_ML(w)
+
+    with the lambdas summing to one. They are estimated by expectation
+    maximization on the cross-validation split. The maximum likelihood
+    probabilities of every order for every held-out token are computed once
+    into a (tokens, orders) matrix, so each iteration is a few vectorized
+    operations on that matrix and never looks at the counts.
+
+    Every order is a distribution over the vocabulary. Infrequent tokens
+    are collapsed into their rare token, as in the other models, and the
+    probability of a rare token is shared equally between the infrequent
+    tokens it stands for.
+    """
+
+    # Expectation maximization of the lambdas stops after this many
+    # iterations, or once no lambda moves by more than em_tolerance.
+    maximum_em_iterations = 200
+    em_tolerance = 1e-6
+
+    def _check_invariants(self):
+        assert(hasattr(self, "ngram_count"))
+        super(LinearInterpolationLanguageModel, self)._check_invariants()
+
+    @records_cache_statistics
+    @timed("train")
+    def train(self):
+        self._check_invariants()
+        logger = logging.getLogger("%s.LinearInterpolationLanguageModel.train" % APP_NAME)
+        logger.debug("entry. self.ngram_count: %s" % self.ngram_count)
+
+        # ---------------------------------------------------------------------
+        #   Split up input into training, cross-validation and testing. The
+        #   counts come from the training set and the lambdas from the
+        #   cross-validation set.
+        # ---------------------------------------------------------------------
+        size = len(self.processed_texts)
+        cross_validation_size = int(size * self.settings.generator_non_kfold_cross_validation_proportion)
+        testing_size = int(size * self.settings.generator_non_kfold_testing_proportion)
+        training_size = (size - cross_validation_size - testing_size)
+        logger.debug("training_size: %s, cross_validation_size: %s, testing_size: %s" %
+                     (training_size, cross_validation_size, testing_size))
+
+        training_set = self.processed_texts[:training_size]
+        cross_validation_set = self.processed_texts[training_size:training_size + cross_validation_size]
+        testing_set = self.processed_texts[training_size + cross_validation_size:]
+        self.start_symbol = training_set[0].START_SYMBOL
+        self.stop_symbol = training_set[0].STOP_SYMBOL
+        # ---------------------------------------------------------------------
+
+        logger.debug("calculating counts...")
+        self.train_from_counts(self.count_training_set(training_set, self.ngram_attribute))
+
+        # ---------------------------------------------------------------------
+        #   Fit the lambdas on the cross-validation set. Without one every
+        #   order keeps an equal weight.
+        # ---------------------------------------------------------------------
+        if len(cross_validation_set) != 0:
+            logger.debug("estimating lambdas...")
+            sentences = [[word for (word, tag) in sentence]
+                         for text in cross_validation_set for sentence in text.tagged_sentences]
+            (probabilities, chunk_sentences) = self.get_order_probabilities(sentences)
+            self.lambdas = self.estimate_lambdas(probabilities)
+        logger.debug("self.lambdas: %s" % (self.lambdas, ))
+        # ---------------------------------------------------------------------
+
+        logger.debug("calculating perplexity...")
+        self.testing_perplexity = self.perplexity(testing_set)
+        logger.debug("self.testing_perplexity: %s" % self.testing_perplexity)
+
+    def train_from_counts(self, tables):
+        logger = logging.getLogger("%s.LinearInterpolationLanguageModel.train_from_counts" % APP_NAME)
+        self.counts = tables["counts"]
+        self.vocabulary = tables["vocabulary"]
+        self.lambdas = numpy.ones(self.ngram_count) / self.ngram_count
+
+        logger.debug("fixing up rare tokens in training set...")
+        self.collapse_rare_tokens()
+        self.rare_type_counts = {}
+        for rare_token in self.rare_counts.rare_tokens.itervalues():
+            self.rare_type_counts[rare_token] = self.rare_type_counts.get(rare_token, 0) + 1
+        self.context_totals = self.count_context_totals(self.rare_counts)
+        self.scoring_context_totals = None
+        self.compact_counts("counts", "rare_counts", "context_totals")
+
+        # ---------------------------------------------------------------------
+        #   Successor tables of every order, for generation; see draw().
+        # ---------------------------------------------------------------------
+        logger.debug("building successor tables...")
+        self.successors = dict((k, self.build_successor_tables(self.counts, k))
+                               for k in xrange(1, self.ngram_count + 1))
+        # ---------------------------------------------------------------------
+
+    def count_context_totals(self, counts):
+        """log2 of the total count of the k-grams that follow each context
+        of k - 1 tokens in counts, for k from 1 to ngram_count, as a
+        dictionary keyed by context, with None for the empty context of the
+        unigrams. These are the q_ML denomenators of
+        get_order_probabilities().
+
+        They differ from the (k - 1)-gram counts, and the unigram total
+        kept under None, only by the start symbols, which are counted more
+        often than they are followed and which are never scored, so only
+        these totals make every order a distribution."""
+        totals = {}
+        for (phrase, count) in counts.iteritems():
+            if phrase is None or phrase[-1] == self.start_symbol:
+                continue
+            context = phrase[:-1] if len(phrase) > 1 else None
+            totals[context] = totals.get(context, 0) + math.pow(2, count)
+        return dict((context, math.log(total, 2)) for (context, total) in totals.iteritems())
+
+    def get_scoring_context_totals(self):
+        """self.context_totals as a NumpyCountStore over the vocabulary of
+        get_scoring_counts(). Made on first use unless it already is
+        one."""
+        counts = self.get_scoring_counts()
+        if isinstance(self.context_totals, NumpyCountStore) and \
+           self.context_totals.vocabulary is counts.vocabulary:
+            return self.context_totals
+        if getattr(self, "scoring_context_totals", None) is None:
+            self.scoring_context_totals = NumpyCountStore.from_dict(self.context_totals, counts.vocabulary)
+        return self.scoring_context_totals
+
+    def get_order_probabilities(self, sentences):
+        """Maximum likelihood probability of every token of a list of
+        sentences, each a list of word tokens without start or stop
+        symbols, under every order. Returns a pair:
+
+        -   probabilities: array of shape (tokens, ngram_count), where
+            column k - 1 holds the order k probabilities. A token the
+            order k counts cannot score, as its context was never seen, has
+            probability zero there.
+        -   chunk_sentences: array of the index of each token's sentence.
+
+        Every infrequent or unseen token is replaced by its rare token,
+        in the context and in the token scored, and the probability of a
+        rare token is divided by the number of infrequent tokens it
+        stands for, so that for any context each order's probabilities
+        sum to one over the vocabulary.
+        """
+        counts = self.get_scoring_counts()
+        context_totals = self.get_scoring_context_totals()
+        vocabulary = counts.vocabulary
+        (chunks, rare_chunks, chunk_sentences) = self.encode_chunks(sentences, vocabulary)
+        probabilities = numpy.zeros((len(chunks), self.ngram_count), dtype=numpy.float64)
+        if len(chunks) == 0:
+            return (probabilities, chunk_sentences)
+
+        # ---------------------------------------------------------------------
+        #   Collapse the chunks. A token is infrequent or unseen exactly when
+        #   the rare counts have no unigram of it.
+        # ---------------------------------------------------------------------
+        is_frequent = counts.lookup_ids(chunks.reshape(-1, 1))[1].reshape(chunks.shape)
+        collapsed_chunks = numpy.where(is_frequent, chunks, rare_chunks)
+        rare_type_counts = numpy.ones(len(chunks), dtype=numpy.float64)
+        for (rare_token, rare_type_count) in self.rare_type_counts.iteritems():
+            is_rare_type = ~is_frequent[:, -1] & (rare_chunks[:, -1] == vocabulary.get_id(rare_token))
+            rare_type_counts[is_rare_type] = rare_type_count
+        # ---------------------------------------------------------------------
+
+        # ---------------------------------------------------------------------
+        #   q_ML numerators and denomenators of each order, from the last k
+        #   tokens of each chunk.
+        # ---------------------------------------------------------------------
+        for k in xrange(1, self.ngram_count + 1):
+            k_chunks = collapsed_chunks[:, self.ngram_count - k:]
+            (numerators, scored) = counts.lookup_ids(k_chunks)
+            if k == 1:
+                denomenators = context_totals[None]
+            else:
+                (denomenators, found) = context_totals.lookup_ids(k_chunks[:, :-1])
+                scored &= found
+            probabilities[scored, k - 1] = (numpy.exp2(numerators - denomenators) / rare_type_counts)[scored]
+        # ---------------------------------------------------------------------
+
+        return (probabilities, chunk_sentences)
+
+    @timed("train.estimate_lambdas")
+    def estimate_lambdas(self, probabilities):
+        """Lambdas maximizing the likelihood of the tokens whose order
+        probabilities are the rows of probabilities, as returned by
+        get_order_probabilities(), found by expectation maximization.
+
+        Each iteration weights every order's probability of every token by
+        its current lambda, normalizes each row into the posterior of the
+        token having come from each order, and takes the mean posterior of
+        each order as its new lambda. Tokens no order can score carry no
+        information about the lambdas and are left out."""
+        logger = logging.getLogger("%s.LinearInterpolationLanguageModel.estimate_lambdas" % APP_NAME)
+        probabilities = probabilities[probabilities.sum(axis=1) > 0]
+        lambdas = numpy.ones(self.ngram_count) / self.ngram_count
+        if len(probabilities) == 0:
+            return lambdas
+        for iteration in xrange(self.maximum_em_iterations):
+            weighted = probabilities * lambdas
+            mixtures = weighted.sum(axis=1)
+            new_lambdas = (weighted / mixtures[:, numpy.newaxis]).mean(axis=0)
+            change = numpy.max(numpy.abs(new_lambdas - lambdas))
+            lambdas = new_lambdas
+            if change <= self.em_tolerance:
+                break
+        logger.debug("%s iterations over %s tokens, log2 likelihood: %s" %
+                     (iteration + 1, len(probabilities), numpy.sum(numpy.log2(mixtures))))
+        return lambdas
+
+    @timed("perplexity")
+    def perplexity(self, processed_texts):
+        """Perplexity of the language model over the sentences of an
+        iterable of ProcessedText objects, scored in one batch."""
+        M = 0
+        sentences = []
+        for text in processed_texts:
+            M += sum(v for v in text.ngram_words[1].itervalues())
+            sentences.extend([word for (word, tag) in sentence]
+                             for sentence in text.tagged_sentences)
+        L = numpy.sum(self.score_sentences(sentences)) / M
+        return math.pow(2, -L)
+
+    @counted_tokens("tokens_scored")
+    def score_sentences(self, sentences):
+        """log2 probability of each of a list of sentences, each a list of
+        word tokens without start or stop symbols. Returns a NumPy array."""
+        (probabilities, chunk_sentences) = self.get_order_probabilities(sentences)
+        with numpy.errstate(divide="ignore"):
+            log_probabilities = numpy.log2(numpy.dot(probabilities, self.lambdas))
+        return numpy.bincount(chunk_sentences, weights=log_probabilities, minlength=len(sentences))
+
+    def draw(self, context):
+        """Draw the token following context: pick an order with probability
+        proportional to its lambda among the orders that have seen their
+        part of context, then draw from that order's successors."""
+        orders = []
+        weights = []
+        for k in xrange(1, self.ngram_count + 1):
+            k_context = context[len(context) - (k - 1):]
+            if k_context in self.successors[k]:
+                orders.append(k)
+                weights.append(self.lambdas[k - 1])
+        threshold = random.random() * sum(weights)
+        for (k, weight) in zip(orders, weights):
+            threshold -= weight
+            if threshold < 0:
+                break
+        return self.successors[k][context[len(context) - (k - 1):]].choice()
+
+    @timed("generate")
+    def generate(self, constraints=None):
+        logger = logging.getLogger("%s.LinearInterpolationLanguageModel.generate" % APP_NAME)
+        logger.debug("entry.")
+        if constraints is not None:
+            return self.generate_constrained(constraints)
+
+        sentence = [self.start_symbol] * (self.ngram_count - 1)
+        while len(sentence) == 0 or sentence[-1] != self.stop_symbol:
+            context = tuple(sentence[len(sentence) - (self.ngram_count - 1):])
+            sentence.append(self.draw(context))
+        return self.render_sentence(sentence)
+
+    def generate_constrained(self, constraints):
+        """Sample a sentence meeting constraints, a GenerationConstraints,
+        or return None if that fails constraints.maximum_attempts times;
+        see InterpolatedKneserNeyLanguageModel.generate_constrained()."""
+        for attempt in xrange(constraints.maximum_attempts):
+            sentence = constraints.start_sentence()
+            context = tuple([self.start_symbol] * (self.ngram_count - 1))
+            while True:
+                for i in xrange(CONSTRAINED_DRAW_ATTEMPTS):
+                    word = self.draw(context)
+                    if word == self.stop_symbol:
+                        if sentence.allows_stop():
+                            break
+                    elif sentence.allows_word(word):
+                        break
+                else:
+                    word = None
+                if metrics.enabled:
+                    metrics.observe("%s.candidates_per_token" % self.__class__.__name__, i + 1)
+                if word is None or word == self.stop_symbol:
+                    break
+                sentence.append(word)
+                context = self.next_context(context, word)
+            if word is not None:
+                rendered_sentence = self.render_sentence(sentence.words)
+                if constraints.allows_sentence(rendered_sentence):
+                    return rendered_sentence
+        return None
+
+class BigramLinearInterpolationLanguageModel(LinearInterpolationLanguageModel):
+    ngram_count = 2
+
+class TrigramLinearInterpolationLanguageModel(LinearInterpolationLanguageModel):
+    ngram_count = 3
+
+
+class InterpolatedKneserNeyLanguageModel(LanguageModel):
+    """Interpolated Kneser-Ney language model over words.
+
+    The highest order uses absolutely discounted n-gram counts. Each lower
+    order uses continuation counts, i.e. the number of distinct tokens
+    seen before an n-gram rather than how often it was seen, and the mass
+    removed by discounting is given to the next order down. The lowest
+    order is interpolated with a uniform distribution over the vocabulary
+    plus one unknown token, so every n-gram, seen or not, has a non-zero
+    probability.
+
+    Everything needed to score an n-gram is computed once in train():
+    -   self.discounts[k]: the discount D for order k, n1 / (n1 + 2 * n2).
+    -   self.alphas[k]: for each k-gram, max(count - D, 0) / count(context).
+    -   self.gammas[k]: for each (k-1)-token context, the backoff weight
+        D * (number of distinct successors) / count(context).
+
+    so scoring a chunk is two lookups per order, with no failure path.
+    """
+
+    default_discount = 0.75
+
+    def _check_invariants(self):
+        assert(hasattr(self, "ngram_count"))
+        super(InterpolatedKneserNeyLanguageModel, self)._check_invariants()
+
+    @records_cache_statistics
+    @timed("train")
+    def train(self):
+        self._check_invariants()
+        logger = logging.getLogger("%s.InterpolatedKneserNeyLanguageModel.train" % APP_NAME)
+        logger.debug("entry. self.ngram_count: %s" % self.ngram_count)
+
+        # ---------------------------------------------------------------------
+        #   Discounts are estimated from the training counts, so there are
+        #   no parameters to cross validate. Split up input into training
+        #   and testing.
+        # ---------------------------------------------------------------------
+        size = len(self.processed_texts)
+        testing_size = int(size * self.settings.generator_non_kfold_testing_proportion)
+        training_size = (size - testing_size)
+        logger.debug("training_size: %s, testing_size: %s" % (training_size, testing_size))
+
+        training_set = self.processed_texts[:training_size]
+        testing_set = self.processed_texts[training_size:]
+        self.start_symbol = training_set[0].START_SYMBOL
+        self.stop_symbol = training_set[0].STOP_SYMBOL
+        # ---------------------------------------------------------------------
+
+        logger.debug("calculating counts...")
+        self.train_from_counts(self.count_training_set(training_set, self.ngram_attribute))
+
+        logger.debug("calculating perplexity...")
+        self.testing_perplexity = self.perplexity(testing_set)
+        logger.debug("self.testing_perplexity: %s" % self.testing_perplexity)
+
+    def train_from_counts(self, tables):
+        logger = logging.getLogger("%s.InterpolatedKneserNeyLanguageModel.train_from_counts" % APP_NAME)
+        counts = tables["counts"]
+        self.vocabulary = sorted(phrase[0] for phrase in counts
+                                 if phrase is not None and len(phrase) == 1
+                                 and phrase[0] != self.start_symbol)
+
+        # ---------------------------------------------------------------------
+        #   The highest order keeps its counts. Each lower order k is
+        #   counted by the number of distinct tokens seen before it, taken
+        #   from the (k+1)-grams. Chunks that are nothing but start symbols
+        #   are padding and are left out.
+        # ---------------------------------------------------------------------
+        logger.debug("calculating continuation counts...")
+        order_counts = dict((k, {}) for k in xrange(1, self.ngram_count + 1))
+        for (phrase, count) in counts.iteritems():
+            if phrase is None or all(elem == self.start_symbol for elem in phrase):
+                continue
+            if len(phrase) == self.ngram_count:
+                order_counts[self.ngram_count][phrase] = count
+            if 2 <= len(phrase) <= self.ngram_count:
+                continuation = order_counts[len(phrase) - 1]
+                continuation[phrase[1:]] = continuation.get(phrase[1:], 0) + 1
+        # ---------------------------------------------------------------------
+
+        # ---------------------------------------------------------------------
+        #   Discounts, discounted probabilities and backoff weights.
+        # ---------------------------------------------------------------------
+        logger.debug("calculating discounts and backoff weights...")
+        self.discounts = {}
+        self.alphas = {}
+        self.gammas = {}
+        for (k, k_counts) in order_counts.iteritems():
+            n1 = sum(1 for count in k_counts.itervalues() if count == 1)
+            n2 = sum(1 for count in k_counts.itervalues() if count == 2)
+            if n1 + 2 * n2 != 0 and 0 < n1 / (n1 + 2 * n2) < 1:
+                discount = n1 / (n1 + 2 * n2)
+            else:
+                discount = self.default_discount
+            self.discounts[k] = discount
+
+            context_totals = {}
+            context_types = {}
+            for (phrase, count) in k_counts.iteritems():
+                context = phrase[:-1]
+                context_totals[context] = context_totals.get(context, 0) + count
+                context_types[context] = context_types.get(context, 0) + 1
+            self.alphas[k] = dict((phrase, max(count - discount, 0) / context_totals[phrase[:-1]])
+                                  for (phrase, count) in k_counts.iteritems())
+            self.gammas[k] = dict((context, discount * context_types[context] / total)
+                                  for (context, total) in context_totals.iteritems())
+            logger.debug("order: %s, discount: %s, n-grams: %s" % (k, discount, len(k_counts)))
+        self.uniform_probability = 1 / (len(self.vocabulary) + 1)
+        if () not in self.gammas[1]:
+            self.gammas[1][()] = 1.0
+        # ---------------------------------------------------------------------
+
+        # ---------------------------------------------------------------------
+        #   Successor tables over the discounted probabilities of each
+        #   order, for generation.
+        # ---------------------------------------------------------------------
+        logger.debug("building successor tables...")
+        self.successors = {}
+        for (k, alphas) in self.alphas.iteritems():
+            successors = {}
+            for (phrase, alpha) in alphas.iteritems():
+                if alpha > 0:
+                    successors.setdefault(phrase[:-1], []).append((phrase[-1], alpha))
+            self.successors[k] = dict((context, CumulativeDistribution(sorted(choices)))
+                                      for (context, choices) in successors.iteritems())
+        # ---------------------------------------------------------------------
+
+    def probability(self, chunk):
+        """Interpolated Kneser-Ney probability of the last token of chunk
+        given the tokens before it. Orders whose context was never seen
+        pass the lower order probability through unchanged."""
+        probability = self.uniform_probability
+        for k in xrange(1, self.ngram_count + 1):
+            phrase = chunk[len(chunk) - k:]
+            gamma = self.gammas[k].get(phrase[:-1])
+            if gamma is None:
+                continue
+            probability = self.alphas[k].get(phrase, 0) + gamma * probability
+        return probability
+
+    def log_probability(self, chunk):
+        """log2 of probability()."""
+        return math.log(self.probability(chunk), 2)
+
+    @counted_tokens("tokens_scored")
+    def score_sentences(self, sentences):
+        """log2 probability of each of a list of sentences, each a list of
+        word tokens without start or stop symbols. Returns a NumPy array."""
+        padding = [self.start_symbol] * (self.ngram_count - 1)
+        scores = numpy.zeros(len(sentences), dtype=numpy.float64)
+        for (index, sentence) in enumerate(sentences):
+            padded_words = tuple(padding + list(sentence) + [self.stop_symbol])
+            scores[index] = sum(self.log_probability(padded_words[i:i+self.ngram_count])
+                                for i in xrange(len(padded_words) - (self.ngram_count - 1)))
+        return scores
+
+    @timed("perplexity")
+    def perplexity(self, processed_texts):
+        """Perplexity of the language model over the sentences of an
+        iterable of ProcessedText objects."""
+        M = 0
+        sentences = []
+        for text in processed_texts:
+            M += sum(v for v in text.ngram_words[1].itervalues())
+            sentences.extend([word for (word, tag) in sentence]
+                             for sentence in text.tagged_sentences)
+        L = numpy.sum(self.score_sentences(sentences)) / M
+        return math.pow(2, -L)
+
+    def draw(self, context):
+        """Draw the token following context. Starting at the highest order,
+        take a discounted successor with probability 1 - gamma, otherwise
+        back off to the next order down, and finally to the uniform
+        distribution over the vocabulary."""
+        for k in xrange(self.ngram_count, 0, -1):
+            k_context = context[len(context) - (k - 1):]
+            gamma = self.gammas[k].get(k_context)
+            if gamma is None:
+                continue
+            if random.random() >= gamma:
+                return self.successors[k][k_context].choice()
+        return random.choice(self.vocabulary)
+
+    @timed("generate")
+    def generate(self, constraints=None):
+        logger = logging.getLogger("%s.InterpolatedKneserNeyLanguageModel.generate" % APP_NAME)
+        logger.debug("entry.")
+        if constraints is not None:
+            return self.generate_constrained(constraints)
+
+        sentence = [self.start_symbol] * (self.ngram_count - 1)
+        while len(sentence) == 0 or sentence[-1] != self.stop_symbol:
+            context = tuple(sentence[len(sentence) - (self.ngram_count - 1):])
+            sentence.append(self.draw(context))
+        return self.render_sentence(sentence)
+
+    def generate_constrained(self, constraints):
+        """Sample a sentence meeting constraints, a GenerationConstraints,
+        or return None if that fails constraints.maximum_attempts times.
+        Words are drawn with draw() until one keeps the sentence within the
+        constraints; if none does after CONSTRAINED_DRAW_ATTEMPTS draws the
+        sentence is started again."""
+        for attempt in xrange(constraints.maximum_attempts):
+            sentence = constraints.start_sentence()
+            context = tuple([self.start_symbol] * (self.ngram_count - 1))
+            while True:
+                for i in xrange(CONSTRAINED_DRAW_ATTEMPTS):
+                    word = self.draw(context)
+                    if word == self.stop_symbol:
+                        if sentence.allows_stop():
+                            break
+                    elif sentence.allows_word(word):
+                        break
+                else:
+                    word = None
+                if metrics.enabled:
+                    metrics.observe("%s.candidates_per_token" % self.__class__.__name__, i + 1)
+                if word is None or word == self.stop_symbol:
+                    break
+                sentence.append(word)
+                context = self.next_context(context, word)
+            if word is not None:
+                rendered_sentence = self.render_sentence(sentence.words)
+                if constraints.allows_sentence(rendered_sentence):
+                    return rendered_sentence
+        return None
+
+class BigramKneserNeyLanguageModel(InterpolatedKneserNeyLanguageModel):
+    ngram_count = 2
+
+class TrigramKneserNeyLanguageModel(InterpolatedKneserNeyLanguageModel):
+    ngram_count = 3
@@ -0,0 +1,262 @@
+from __future__ import division
+
+import os
+import sys
+import json
+
+import numpy
+
+import LanguageModel
+from CountStore import Vocabulary, NumpyCountStore
+from BatchSampler import BatchSuccessorTable
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "MappedModel"
+MAPPED_MODEL_FORMAT_VERSION = 1
+MANIFEST_FILENAME = "manifest.json"
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   A mapped model is a directory holding a manifest.json plus one .npy file
+#   per array, all of which are opened with numpy.load(mmap_mode="r") so
+#   that every process reading the model shares the same physical pages:
+#
+#   -   strings, string_offsets, string_order: the string table. Token id i
+#       is the UTF-8 bytes strings[string_offsets[i]:string_offsets[i+1]],
+#       and string_order lists the token ids sorted by token, for lookups.
+#       Id 0 is the unknown token.
+#   -   <name>_keys_<order>, <name>_values_<order>: a NumpyCountStore for
+#       each count table (counts, rare_counts and, for the HMM, emissions).
+#   -   <name>_keys, <name>_tokens, <name>_next_rows, <name>_context_keys,
+#       <name>_context_rows: a BatchSuccessorTable for each sampling table
+#       (batch_successors and, for the HMM, batch_emissions).
+# -----------------------------------------------------------------------------
+
+def is_mappable(language_model):
+    """Whether save_mapped_model() can write language_model."""
+    return isinstance(language_model, (LanguageModel.HMMTrigramMaximumLikelihoodModel,
+                                       LanguageModel.NGramMaximumLikelihoodLanguageModel))
+
+def get_model_tables(language_model):
+    """Names of the count tables and sampling tables a model needs, the
+    latter as (attribute, successor tables, next context function)."""
+    if isinstance(language_model, LanguageModel.HMMTrigramMaximumLikelihoodModel):
+        return (["counts", "rare_counts", "emissions"],
+                [("batch_successors", language_model.successors, language_model.next_context),
+                 ("batch_emissions", language_model.emission_tables, None)])
+    if isinstance(language_model, LanguageModel.NGramMaximumLikelihoodLanguageModel):
+        return (["counts", "rare_counts"],
+                [("batch_successors", language_model.successors, language_model.next_context)])
+    raise ValueError("no mapped model format for %s" % language_model.__class__.__name__)
+
+def as_unicode(token):
+    if isinstance(token, unicode):
+        return token
+    return token.decode("utf-8")
+
+def save_mapped_model(language_model, directory):
+    """Write a trained language model to directory in the mapped model
+    format."""
+    logger = logging.getLogger("%s.save_mapped_model" % APP_NAME)
+    logger.debug("entry. directory: '%s'" % directory)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    (count_names, sampling_tables) = get_model_tables(language_model)
+
+    def save_array(name, array):
+        numpy.save(os.path.join(directory, "%s.npy" % name), array)
+
+    # -------------------------------------------------------------------------
+    #   String table.
+    # -------------------------------------------------------------------------
+    vocabulary = Vocabulary.from_counts(*[getattr(language_model, name) for name in count_names])
+    tokens = [as_unicode(token) for token in vocabulary.tokens[1:]]
+    encoded_tokens = [token.encode("utf-8") for token in tokens]
+    string_offsets = numpy.zeros(len(vocabulary) + 1, dtype=numpy.int64)
+    string_offsets[2:] = numpy.cumsum([len(token) for token in encoded_tokens])
+    save_array("strings", numpy.frombuffer("".join(encoded_tokens), dtype=numpy.uint8))
+    save_array("string_offsets", string_offsets)
+    save_array("string_order", numpy.array(sorted(xrange(1, len(vocabulary)),
+                                                  key=lambda token_id: tokens[token_id - 1]),
+                                           dtype=numpy.int64))
+    # -------------------------------------------------------------------------
+
+    # -------------------------------------------------------------------------
+    #   Count tables.
+    # -------------------------------------------------------------------------
+    manifest_count_tables = {}
+    for name in count_names:
+        store = NumpyCountStore.from_dict(getattr(language_model, name), vocabulary)
+        for order in store.keys:
+            save_array("%s_keys_%s" % (name, order), store.keys[order])
+            save_array("%s_values_%s" % (name, order), store.values[order])
+        manifest_count_tables[name] = {"orders": sorted(store.keys), "total": store.total}
+    # -------------------------------------------------------------------------
+
+    # -------------------------------------------------------------------------
+    #   Sampling tables. Contexts are looked up by their packed token ids.
+    # -------------------------------------------------------------------------
+    packer = NumpyCountStore(vocabulary, {}, {}, None)
+    manifest_sampling_tables = {}
+    for (name, successors, next_context) in sampling_tables:
+        table = BatchSuccessorTable.from_successor_tables(successors, next_context, vocabulary)
+        contexts = [context if isinstance(context, tuple) else (context, )
+                    for context in table.contexts]
+        context_keys = packer.pack(vocabulary.encode(contexts))
+        context_rows = numpy.argsort(context_keys, kind="mergesort")
+        save_array("%s_keys" % name, table.keys)
+        save_array("%s_tokens" % name, table.tokens)
+        save_array("%s_next_rows" % name, table.next_rows)
+        save_array("%s_context_keys" % name, context_keys[context_rows])
+        save_array("%s_context_rows" % name, context_rows)
+        manifest_sampling_tables[name] = {"tuple_contexts": isinstance(table.contexts[0], tuple)}
+    # -------------------------------------------------------------------------
+
+    manifest = {"format_version": MAPPED_MODEL_FORMAT_VERSION,
+                "class_name": language_model.__class__.__name__,
+                "start_symbol": language_model.start_symbol,
+                "stop_symbol": language_model.stop_symbol,
+                "testing_perplexity": getattr(language_model, "testing_perplexity", None),
+                "count_tables": manifest_count_tables,
+                "sampling_tables": manifest_sampling_tables}
+    with open(os.path.join(directory, MANIFEST_FILENAME), "w") as f_out:
+        json.dump(manifest, f_out, indent=2)
+
+def load_mapped_model(directory):
+    """Open a model written by save_mapped_model(). Every array is memory
+    mapped read-only, so loading is cheap and the pages are shared with
+    any other process that has the same model open.
+
+    The returned object is an instance of the original model class
+    without its training data. generate_many() and the count lookups work
+    as usual, as do score_sentences() and perplexity() for the n-gram
+    models; generate(), which uses the Python successor tables, does not.
+    """
+    logger = logging.getLogger("%s.load_mapped_model" % APP_NAME)
+    logger.debug("entry. directory: '%s'" % directory)
+    with open(os.path.join(directory, MANIFEST_FILENAME)) as f_in:
+        manifest = json.load(f_in)
+    assert(manifest["format_version"] == MAPPED_MODEL_FORMAT_VERSION)
+
+    def load_array(name):
+        return numpy.load(os.path.join(directory, "%s.npy" % name), mmap_mode="r")
+
+    vocabulary = MappedVocabulary(load_array("strings"),
+                                  load_array("string_offsets"),
+                                  load_array("string_order"))
+
+    language_model_cls = getattr(LanguageModel, manifest["class_name"])
+    language_model = language_model_cls.__new__(language_model_cls)
+    language_model.processed_texts = None
+    language_model.settings = None
+    language_model.start_symbol = manifest["start_symbol"]
+    language_model.stop_symbol = manifest["stop_symbol"]
+    language_model.testing_perplexity = manifest["testing_perplexity"]
+    for (name, table) in manifest["count_tables"].iteritems():
+        keys = dict((order, load_array("%s_keys_%s" % (name, order))) for order in table["orders"])
+        values = dict((order, load_array("%s_values_%s" % (name, order))) for order in table["orders"])
+        setattr(language_model, name, NumpyCountStore(vocabulary, keys, values, table["total"]))
+    for (name, table) in manifest["sampling_tables"].iteritems():
+        setattr(language_model, name, MappedBatchSuccessorTable(vocabulary,
+                                                                load_array("%s_context_keys" % name),
+                                                                load_array("%s_context_rows" % name),
+                                                                table["tuple_contexts"],
+                                                                load_array("%s_keys" % name),
+                                                                load_array("%s_tokens" % name),
+                                                                load_array("%s_next_rows" % name)))
+    return language_model
+
+class MappedVocabulary(object):
+    """Read-only Vocabulary over a memory-mapped string table. Tokens are
+    decoded from the table when asked for, and ids are found by binary
+    search over the ids sorted by token, so no per-process dictionary of
+    the vocabulary is built."""
+
+    UNKNOWN_ID = Vocabulary.UNKNOWN_ID
+
+    def __init__(self, strings, string_offsets, string_order):
+        self.strings = strings
+        self.string_offsets = string_offsets
+        self.string_order = string_order
+
+    @property
+    def tokens(self):
+        return self
+
+    def __len__(self):
+        return len(self.string_offsets) - 1
+
+    def __getitem__(self, token_id):
+        return self.get_token(token_id)
+
+    def __contains__(self, token):
+        return self.get_id(token) != self.UNKNOWN_ID
+
+    def get_token(self, token_id):
+        if token_id == self.UNKNOWN_ID:
+            return None
+        start = self.string_offsets[token_id]
+        end = self.string_offsets[token_id + 1]
+        return self.strings[start:end].tostring().decode("utf-8")
+
+    def get_id(self, token):
+        token = as_unicode(token)
+        low = 0
+        high = len(self.string_order)
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_token(self.string_order[middle]) < token:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.string_order) and self.get_token(self.string_order[low]) == token:
+            return int(self.string_order[low])
+        return self.UNKNOWN_ID
+
+    def encode(self, phrases):
+        rows = [[self.get_id(token) for token in phrase] for phrase in phrases]
+        return numpy.array(rows, dtype=numpy.int64).reshape(len(rows), -1)
+
+    def decode(self, token_ids):
+        decoded = numpy.empty(len(token_ids), dtype=object)
+        for (i, token_id) in enumerate(token_ids):
+            decoded[i] = self.get_token(token_id)
+        return decoded
+
+class MappedBatchSuccessorTable(BatchSuccessorTable):
+    """BatchSuccessorTable over memory-mapped arrays. Contexts are found by
+    searching their packed token ids rather than through a dictionary."""
+
+    def __init__(self, vocabulary, context_keys, context_rows, tuple_contexts, keys, tokens, next_rows):
+        self.vocabulary = vocabulary
+        self.context_keys = context_keys
+        self.context_rows = context_rows
+        self.tuple_contexts = tuple_contexts
+        self.keys = keys
+        self.tokens = tokens
+        self.next_rows = next_rows
+        self.packer = NumpyCountStore(vocabulary, {}, {}, None)
+
+    def get_row(self, context):
+        if not self.tuple_contexts:
+            context = (context, )
+        packed = self.packer.pack(self.vocabulary.encode([context]))
+        position = numpy.searchsorted(self.context_keys, packed)[0]
+        if position == len(self.context_keys) or self.context_keys[position] != packed[0]:
+            raise KeyError(context)
+        return int(self.context_rows[position])
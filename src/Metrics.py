@@ -0,0 +1,260 @@
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import bisect
+import atexit
+import weakref
+import itertools
+import threading
+import functools
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "Metrics"
+
+# Upper bounds of the histogram buckets for durations, in seconds, and for
+# counts. Anything above the last bound goes in a final overflow bucket.
+SECONDS_BOUNDS = [1e-6 * 2 ** i for i in xrange(25)]
+COUNT_BOUNDS = [2 ** i for i in xrange(21)]
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+class Histogram(object):
+    """Count, total, minimum, maximum and bucketed counts of observed
+    values. bounds are the ascending upper bounds of the buckets."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+
+    def observe(self, value, count=1):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += count
+        self.count += count
+        self.total += value * count
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def to_dict(self):
+        upper_bounds = self.bounds + [None]
+        return {"count": self.count,
+                "total": self.total,
+                "mean": self.total / self.count if self.count else None,
+                "minimum": self.minimum,
+                "maximum": self.maximum,
+                "buckets": [[upper_bound, count] for (upper_bound, count)
+                            in zip(upper_bounds, self.buckets) if count != 0]}
+
+class MetricsRegistry(object):
+    """Process-wide counters and histograms, off until enable() is called.
+
+    While disabled every recording call returns after checking
+    self.enabled, so instrumented code costs next to nothing. Updates take
+    a lock, as the server generates on many threads.
+
+    Language models passed to track() are held weakly. The statistics of
+    their memoize caches are recorded by record_cache_statistics(), which
+    the models call when training finishes, and again for the models still
+    alive when the metrics are exported, so models freed before then, like
+    the fold models of cross-validation, still count. Forked worker
+    processes record into their own copy of the registry, which is not
+    exported.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.filepath = None
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        # Tracked models, mapped to the key of their latest memoize cache
+        # statistics in self.cache_statistics, as (class name, statistics).
+        self.tracked_models = weakref.WeakKeyDictionary()
+        self.model_keys = itertools.count()
+        self.cache_statistics = {}
+
+    def enable(self, filepath=None):
+        """Start recording and, if filepath is given, write the metrics to
+        it as JSON when the process exits. Enabling again only changes the
+        filepath."""
+        if filepath is not None and self.filepath is None:
+            atexit.register(self.write_json_at_exit)
+        self.filepath = filepath or self.filepath
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.cache_statistics = {}
+
+    def increment(self, name, count=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def observe(self, name, value, count=1, bounds=COUNT_BOUNDS):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+            histogram.observe(value, count)
+
+    def observe_seconds(self, name, seconds, count=1):
+        self.observe(name, seconds, count, SECONDS_BOUNDS)
+
+    def track(self, language_model):
+        if not self.enabled:
+            return
+        with self.lock:
+            if language_model not in self.tracked_models:
+                self.tracked_models[language_model] = next(self.model_keys)
+
+    def record_cache_statistics(self, language_model):
+        if not self.enabled:
+            return
+        self.track(language_model)
+        statistics = language_model.get_cache_statistics()
+        with self.lock:
+            self.cache_statistics[self.tracked_models[language_model]] = \
+                (language_model.__class__.__name__, statistics)
+
+    def get_cache_statistics(self):
+        """Memoize cache statistics summed over the tracked models of each
+        class, keyed by class name and then cache name, with hit rates."""
+        for language_model in self.tracked_models.keys():
+            self.record_cache_statistics(language_model)
+        with self.lock:
+            cache_statistics = self.cache_statistics.values()
+        caches = {}
+        for (class_name, model_statistics) in cache_statistics:
+            class_caches = caches.setdefault(class_name, {})
+            for (name, statistics) in model_statistics.iteritems():
+                totals = class_caches.setdefault(name, {"hits": 0, "misses": 0, "evictions": 0})
+                for key in totals:
+                    totals[key] += statistics[key]
+        for class_caches in caches.itervalues():
+            for totals in class_caches.itervalues():
+                lookups = totals["hits"] + totals["misses"]
+                totals["hit_rate"] = totals["hits"] / lookups if lookups else None
+        return caches
+
+    def to_dict(self):
+        caches = self.get_cache_statistics()
+        with self.lock:
+            return {"counters": dict(self.counters),
+                    "histograms": dict((name, histogram.to_dict())
+                                       for (name, histogram) in self.histograms.iteritems()),
+                    "memoize_caches": caches}
+
+    def write_json(self, filepath):
+        directory = os.path.dirname(filepath)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(filepath, "w") as f_out:
+            json.dump(self.to_dict(), f_out, indent=2, sort_keys=True)
+
+    def write_json_at_exit(self):
+        logger = logging.getLogger("%s.MetricsRegistry.write_json_at_exit" % APP_NAME)
+        if self.filepath is None:
+            return
+        logger.info("writing metrics: '%s'" % self.filepath)
+        self.write_json(self.filepath)
+
+metrics = MetricsRegistry()
+
+def enable_from_settings(settings):
+    if settings.generator_collect_metrics:
+        metrics.enable(settings.generator_metrics_filepath)
+
+# -----------------------------------------------------------------------------
+#   Method decorators. Metric names are prefixed with the class name of the
+#   instance the method is called on, so that subclasses sharing a method
+#   are recorded apart.
+# -----------------------------------------------------------------------------
+def timed(name):
+    """Record the duration of every call of a method in the seconds
+    histogram "<class name>.<name>"."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrap(self, *args, **kwargs):
+            if not metrics.enabled:
+                return method(self, *args, **kwargs)
+            start_time = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                metrics.observe_seconds("%s.%s" % (self.__class__.__name__, name), time.time() - start_time)
+        return wrap
+    return decorator
+
+def timed_per_item(name):
+    """Record the duration of every call of a method that returns a list,
+    divided by the length of the list, in the seconds histogram
+    "<class name>.<name>", once per item."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrap(self, *args, **kwargs):
+            if not metrics.enabled:
+                return method(self, *args, **kwargs)
+            start_time = time.time()
+            items = method(self, *args, **kwargs)
+            if len(items) != 0:
+                metrics.observe_seconds("%s.%s" % (self.__class__.__name__, name),
+                                        (time.time() - start_time) / len(items),
+                                        len(items))
+            return items
+        return wrap
+    return decorator
+
+def counted_tokens(name):
+    """Count the tokens scored by a method taking a list of sentences, each
+    a list of tokens, in the counter "<class name>.<name>": every token of
+    every sentence and the stop symbol ending it."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrap(self, sentences, *args, **kwargs):
+            if metrics.enabled:
+                metrics.increment("%s.%s" % (self.__class__.__name__, name),
+                                  sum(len(sentence) + 1 for sentence in sentences))
+            return method(self, sentences, *args, **kwargs)
+        return wrap
+    return decorator
+
+def records_cache_statistics(method):
+    """Record the memoize cache statistics of the instance once a method
+    returns; see MetricsRegistry.record_cache_statistics()."""
+    @functools.wraps(method)
+    def wrap(self, *args, **kwargs):
+        return_value = method(self, *args, **kwargs)
+        metrics.record_cache_statistics(self)
+        return return_value
+    return wrap
+# -----------------------------------------------------------------------------
@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import hashlib
+import cPickle as pickle
+
+from Metrics import metrics, enable_from_settings
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "ModelSnapshot"
+
+# Bump this whenever a change to the language models makes previously saved
+# snapshots invalid.
+SNAPSHOT_FORMAT_VERSION = 3
+
+# Generator settings that do not change what training produces, and hence
+# are left out of the snapshot key.
+SETTINGS_NOT_AFFECTING_TRAINING = set(["training_workers",
+                                       "kfold_workers",
+                                       "use_snapshots",
+                                       "snapshot_directory",
+                                       "use_generation_constraints",
+                                       "maximum_sentence_tokens",
+                                       "generation_workers",
+                                       "use_mapped_models",
+                                       "mapped_model_directory",
+                                       "deduplicate_sentences",
+                                       "deduplication_expected_sentences",
+                                       "deduplication_error_rate",
+                                       "output_gzip",
+                                       "output_rotate_bytes",
+                                       "output_rotate_sentences",
+                                       "output_backup_count",
+                                       "collect_metrics",
+                                       "metrics_filepath"])
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+def get_corpus_fingerprint(processed_texts):
+    """SHA-1 hex digest over the id, text and tagged sentences of each
+    ProcessedText, in order. Order matters because models split their input
+    into training and testing sets by position."""
+    digest = hashlib.sha1()
+    for text in processed_texts:
+        digest.update(json.dumps([text.id, text.text, text.tagged_sentences]))
+    return digest.hexdigest()
+
+def get_snapshot_key(language_model_cls, corpus_fingerprint, settings):
+    """SHA-1 hex digest identifying a trained model: the snapshot format,
+    the model class and its class-level parameters, the corpus and the
+    generator settings that affect training."""
+    generator_settings = dict((k, v) for (k, v) in settings.yaml_object['generator'].iteritems()
+                              if k not in SETTINGS_NOT_AFFECTING_TRAINING)
+    parameters = [SNAPSHOT_FORMAT_VERSION,
+                  language_model_cls.__module__,
+                  language_model_cls.__name__,
+                  getattr(language_model_cls, "ngram_count", None),
+                  getattr(language_model_cls, "infrequent_count_threshold", None),
+                  repr(getattr(language_model_cls, "infrequent_word_tokens", None)),
+                  corpus_fingerprint,
+                  generator_settings]
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True)).hexdigest()
+
+def get_snapshot_filepath(language_model_cls, corpus_fingerprint, settings):
+    key = get_snapshot_key(language_model_cls, corpus_fingerprint, settings)
+    return os.path.join(settings.generator_snapshot_directory,
+                        "%s-%s.pickle" % (language_model_cls.__name__, key))
+
+def save_snapshot(language_model, filepath):
+    """Pickle a trained language model to filepath. The pickle is written
+    to a temporary file first and then renamed, so a partially written
+    snapshot is never picked up."""
+    logger = logging.getLogger("%s.save_snapshot" % APP_NAME)
+    logger.debug("entry. filepath: '%s'" % filepath)
+    directory = os.path.dirname(filepath)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary_filepath = "%s.tmp.%s" % (filepath, os.getpid())
+    with open(temporary_filepath, "wb") as f_out:
+        pickle.dump(language_model, f_out, pickle.HIGHEST_PROTOCOL)
+    os.rename(temporary_filepath, filepath)
+
+def load_snapshot(filepath, processed_texts, settings):
+    """Load a language model saved by save_snapshot(), reattaching the
+    processed texts and settings, which are not saved with it."""
+    logger = logging.getLogger("%s.load_snapshot" % APP_NAME)
+    logger.debug("entry. filepath: '%s'" % filepath)
+    with open(filepath, "rb") as f_in:
+        language_model = pickle.load(f_in)
+    language_model.processed_texts = processed_texts
+    language_model.settings = settings
+    enable_from_settings(settings)
+    metrics.track(language_model)
+    return language_model
@@ -155,6 +155,25 @@ class ProcessedText(object):
 
         return pt
 
+    @staticmethod
+    def initialize_from_tagged_sentences(id, tagged_sentences):
+        """A ProcessedText of sentences already split into words and
+        tagged, each a list of (word, tag) tuples, treated as interesting
+        English text. Lets corpora be built without running NLTK over raw
+        text, e.g. the synthetic corpora of benchmark.py."""
+        pt = ProcessedText(id, " ".join(word for tagged_sentence in tagged_sentences
+                                        for (word, tag) in tagged_sentence),
+                           initialize=False)
+        pt.is_text_english = True
+        pt.is_interesting = True
+        pt.ngram_words = dict([(i, {}) for i in xrange(1, pt.maximum_ngram_size + 1)])
+        pt.ngram_tags = dict([(i, {}) for i in xrange(1, pt.maximum_ngram_size + 1)])
+        pt.tags_words_counts = {}
+        pt.tagged_sentences = []
+        for tagged_sentence in tagged_sentences:
+            pt.add_tagged_sentence(tagged_sentence)
+        return pt
+
     def get_dict_representation(self):
         return_value = {}
         return_value['id'] = self.id
@@ -246,8 +265,6 @@ class ProcessedText(object):
         self.tags_words_counts = {}
         self.tagged_sentences = []
         for sentence_tree in self.processed_text:
-            words = []
-            tags = []
             tagged_sentence = []
             for element in sentence_tree:
                 if type(element) == nltk.tree.Tree:
@@ -268,45 +285,11 @@ class ProcessedText(object):
                     contents = [elem[0] for elem in element.leaves()]
                     named_entity_content = [(contents[0], named_entity_type_start)] + \
                                            [(elem, named_entity_type_continue) for elem in contents[1:]]
-
-                    for (word, tag) in named_entity_content:
-                        if tag not in self.tags_words_counts:
-                            self.tags_words_counts[tag] = {}
-                        self.tags_words_counts[tag][word] = self.tags_words_counts[tag].get(word, 0) + 1
-
-                    tags.extend([tag for (word, tag) in named_entity_content])
-                    words.extend([word for (word, tag) in named_entity_content])
                     tagged_sentence.extend(named_entity_content)
                 else:
                     # This is a (word, tag) pair.
-                    word = element[0]
-                    words.append(word)
-                    tag = element[1]
-                    tags.append(tag)
-                    tagged_sentence.append((word, tag))
-                    if tag not in self.tags_words_counts:
-                        self.tags_words_counts[tag] = {}
-                    self.tags_words_counts[tag][word] = self.tags_words_counts[tag].get(word, 0) + 1
-
-            self.tagged_sentences.append(tagged_sentence)
-
-            # -----------------------------------------------------------------
-            #   Update n-gram counts for both words and tags. Note that
-            #   named entities have been added as "NE-*" tags.
-            # -----------------------------------------------------------------
-            for i in xrange(1, self.maximum_ngram_size + 1):
-                number_of_start_symbols = max(i-1, 1)
-                padded_words = [self.START_SYMBOL] * number_of_start_symbols + words + [self.STOP_SYMBOL]
-                padded_word_ngrams = nltk.ngrams(padded_words, i)
-                for ngram in padded_word_ngrams:
-                    self.ngram_words[i][ngram] = self.ngram_words[i].get(ngram, 0) + 1
-
-                padded_tags = [self.START_SYMBOL] * number_of_start_symbols + tags + [self.STOP_SYMBOL]
-                padded_tag_ngrams = nltk.ngrams(padded_tags, i)
-                for ngram in padded_tag_ngrams:
-                    self.ngram_tags[i][ngram] = self.ngram_tags[i].get(ngram, 0) + 1
-            # -----------------------------------------------------------------
-
+                    tagged_sentence.append((element[0], element[1]))
+            self.add_tagged_sentence(tagged_sentence)
         # ---------------------------------------------------------------------
 
         # ---------------------------------------------------------------------
@@ -321,3 +304,32 @@ class ProcessedText(object):
         #            v1[k2] = math.log10(v2)
         # ---------------------------------------------------------------------
 
+    def add_tagged_sentence(self, tagged_sentence):
+        """Append tagged_sentence, a list of (word, tag) tuples, to
+        self.tagged_sentences and add its words and tags to
+        self.tags_words_counts, self.ngram_words and self.ngram_tags."""
+        words = [word for (word, tag) in tagged_sentence]
+        tags = [tag for (word, tag) in tagged_sentence]
+        for (word, tag) in tagged_sentence:
+            if tag not in self.tags_words_counts:
+                self.tags_words_counts[tag] = {}
+            self.tags_words_counts[tag][word] = self.tags_words_counts[tag].get(word, 0) + 1
+
+        self.tagged_sentences.append(tagged_sentence)
+
+        # ---------------------------------------------------------------------
+        #   Update n-gram counts for both words and tags. Note that
+        #   named entities have been added as "NE-*" tags.
+        # ---------------------------------------------------------------------
+        for i in xrange(1, self.maximum_ngram_size + 1):
+            number_of_start_symbols = max(i-1, 1)
+            padded_words = [self.START_SYMBOL] * number_of_start_symbols + words + [self.STOP_SYMBOL]
+            padded_word_ngrams = nltk.ngrams(padded_words, i)
+            for ngram in padded_word_ngrams:
+                self.ngram_words[i][ngram] = self.ngram_words[i].get(ngram, 0) + 1
+
+            padded_tags = [self.START_SYMBOL] * number_of_start_symbols + tags + [self.STOP_SYMBOL]
+            padded_tag_ngrams = nltk.ngrams(padded_tags, i)
+            for ngram in padded_tag_ngrams:
+                self.ngram_tags[i][ngram] = self.ngram_tags[i].get(ngram, 0) + 1
+        # ---------------------------------------------------------------------
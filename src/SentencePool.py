@@ -0,0 +1,155 @@
+import os
+import sys
+import threading
+import collections
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "SentencePool"
+
+# How long the refill thread waits before generating again after a batch
+# came back empty, as happens when the model cannot meet the constraints.
+# The wait doubles with every further empty batch, up to the maximum.
+EMPTY_BATCH_BACKOFF_SECONDS = 1.0
+MAXIMUM_EMPTY_BATCH_BACKOFF_SECONDS = 60.0
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+class SentencePool(object):
+    """A ring buffer of sentences pre-generated from one language model,
+    kept topped up by a background thread, so that taking sentences costs
+    a constant amount of time per sentence however long they take to
+    generate.
+
+    Whenever the buffer falls below low_watermark sentences the thread
+    generates batches of up to batch_size sentences with generate_many()
+    until it holds high_watermark. If a consumer asks for more sentences
+    than the buffer holds, the rest are generated on the consumer's thread.
+
+    Under constraints generate_many() may return fewer sentences than asked
+    for, or none. The thread then backs off before trying again, and a
+    consumer is given fewer sentences than it asked for.
+
+    Counters:
+    -   hits: sentences taken from the buffer.
+    -   underflows: requests the buffer could not satisfy in full.
+    -   refills: times the thread started topping the buffer up.
+    -   generated: sentences the thread has generated.
+    -   empty_batches: batches the thread generated that came back empty.
+    """
+
+    def __init__(self, language_model, low_watermark, high_watermark, batch_size=100, constraints=None):
+        assert(0 <= low_watermark < high_watermark)
+        self.language_model = language_model
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.batch_size = batch_size
+        self.constraints = constraints
+        self.sentences = collections.deque(maxlen=high_watermark)
+        self.condition = threading.Condition()
+        self.hits = 0
+        self.underflows = 0
+        self.refills = 0
+        self.generated = 0
+        self.empty_batches = 0
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="%s-%s" % (APP_NAME, self.language_model.__class__.__name__))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        logger = logging.getLogger("%s.SentencePool.run" % APP_NAME)
+        while True:
+            with self.condition:
+                while not self.stopping and len(self.sentences) >= self.low_watermark:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                self.refills += 1
+            logger.debug("refilling %s from %s sentences" % (self.language_model.__class__.__name__,
+                                                            len(self.sentences)))
+            backoff_seconds = EMPTY_BATCH_BACKOFF_SECONDS
+            while True:
+                with self.condition:
+                    if self.stopping:
+                        return
+                    shortfall = self.high_watermark - len(self.sentences)
+                if shortfall <= 0:
+                    break
+                batch = self.language_model.generate_many(min(shortfall, self.batch_size),
+                                                          constraints=self.constraints)
+                with self.condition:
+                    self.sentences.extend(batch)
+                    self.generated += len(batch)
+                    self.condition.notify_all()
+                    if len(batch) != 0:
+                        backoff_seconds = EMPTY_BATCH_BACKOFF_SECONDS
+                        continue
+                    self.empty_batches += 1
+                    logger.warning("%s generated no sentences, retrying in %s seconds" %
+                                   (self.language_model.__class__.__name__, backoff_seconds))
+                    if not self.stopping:
+                        self.condition.wait(backoff_seconds)
+                backoff_seconds = min(2 * backoff_seconds, MAXIMUM_EMPTY_BATCH_BACKOFF_SECONDS)
+
+    def pop_many(self, n):
+        """Take n sentences, from the buffer where possible. Returns fewer
+        if the rest cannot be generated: generation on the calling thread
+        stops at the first batch that comes back empty."""
+        with self.condition:
+            taken = [self.sentences.popleft() for i in xrange(min(n, len(self.sentences)))]
+            self.hits += len(taken)
+            if len(taken) < n:
+                self.underflows += 1
+            if len(self.sentences) < self.low_watermark:
+                self.condition.notify_all()
+        while len(taken) < n:
+            batch = self.language_model.generate_many(n - len(taken), constraints=self.constraints)
+            if len(batch) == 0:
+                break
+            taken.extend(batch)
+        return taken
+
+    def pop(self):
+        """Take one sentence, or None if none can be generated."""
+        taken = self.pop_many(1)
+        if len(taken) == 0:
+            return None
+        return taken[0]
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def get_statistics(self):
+        with self.condition:
+            return {"size": len(self.sentences),
+                    "low_watermark": self.low_watermark,
+                    "high_watermark": self.high_watermark,
+                    "hits": self.hits,
+                    "underflows": self.underflows,
+                    "refills": self.refills,
+                    "generated": self.generated,
+                    "empty_batches": self.empty_batches}
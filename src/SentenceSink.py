@@ -0,0 +1,173 @@
+import os
+import sys
+import gzip
+import glob
+import re
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "SentenceSink"
+DEFAULT_BUFFER_SIZE = 1 << 16
+DEFAULT_BACKUP_COUNT = 10
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+class SentenceSink(object):
+    """Appends sentences, one per line, to a file kept open behind one
+    buffered handle for as long as the sink is.
+
+    -   use_gzip: write gzip-compressed, to filepath with ".gz" appended.
+        Appending to an existing file adds a gzip member, which gzip
+        readers treat as one stream.
+    -   maximum_bytes, maximum_sentences: once the current file holds this
+        many bytes of sentences (before compression) or this many
+        sentences it is rotated, as logging.handlers.RotatingFileHandler
+        does: the file becomes <file>.1, <file>.1 becomes <file>.2 and so
+        on, keeping at most backup_count old files.
+
+    self.sentences counts the sentences written through the sink, and is
+    logged when it is closed.
+    """
+
+    def __init__(self,
+                 filepath,
+                 use_gzip=False,
+                 maximum_bytes=None,
+                 maximum_sentences=None,
+                 backup_count=DEFAULT_BACKUP_COUNT,
+                 buffer_size=DEFAULT_BUFFER_SIZE):
+        if use_gzip:
+            filepath = "%s.gz" % filepath
+        self.filepath = filepath
+        self.use_gzip = use_gzip
+        self.maximum_bytes = maximum_bytes
+        self.maximum_sentences = maximum_sentences
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.handle = None
+        self.sentences = 0
+        self.file_bytes = 0
+        self.file_sentences = 0
+
+    @staticmethod
+    def from_settings(filepath, settings):
+        return SentenceSink(filepath,
+                            use_gzip=settings.generator_output_gzip,
+                            maximum_bytes=settings.generator_output_rotate_bytes,
+                            maximum_sentences=settings.generator_output_rotate_sentences,
+                            backup_count=settings.generator_output_backup_count)
+
+    def open(self):
+        """Open the current file for appending. Its existing contents count
+        towards rotation."""
+        directory = os.path.dirname(self.filepath)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file_bytes = 0
+        self.file_sentences = 0
+        if os.path.isfile(self.filepath) and (self.maximum_bytes is not None or
+                                              self.maximum_sentences is not None):
+            for line in iter_lines(self.filepath):
+                self.file_bytes += len(line)
+                self.file_sentences += 1
+        if self.use_gzip:
+            self.handle = gzip.GzipFile(fileobj=open(self.filepath, "ab", self.buffer_size), mode="ab")
+        else:
+            self.handle = open(self.filepath, "ab", self.buffer_size)
+
+    def write(self, sentence):
+        if self.handle is None:
+            self.open()
+        if isinstance(sentence, unicode):
+            sentence = sentence.encode("utf-8")
+        line = "%s\n" % sentence
+        self.handle.write(line)
+        self.sentences += 1
+        self.file_bytes += len(line)
+        self.file_sentences += 1
+        if (self.maximum_bytes is not None and self.file_bytes >= self.maximum_bytes) or \
+           (self.maximum_sentences is not None and self.file_sentences >= self.maximum_sentences):
+            self.rotate()
+
+    def write_many(self, sentences):
+        for sentence in sentences:
+            self.write(sentence)
+
+    def close_handle(self):
+        if self.handle is None:
+            return
+        if self.use_gzip:
+            fileobj = self.handle.fileobj
+            self.handle.close()
+            fileobj.close()
+        else:
+            self.handle.close()
+        self.handle = None
+
+    def rotate(self):
+        logger = logging.getLogger("%s.SentenceSink.rotate" % APP_NAME)
+        logger.debug("rotating: '%s'" % self.filepath)
+        self.close_handle()
+        if self.backup_count > 0:
+            for i in xrange(self.backup_count - 1, 0, -1):
+                source = "%s.%s" % (self.filepath, i)
+                if os.path.isfile(source):
+                    os.rename(source, "%s.%s" % (self.filepath, i + 1))
+            os.rename(self.filepath, "%s.1" % self.filepath)
+        else:
+            os.remove(self.filepath)
+        self.open()
+
+    def close(self):
+        logger = logging.getLogger("%s.SentenceSink.close" % APP_NAME)
+        self.close_handle()
+        logger.info("wrote %s sentences to '%s'" % (self.sentences, self.filepath))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def iter_lines(filepath):
+    """Lines of a file written by a SentenceSink, gzip-compressed or not."""
+    if filepath.endswith(".gz") or re.search(r"\.gz\.\d+$", filepath):
+        f_in = gzip.open(filepath, "rb")
+    else:
+        f_in = open(filepath, "rb")
+    with f_in:
+        for line in f_in:
+            yield line
+
+def get_sentence_filepaths(filepath):
+    """Every file a SentenceSink writing to filepath may have produced,
+    compressed or not, oldest first."""
+    filepaths = []
+    for candidate in (filepath, "%s.gz" % filepath):
+        rotated = [path for path in glob.glob("%s.*" % candidate)
+                   if path[len(candidate)+1:].isdigit()]
+        rotated.sort(key=lambda path: int(path[len(candidate)+1:]), reverse=True)
+        filepaths.extend(rotated)
+        if os.path.isfile(candidate):
+            filepaths.append(candidate)
+    return filepaths
+
+def iter_sentences(filepath):
+    """Sentences written by a SentenceSink to filepath, including rotated
+    and compressed files, oldest first."""
+    for path in get_sentence_filepaths(filepath):
+        for line in iter_lines(path):
+            yield line.rstrip("\n")
@@ -0,0 +1,237 @@
+from __future__ import division
+
+import os
+import sys
+
+import numpy
+
+from CountStore import Vocabulary
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "TagLattice"
+
+# Sentences run through the lattice together by score_sentences() and
+# decode().
+DEFAULT_BATCH_SIZE = 256
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+class TagLattice(object):
+    """A trigram HMM over tags held as dense NumPy matrices, for scoring
+    word sequences with the forward algorithm and tagging them with the
+    Viterbi algorithm, a batch of sentences at a time.
+
+    -   tags: Vocabulary of tags, including the start and stop symbols.
+        Row and column 0, for unknown tags, are never used.
+    -   words: Vocabulary of the words with their own emission column.
+        Column 0 stands for every rare or unknown word.
+    -   transitions: array of shape (K, K, K), where K is len(tags), with
+        transitions[u, v, w] the probability of tag w after tags u, v.
+    -   emissions: array of shape (K, len(words)), with emissions[t, x]
+        the probability of tag t emitting word x.
+
+    The lattice's states are pairs of tags, so each step costs O(K^3) per
+    sentence. The forward algorithm does it as one matrix product per
+    middle tag over the whole batch: forward probabilities are rescaled
+    after every step and the log2 of the scale factors is kept, so nothing
+    underflows however long the sentence.
+    """
+
+    def __init__(self, tags, words, transitions, emissions, start_symbol, stop_symbol):
+        self.tags = tags
+        self.words = words
+        self.transitions = transitions
+        self.emissions = emissions
+        self.start_id = tags.get_id(start_symbol)
+        self.stop_id = tags.get_id(stop_symbol)
+        # transitions with the middle tag first, for the forward step.
+        self.transitions_by_middle = numpy.ascontiguousarray(transitions.transpose(1, 0, 2))
+        self.log_transitions = None
+        self.log_emissions = None
+
+    @staticmethod
+    def from_counts(counts, emissions, start_symbol, stop_symbol,
+                    infrequent_count_threshold, lambdas):
+        """Build a lattice from a trained HMM's tag counts, which are log2
+        counts, and (tag, word) emission counts, which are whole counts.
+
+        Transition probabilities linearly interpolate the maximum
+        likelihood trigram, bigram and unigram estimates with lambdas, a
+        (trigram, bigram, unigram) tuple summing to one, so that tag
+        sequences never seen in training keep some probability. A context
+        never seen in training uses the next lower order estimate in place
+        of its own.
+
+        Words seen at most infrequent_count_threshold times share emission
+        column 0 with unknown words.
+        """
+        tag_set = set()
+        for phrase in counts:
+            if phrase is not None:
+                tag_set.update(phrase)
+        tag_set.discard(start_symbol)
+        tags = Vocabulary([start_symbol] + sorted(tag_set))
+        K = len(tags)
+
+        # ---------------------------------------------------------------------
+        #   Transitions.
+        # ---------------------------------------------------------------------
+        unigrams = numpy.zeros(K)
+        bigrams = numpy.zeros((K, K))
+        trigrams = numpy.zeros((K, K, K))
+        tables = {1: unigrams, 2: bigrams, 3: trigrams}
+        for (phrase, count) in counts.iteritems():
+            if phrase is None or len(phrase) not in tables:
+                continue
+            tables[len(phrase)][tuple(tags.get_id(tag) for tag in phrase)] += 2 ** count
+        for table in tables.itervalues():
+            table[..., tags.get_id(start_symbol)] = 0
+        unigrams /= unigrams.sum()
+        bigrams = normalize_rows(bigrams, unigrams)
+        trigrams = normalize_rows(trigrams, bigrams)
+        (trigram_lambda, bigram_lambda, unigram_lambda) = lambdas
+        transitions = trigram_lambda * trigrams + bigram_lambda * bigrams + unigram_lambda * unigrams
+        # ---------------------------------------------------------------------
+
+        # ---------------------------------------------------------------------
+        #   Emissions.
+        # ---------------------------------------------------------------------
+        word_counts = {}
+        for ((tag, word), count) in emissions.iteritems():
+            word_counts[word] = word_counts.get(word, 0) + count
+        words = Vocabulary(sorted(word for (word, count) in word_counts.iteritems()
+                                  if count > infrequent_count_threshold))
+        emission_matrix = numpy.zeros((K, len(words)))
+        for ((tag, word), count) in emissions.iteritems():
+            emission_matrix[tags.get_id(tag), words.get_id(word)] += count
+        emission_matrix = normalize_rows(emission_matrix, numpy.zeros(len(words)))
+        # ---------------------------------------------------------------------
+
+        return TagLattice(tags, words, transitions, emission_matrix, start_symbol, stop_symbol)
+
+    def encode(self, sentences):
+        """Word ids of a list of sentences, each a list of words, as an
+        array padded with zeros to the longest sentence, and their
+        lengths."""
+        lengths = numpy.array([len(sentence) for sentence in sentences], dtype=numpy.int64)
+        word_ids = numpy.zeros((len(sentences), max(lengths) if len(sentences) else 0), dtype=numpy.int64)
+        get_id = self.words.get_id
+        for (row, sentence) in enumerate(sentences):
+            word_ids[row, :len(sentence)] = [get_id(word) for word in sentence]
+        return (word_ids, lengths)
+
+    def iter_batches(self, sentences, batch_size):
+        """Yield (indices, sentences) for batches of sentences of similar
+        length, longest first within each batch, so that the sentences
+        still running at any step are always a prefix of the batch."""
+        order = sorted(xrange(len(sentences)), key=lambda index: -len(sentences[index]))
+        for start in xrange(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            yield (indices, [sentences[index] for index in indices])
+
+    def score_sentences(self, sentences, batch_size=DEFAULT_BATCH_SIZE):
+        """log2 probability of each of a list of sentences, each a list of
+        words without start or stop symbols, summed over every tag
+        sequence. Returns a NumPy array."""
+        scores = numpy.zeros(len(sentences))
+        for (indices, batch) in self.iter_batches(sentences, batch_size):
+            scores[indices] = self.forward(batch)
+        return scores
+
+    def forward(self, sentences):
+        """score_sentences() for one batch sorted longest first."""
+        (word_ids, lengths) = self.encode(sentences)
+        K = len(self.tags)
+        alpha = numpy.zeros((len(sentences), K, K))
+        alpha[:, self.start_id, self.start_id] = 1.0
+        log_scales = numpy.zeros(len(sentences))
+        for t in xrange(word_ids.shape[1]):
+            n = int(numpy.sum(lengths > t))
+            # step[b, v, w] = sum over u of alpha[b, u, v] * transitions[u, v, w]
+            step = numpy.empty((n, K, K))
+            for v in xrange(K):
+                step[:, v, :] = numpy.dot(alpha[:n, :, v], self.transitions_by_middle[v])
+            step *= self.emissions[:, word_ids[:n, t]].T[:, numpy.newaxis, :]
+            scales = step.reshape(n, -1).max(axis=1)
+            scales[scales == 0] = 1.0
+            alpha[:n] = step / scales[:, numpy.newaxis, numpy.newaxis]
+            log_scales[:n] += numpy.log2(scales)
+        final = numpy.einsum("buv,uv->b", alpha, self.transitions[:, :, self.stop_id])
+        with numpy.errstate(divide="ignore"):
+            return log_scales + numpy.log2(final)
+
+    def decode(self, sentences, batch_size=DEFAULT_BATCH_SIZE):
+        """Most likely tag sequence of each of a list of sentences, each a
+        list of words, or None for a sentence no tag sequence can emit."""
+        if self.log_transitions is None:
+            with numpy.errstate(divide="ignore"):
+                self.log_transitions = numpy.log2(self.transitions)
+                self.log_emissions = numpy.log2(self.emissions)
+        tag_sequences = [None] * len(sentences)
+        for (indices, batch) in self.iter_batches(sentences, batch_size):
+            for (index, tags) in zip(indices, self.viterbi(batch)):
+                tag_sequences[index] = tags
+        return tag_sequences
+
+    def viterbi(self, sentences):
+        """decode() for one batch sorted longest first."""
+        (word_ids, lengths) = self.encode(sentences)
+        K = len(self.tags)
+        delta = numpy.empty((len(sentences), K, K))
+        delta.fill(-numpy.inf)
+        delta[:, self.start_id, self.start_id] = 0.0
+
+        # backpointers[t][b, v, w] is the best tag u before the tags v, w
+        # at step t.
+        backpointers = []
+        for t in xrange(word_ids.shape[1]):
+            n = int(numpy.sum(lengths > t))
+            step = numpy.empty((n, K, K))
+            pointers = numpy.empty((n, K, K), dtype=numpy.int32)
+            for v in xrange(K):
+                scores = delta[:n, :, v, numpy.newaxis] + self.log_transitions[numpy.newaxis, :, v, :]
+                pointers[:, v, :] = scores.argmax(axis=1)
+                step[:, v, :] = scores.max(axis=1)
+            step += self.log_emissions[:, word_ids[:n, t]].T[:, numpy.newaxis, :]
+            delta[:n] = step
+            backpointers.append(pointers)
+
+        final = delta + self.log_transitions[numpy.newaxis, :, :, self.stop_id]
+        tag_sequences = []
+        for (b, length) in enumerate(lengths):
+            (u, v) = numpy.unravel_index(final[b].argmax(), (K, K))
+            if numpy.isneginf(final[b, u, v]):
+                tag_sequences.append(None)
+                continue
+            tag_ids = [u, v]
+            for t in xrange(length - 1, 1, -1):
+                tag_ids.insert(0, backpointers[t][b, tag_ids[0], tag_ids[1]])
+            tag_sequences.append([self.tags.get_token(tag_id) for tag_id in tag_ids[2 - min(length, 2):]])
+        return tag_sequences
+
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.transitions, self.transitions_by_middle, self.emissions,
+                                              self.log_transitions, self.log_emissions)
+                   if array is not None)
+
+def normalize_rows(counts, fallback):
+    """Divide whole counts through by their totals along the last axis.
+    Rows with no counts are taken from fallback, which is broadcast
+    against counts, so the fallback of trigram row (u, v) is bigram row
+    v."""
+    totals = counts.sum(axis=-1)[..., numpy.newaxis]
+    return numpy.where(totals > 0, counts / numpy.maximum(totals, 1), fallback)
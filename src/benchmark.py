@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import platform
+import resource
+import multiprocessing
+import cPickle as pickle
+
+import numpy
+
+from settings import Settings
+from ProcessedText import ProcessedText, ProcessedTextJSONEncoder, ProcessedTextJSONDecoder
+from generator_language_model import LANGUAGE_MODELS
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "benchmark"
+SENTENCE_END_WORD = "."
+SENTENCE_END_TAG = "."
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+def get_peak_memory_bytes():
+    """Peak resident memory of this process so far. A forked child starts
+    from its parent's peak. ru_maxrss is in kilobytes on Linux but in
+    bytes on OS X."""
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak_memory
+    return peak_memory * 1024
+
+def get_synthetic_word(index):
+    """The index-th lowercase word in bijective base 26: "a" to "z", then
+    "aa", "ab" etc."""
+    letters = []
+    index += 1
+    while index > 0:
+        (index, remainder) = divmod(index - 1, 26)
+        letters.append(chr(ord("a") + remainder))
+    return "".join(reversed(letters))
+
+def make_synthetic_corpus(number_of_texts, settings):
+    """A list of number_of_texts ProcessedText objects of random sentences,
+    as described in the benchmark settings. Word frequencies follow Zipf's
+    law, each word always has the same tag, and every sentence ends with
+    a full stop."""
+    random_state = numpy.random.RandomState(settings.benchmark_seed)
+    vocabulary_size = settings.benchmark_vocabulary_size
+    words = [get_synthetic_word(index) for index in xrange(vocabulary_size)]
+    tags = ["TAG%s" % tag_index
+            for tag_index in random_state.randint(settings.benchmark_number_of_tags, size=vocabulary_size)]
+    weights = 1.0 / numpy.arange(1, vocabulary_size + 1)
+    weights /= weights.sum()
+
+    sentences_per_text = 1 + random_state.poisson(settings.benchmark_sentences_per_text - 1, size=number_of_texts)
+    words_per_sentence = 1 + random_state.poisson(settings.benchmark_words_per_sentence - 1,
+                                                  size=sentences_per_text.sum())
+    word_ids = random_state.choice(vocabulary_size, size=words_per_sentence.sum(), p=weights)
+
+    processed_texts = []
+    sentence_index = 0
+    word_index = 0
+    for text_index in xrange(number_of_texts):
+        tagged_sentences = []
+        for i in xrange(sentences_per_text[text_index]):
+            sentence_word_ids = word_ids[word_index:word_index + words_per_sentence[sentence_index]]
+            tagged_sentences.append([(words[word_id], tags[word_id]) for word_id in sentence_word_ids] +
+                                    [(SENTENCE_END_WORD, SENTENCE_END_TAG)])
+            word_index += words_per_sentence[sentence_index]
+            sentence_index += 1
+        processed_texts.append(ProcessedText.initialize_from_tagged_sentences(text_index, tagged_sentences))
+    return processed_texts
+
+def get_rate(count, seconds):
+    if seconds == 0:
+        return None
+    return count / seconds
+
+# -----------------------------------------------------------------------------
+#   Benchmark workers.
+#
+#   Every benchmark runs in a worker process of its own, forked once the
+#   corpus is built, so that its peak memory includes the corpus but not
+#   the models benchmarked before it. As in cross_validation the workers
+#   inherit the corpus rather than have it pickled.
+# -----------------------------------------------------------------------------
+worker_processed_texts = None
+worker_settings = None
+
+def initialize_benchmark_worker(processed_texts, settings):
+    global worker_processed_texts
+    global worker_settings
+    worker_processed_texts = processed_texts
+    worker_settings = settings
+
+def benchmark_serialization_task(unused):
+    """Time JSON and pickle round trips of the corpus, as
+    generate_tagged_chunked writes it and generator_language_model reads
+    it back."""
+    processed_texts = worker_processed_texts
+    results = {}
+
+    start_time = time.time()
+    json_string = json.dumps(processed_texts, sort_keys=True, cls=ProcessedTextJSONEncoder)
+    results["json_bytes"] = len(json_string)
+    results["json_dump_seconds"] = time.time() - start_time
+    start_time = time.time()
+    assert(len(json.loads(json_string, cls=ProcessedTextJSONDecoder)) == len(processed_texts))
+    results["json_load_seconds"] = time.time() - start_time
+    del json_string
+
+    start_time = time.time()
+    pickle_string = pickle.dumps(processed_texts, protocol=pickle.HIGHEST_PROTOCOL)
+    results["pickle_bytes"] = len(pickle_string)
+    results["pickle_dump_seconds"] = time.time() - start_time
+    start_time = time.time()
+    assert(len(pickle.loads(pickle_string)) == len(processed_texts))
+    results["pickle_load_seconds"] = time.time() - start_time
+    del pickle_string
+
+    for serialization in ["json", "pickle"]:
+        for operation in ["dump", "load"]:
+            results["%s_%s_texts_per_second" % (serialization, operation)] = \
+                get_rate(len(processed_texts), results["%s_%s_seconds" % (serialization, operation)])
+    results["peak_memory_bytes"] = get_peak_memory_bytes()
+    return results
+
+def benchmark_language_model_task(language_model_cls):
+    """Time training a language_model_cls on the corpus, its perplexity
+    over the testing texts and sentence generation.
+
+    Training is timed as counting the training texts and training from
+    those counts, as cross_validation trains its folds, leaving out the
+    testing perplexity that train() ends with. Maximum likelihood models
+    cannot score n-grams never seen in training, so such a model is
+    still benchmarked, with a perplexity of None."""
+    logger = logging.getLogger("%s.benchmark_language_model_task" % APP_NAME)
+    processed_texts = worker_processed_texts
+    settings = worker_settings
+    random.seed(settings.benchmark_seed)
+    results = {}
+
+    size = len(processed_texts)
+    testing_size = int(size * settings.generator_non_kfold_testing_proportion)
+    training_set = processed_texts[:size - testing_size]
+    testing_set = processed_texts[size - testing_size:]
+
+    lm = language_model_cls(processed_texts, settings)
+    lm.start_symbol = training_set[0].START_SYMBOL
+    lm.stop_symbol = training_set[0].STOP_SYMBOL
+    start_time = time.time()
+    lm.train_from_counts(lm.count_training_set(training_set, lm.ngram_attribute, lm.count_emissions))
+    results["train_seconds"] = time.time() - start_time
+    results["train_texts_per_second"] = get_rate(len(training_set), results["train_seconds"])
+    results["peak_memory_after_training_bytes"] = get_peak_memory_bytes()
+
+    testing_words = sum(len(sentence) for text in testing_set for sentence in text.tagged_sentences)
+    start_time = time.time()
+    try:
+        perplexity = lm.perplexity(testing_set)
+    except AssertionError:
+        logger.warning("%s cannot score its testing texts" % language_model_cls.__name__)
+        perplexity = None
+    results["perplexity_seconds"] = time.time() - start_time
+    if perplexity is None or math.isinf(perplexity):
+        results["perplexity"] = None
+        results["perplexity_words_per_second"] = None
+    else:
+        results["perplexity"] = perplexity
+        results["perplexity_words_per_second"] = get_rate(testing_words, results["perplexity_seconds"])
+
+    n = settings.benchmark_generated_sentences
+    start_time = time.time()
+    sentences = [lm.generate() for i in xrange(n)]
+    results["generate_seconds"] = time.time() - start_time
+    results["generate_sentences_per_second"] = get_rate(n, results["generate_seconds"])
+    results["generated_words_per_sentence"] = sum(len(sentence.split()) for sentence in sentences) / n
+
+    start_time = time.time()
+    lm.generate_many(n, seed=settings.benchmark_seed)
+    results["generate_many_seconds"] = time.time() - start_time
+    results["generate_many_sentences_per_second"] = get_rate(n, results["generate_many_seconds"])
+
+    results["peak_memory_bytes"] = get_peak_memory_bytes()
+    return results
+
+def run_benchmark_task(task, argument, processed_texts, settings):
+    pool = multiprocessing.Pool(1, initialize_benchmark_worker, (processed_texts, settings))
+    try:
+        return pool.apply(task, (argument, ))
+    finally:
+        pool.close()
+        pool.join()
+# -----------------------------------------------------------------------------
+
+def benchmark_corpus(number_of_texts, settings):
+    """Build a synthetic corpus of number_of_texts texts and benchmark
+    serializing it and each of LANGUAGE_MODELS on it."""
+    logger = logging.getLogger("%s.benchmark_corpus" % APP_NAME)
+    logger.info("building a corpus of %s texts..." % number_of_texts)
+    start_time = time.time()
+    processed_texts = make_synthetic_corpus(number_of_texts, settings)
+    results = {"number_of_texts": number_of_texts,
+               "number_of_sentences": sum(len(text.tagged_sentences) for text in processed_texts),
+               "number_of_words": sum(len(sentence) for text in processed_texts
+                                      for sentence in text.tagged_sentences),
+               "corpus_seconds": time.time() - start_time,
+               "peak_memory_bytes": get_peak_memory_bytes(),
+               "language_models": {}}
+
+    results["serialization"] = run_benchmark_task(benchmark_serialization_task, None, processed_texts, settings)
+    logger.info("JSON dump %.2fs, load %.2fs; pickle dump %.2fs, load %.2fs" %
+                (results["serialization"]["json_dump_seconds"], results["serialization"]["json_load_seconds"],
+                 results["serialization"]["pickle_dump_seconds"], results["serialization"]["pickle_load_seconds"]))
+
+    for language_model_cls in LANGUAGE_MODELS:
+        model_results = run_benchmark_task(benchmark_language_model_task, language_model_cls,
+                                           processed_texts, settings)
+        results["language_models"][language_model_cls.__name__] = model_results
+        logger.info("%s: train %.2fs, perplexity %s, %.0f sentences/s, peak memory %.0f MB" %
+                    (language_model_cls.__name__, model_results["train_seconds"], model_results["perplexity"],
+                     model_results["generate_sentences_per_second"] or 0,
+                     model_results["peak_memory_bytes"] / (1024 * 1024)))
+    return results
+
+def write_results(results, filepath):
+    directory = os.path.dirname(filepath)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filepath, "w") as f_out:
+        json.dump(results, f_out, indent=2, sort_keys=True)
+
+def main():
+    logger = logging.getLogger("%s.main" % APP_NAME)
+    logger.debug("entry.")
+
+    settings = Settings()
+    results = {"started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "platform": {"platform": platform.platform(),
+                            "machine": platform.machine(),
+                            "processor": platform.processor(),
+                            "cpu_count": multiprocessing.cpu_count(),
+                            "python": platform.python_version(),
+                            "numpy": numpy.__version__},
+               "settings": {"benchmark": settings.yaml_object["benchmark"],
+                            "generator": settings.yaml_object["generator"]},
+               "corpora": []}
+
+    # Smallest corpus first, so that each worker's peak memory inherited
+    # from this process is that of its own corpus.
+    for number_of_texts in sorted(settings.benchmark_numbers_of_texts):
+        results["corpora"].append(benchmark_corpus(number_of_texts, settings))
+        write_results(results, settings.benchmark_results_filepath)
+    logger.info("results written to: '%s'" % settings.benchmark_results_filepath)
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ import glob
 import re
 
 from settings import Settings
+from SentenceSink import get_sentence_filepaths, iter_sentences
+from GenerationConstraints import get_minimum_sentence_characters
 
 # -----------------------------------------------------------------------------
 #   Constants.
@@ -34,20 +36,29 @@ def main():
     settings = Settings()
     output = {}
     data_directory = settings.builder_data_directory
-    minimum_sentence_length = settings.builder_minimum_sentence_length
+    minimum_sentence_characters = get_minimum_sentence_characters(settings)
     re_reject = re.compile(settings.builder_re_reject)
     for (filename, key) in settings.builder_filename_to_key.items():
         logger.debug("filename: '%s', key: '%s'." % (filename, key))
         filepath = os.path.join(data_directory, filename)
-        if not os.path.isfile(filepath):
+        if len(get_sentence_filepaths(filepath)) == 0:
             logger.error("filepath: '%s' does not exist." % filepath)
             continue
         output[key] = []
-        with open(filepath) as f_in:
-            input_lines = (line.strip() for line in f_in
-                           if len(line) >= minimum_sentence_length and
-                              re_reject.search(line) is None)
-            output[key].extend(input_lines)
+        input_lines = (line.strip() for line in iter_sentences(filepath)
+                       if len(line) >= minimum_sentence_characters and
+                          re_reject.search(line) is None)
+        # Output files written before generation was deduplicated may
+        # still repeat sentences.
+        seen = set()
+        number_of_duplicates = 0
+        for line in input_lines:
+            if line in seen:
+                number_of_duplicates += 1
+                continue
+            seen.add(line)
+            output[key].append(line)
+        logger.debug("%s sentences, %s duplicates dropped" % (len(output[key]), number_of_duplicates))
 
     with open(settings.builder_output_json, "w") as f_out:
         json.dump(output, f_out, indent=2)
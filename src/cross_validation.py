@@ -0,0 +1,157 @@
+from __future__ import division
+
+import os
+import sys
+import multiprocessing
+
+from LanguageModel import count_training_texts, merge_count_tables, subtract_count_tables
+from Metrics import metrics
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "cross_validation"
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+def get_folds(processed_texts, settings):
+    """Hold back the last generator_kfold_testing_proportion of
+    processed_texts for testing and split the rest into
+    generator_number_of_k_folds contiguous folds of nearly equal size.
+    Returns (folds, testing_texts)."""
+    size = len(processed_texts)
+    testing_size = int(size * settings.generator_kfold_testing_proportion)
+    training_texts = processed_texts[:size - testing_size]
+    k = settings.generator_number_of_k_folds
+    assert(2 <= k <= len(training_texts))
+    folds = [training_texts[i * len(training_texts) // k:(i + 1) * len(training_texts) // k]
+             for i in xrange(k)]
+    return (folds, processed_texts[size - testing_size:])
+
+# -----------------------------------------------------------------------------
+#   Fold workers.
+#
+#   Every fold is counted once. The counts of the whole training set are the
+#   sum of the fold counts, and a fold's model is trained from the whole
+#   counts less that fold's counts, so no text is counted more than once
+#   however many folds there are. As in parallel generation the workers are
+#   handed the counts when they start and, as the pool forks, inherit them
+#   rather than have them pickled.
+# -----------------------------------------------------------------------------
+worker_language_model_cls = None
+worker_settings = None
+worker_folds = None
+worker_testing_texts = None
+worker_fold_tables = None
+worker_total_tables = None
+
+def initialize_fold_worker(language_model_cls, settings, folds, testing_texts, fold_tables, total_tables):
+    global worker_language_model_cls
+    global worker_settings
+    global worker_folds
+    global worker_testing_texts
+    global worker_fold_tables
+    global worker_total_tables
+    worker_language_model_cls = language_model_cls
+    worker_settings = settings
+    worker_folds = folds
+    worker_testing_texts = testing_texts
+    worker_fold_tables = fold_tables
+    worker_total_tables = total_tables
+
+def score_fold_task(fold_index):
+    """Train a model on every fold but fold_index and return its perplexity
+    over fold_index, or infinity if it cannot score some of the fold's
+    n-grams at all. A fold_index of len(folds) stands for the testing
+    texts, scored by a model trained on every fold."""
+    logger = logging.getLogger("%s.score_fold_task" % APP_NAME)
+    if fold_index == len(worker_folds):
+        fold = worker_testing_texts
+        training_texts = [text for other_fold in worker_folds for text in other_fold]
+        tables = dict((name, table.copy()) for (name, table) in worker_total_tables.iteritems())
+    else:
+        fold = worker_folds[fold_index]
+        training_texts = [text for (index, other_fold) in enumerate(worker_folds) if index != fold_index
+                          for text in other_fold]
+        tables = subtract_count_tables(worker_total_tables, worker_fold_tables[fold_index])
+    lm = worker_language_model_cls(training_texts, worker_settings)
+    lm.start_symbol = fold[0].START_SYMBOL
+    lm.stop_symbol = fold[0].STOP_SYMBOL
+    lm.train_from_counts(tables)
+    try:
+        return lm.perplexity(fold)
+    except AssertionError:
+        logger.warning("fold %s has n-grams %s cannot score" % (fold_index, lm.__class__.__name__))
+        return float("inf")
+    finally:
+        metrics.record_cache_statistics(lm)
+# -----------------------------------------------------------------------------
+
+def cross_validate(language_model_cls, processed_texts, settings):
+    """k-fold cross-validation of language_model_cls over processed_texts;
+    see get_folds(). The folds are counted, then trained and scored, over
+    generator_kfold_workers worker processes.
+
+    Returns a dictionary with the perplexity of each fold under a model
+    trained on the others, "fold_perplexities", their mean,
+    "mean_perplexity", and the perplexity of the held back testing texts
+    under a model trained on every fold, "testing_perplexity", or None if
+    no texts are held back."""
+    logger = logging.getLogger("%s.cross_validate" % APP_NAME)
+    (folds, testing_texts) = get_folds(processed_texts, settings)
+    workers = min(settings.generator_kfold_workers, len(folds))
+    logger.debug("entry. language_model_cls: %s, folds: %s, workers: %s" %
+                 (language_model_cls.__name__, len(folds), workers))
+
+    start_symbol = folds[0][0].START_SYMBOL
+    count_tasks = [(fold, language_model_cls.ngram_attribute, language_model_cls.ngram_count,
+                    start_symbol, language_model_cls.count_emissions)
+                   for fold in folds]
+    if workers <= 1:
+        fold_tables = map(count_training_texts, count_tasks)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            fold_tables = pool.map(count_training_texts, count_tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    total_tables = dict((name, table.copy()) for (name, table) in fold_tables[0].iteritems())
+    for tables in fold_tables[1:]:
+        merge_count_tables((total_tables, tables))
+
+    arguments = (language_model_cls, settings, folds, testing_texts, fold_tables, total_tables)
+    fold_indices = range(len(folds) + 1 if len(testing_texts) != 0 else len(folds))
+    if workers <= 1:
+        initialize_fold_worker(*arguments)
+        perplexities = map(score_fold_task, fold_indices)
+    else:
+        pool = multiprocessing.Pool(workers, initialize_fold_worker, arguments)
+        try:
+            perplexities = pool.map(score_fold_task, fold_indices)
+        finally:
+            pool.close()
+            pool.join()
+    testing_perplexity = perplexities.pop() if len(testing_texts) != 0 else None
+
+    mean_perplexity = sum(perplexities) / len(perplexities)
+    for (fold_index, perplexity) in enumerate(perplexities):
+        logger.info("%s fold %s: perplexity %s" % (language_model_cls.__name__, fold_index, perplexity))
+    logger.info("%s mean perplexity over %s folds: %s" % (language_model_cls.__name__, len(folds), mean_perplexity))
+    logger.info("%s testing perplexity: %s" % (language_model_cls.__name__, testing_perplexity))
+    return {"fold_perplexities": perplexities,
+            "mean_perplexity": mean_perplexity,
+            "testing_perplexity": testing_perplexity}
@@ -6,15 +6,28 @@ import pprint
 import json
 import random
 import copy
+import hashlib
+import itertools
+import multiprocessing
 import cPickle as pickle
 
 from settings import Settings
+from utilities import BloomFilter
+from ModelSnapshot import get_corpus_fingerprint, get_snapshot_filepath, save_snapshot, load_snapshot
+from MappedModel import is_mappable, save_mapped_model, load_mapped_model
+from GenerationConstraints import GenerationConstraints
+from SentenceSink import SentenceSink, iter_sentences
+from cross_validation import cross_validate
 from ProcessedText import ProcessedText, ProcessedTextJSONEncoder, ProcessedTextJSONDecoder
 from LanguageModel import UnigramMaximumLikelihoodLanguageModel, \
                           BigramMaximumLikelihoodLanguageModel, \
                           TrigramMaximumLikelihoodLanguageModel, \
                           QuadgramMaximumLikelihoodLanguageModel, \
-                          HMMTrigramMaximumLikelihoodModel
+                          HMMTrigramMaximumLikelihoodModel, \
+                          BigramKneserNeyLanguageModel, \
+                          TrigramKneserNeyLanguageModel, \
+                          BigramLinearInterpolationLanguageModel, \
+                          TrigramLinearInterpolationLanguageModel
 
 # -----------------------------------------------------------------------------
 #   Constants.
@@ -29,6 +42,10 @@ LANGUAGE_MODELS = [ \
                    TrigramMaximumLikelihoodLanguageModel,
                    #QuadgramMaximumLikelihoodLanguageModel,
                    HMMTrigramMaximumLikelihoodModel,
+                   #BigramKneserNeyLanguageModel,
+                   #TrigramKneserNeyLanguageModel,
+                   #BigramLinearInterpolationLanguageModel,
+                   #TrigramLinearInterpolationLanguageModel,
                   ]
 # -----------------------------------------------------------------------------
 
@@ -45,32 +62,203 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 # -----------------------------------------------------------------------------
 
-def get_trained_language_model(language_model_cls, processed_texts, settings):
+def get_trained_language_model(language_model_cls, processed_texts, settings, corpus_fingerprint=None):
+    """Train a language model, or, if snapshots are enabled and one exists
+    for this corpus, model class and settings, load it instead."""
     logger = logging.getLogger("%s.get_trained_language_models" % APP_NAME)
     logger.debug("entry. language_model_cls: %s" % language_model_cls)
+
+    if settings.generator_use_snapshots:
+        if corpus_fingerprint is None:
+            corpus_fingerprint = get_corpus_fingerprint(processed_texts)
+        snapshot_filepath = get_snapshot_filepath(language_model_cls, corpus_fingerprint, settings)
+        if os.path.isfile(snapshot_filepath):
+            logger.debug("loading snapshot: '%s'" % snapshot_filepath)
+            return load_snapshot(snapshot_filepath, processed_texts, settings)
+
     lm = language_model_cls(processed_texts, settings)
     lm.train()
+
+    if settings.generator_use_snapshots:
+        logger.debug("saving snapshot: '%s'" % snapshot_filepath)
+        save_snapshot(lm, snapshot_filepath)
     return lm
 
-def use_language_model(lm, settings, number_of_sentences=100):
-    logger = logging.getLogger("%s.use_language_model" % APP_NAME)
-    logger.debug("entry.")
+def get_generation_constraints(settings):
+    if settings.generator_use_generation_constraints:
+        return GenerationConstraints.from_settings(settings)
+    return None
 
-    logger.debug("generated sentences:")
+def get_output_filepath(lm):
     if not os.path.isdir(OUTPUT_DIRECTORY):
         os.makedirs(OUTPUT_DIRECTORY)
-    output_filepath = os.path.join(OUTPUT_DIRECTORY, "%s.txt" % lm.__class__.__name__)
-    with open(output_filepath, "a") as f_out:
-        for i in xrange(number_of_sentences):
-            sentence = lm.generate()
-            f_out.write("%s\n" % sentence)
-            logger.debug(sentence)
+    return os.path.join(OUTPUT_DIRECTORY, "%s.txt" % lm.__class__.__name__)
 
-def main():
-    logger = logging.getLogger("%s.main" % APP_NAME)
-    logger.debug("entry.")
+class SentenceDeduplicator(object):
+    """Drops sentences that have already been written to a model's output
+    file, remembering them in a BloomFilter so that memory stays bounded
+    however many sentences are generated. A new sentence is wrongly taken
+    for a duplicate with probability about the filter's error rate."""
 
-    settings = Settings()
+    def __init__(self, expected_count, error_rate):
+        self.seen = BloomFilter(expected_count, error_rate)
+        self.sentences = 0
+        self.duplicates = 0
+
+    @staticmethod
+    def from_settings(settings):
+        return SentenceDeduplicator(settings.generator_deduplication_expected_sentences,
+                                    settings.generator_deduplication_error_rate)
+
+    def add_existing(self, sentence):
+        """Remember a sentence written on an earlier run, without counting it."""
+        self.seen.add(sentence)
+
+    def is_new(self, sentence):
+        self.sentences += 1
+        if self.seen.add(sentence):
+            self.duplicates += 1
+            return False
+        return True
+
+    def get_duplicate_rate(self):
+        if self.sentences == 0:
+            return 0
+        return self.duplicates / float(self.sentences)
+
+def get_sentence_deduplicator(lm, settings):
+    """SentenceDeduplicator for lm's output file, primed with the sentences
+    already in it, or None if deduplication is turned off."""
+    if not settings.generator_deduplicate_sentences:
+        return None
+    deduplicator = SentenceDeduplicator.from_settings(settings)
+    for sentence in iter_sentences(get_output_filepath(lm)):
+        deduplicator.add_existing(sentence)
+    return deduplicator
+
+def get_sentence_sink(lm, settings):
+    return SentenceSink.from_settings(get_output_filepath(lm), settings)
+
+def report_duplicates(language_models, deduplicators):
+    logger = logging.getLogger("%s.report_duplicates" % APP_NAME)
+    for (lm, deduplicator) in zip(language_models, deduplicators):
+        if deduplicator is not None:
+            logger.info("%s: %s of %s sentences were duplicates (%.1f%%)" %
+                        (lm.__class__.__name__, deduplicator.duplicates, deduplicator.sentences,
+                         100 * deduplicator.get_duplicate_rate()))
+
+def write_sentences(sink, sentences, deduplicator=None):
+    if deduplicator is not None:
+        sentences = (sentence for sentence in sentences if deduplicator.is_new(sentence))
+    sink.write_many(sentences)
+
+# -----------------------------------------------------------------------------
+#   Parallel generation.
+#
+#   Generation is split into tasks, run over a pool of worker processes or,
+#   with a single worker, in this process. Every worker process is handed
+#   the trained models and the generation constraints once, when it
+#   starts. On POSIX the pool forks, so the models are inherited rather
+#   than pickled. Work is split into tasks of number_of_sentences sentences
+#   from one model, and each task is seeded from the run's seed and its own
+#   task index alone. The output hence depends only on the seed, not on the
+#   number of workers or on which worker runs which task, and as results
+#   are written in task order the output files are the same on every run
+#   with the same seed.
+#
+#   With use_mapped_models the workers are instead handed the directory of
+#   each model that has been written in the mapped model format, and open
+#   it when they start, so that they share its pages rather than each
+#   touching, and so copying, its own part of the forked model.
+# -----------------------------------------------------------------------------
+worker_language_models = None
+worker_constraints = None
+
+def initialize_generation_worker(language_models, constraints):
+    """language_models holds trained models or the directories of mapped
+    models; see get_worker_language_models()."""
+    global worker_language_models
+    global worker_constraints
+    worker_language_models = [load_mapped_model(lm) if isinstance(lm, basestring) else lm
+                              for lm in language_models]
+    worker_constraints = constraints
+
+def get_worker_language_models(language_models, constraints, settings):
+    """The language models to hand the generation workers. If
+    use_mapped_models is set, every model that can be, and that is not
+    generating under constraints, is written in the mapped model format
+    and replaced by its directory."""
+    logger = logging.getLogger("%s.get_worker_language_models" % APP_NAME)
+    if not settings.generator_use_mapped_models or constraints is not None:
+        return language_models
+    worker_language_models = []
+    for lm in language_models:
+        if not is_mappable(lm):
+            worker_language_models.append(lm)
+            continue
+        directory = os.path.join(settings.generator_mapped_model_directory, lm.__class__.__name__)
+        logger.debug("saving mapped model: '%s'" % directory)
+        save_mapped_model(lm, directory)
+        worker_language_models.append(directory)
+    return worker_language_models
+
+def get_task_seed(seed, task_index):
+    """32-bit seed for one task, derived from the run's seed and the task's
+    index."""
+    return int(hashlib.sha1("%s:%s" % (seed, task_index)).hexdigest()[:8], 16)
+
+def generate_sentences_task(arguments):
+    (task_index, model_index, number_of_sentences, seed) = arguments
+    lm = worker_language_models[model_index]
+    sentences = lm.generate_many(number_of_sentences,
+                                 seed=get_task_seed(seed, task_index),
+                                 constraints=worker_constraints)
+    return (model_index, sentences)
+
+def use_language_models_in_parallel(language_models, settings, number_of_rounds,
+                                    number_of_sentences=100, seed=None):
+    """Generate number_of_rounds batches of number_of_sentences sentences
+    from every language model over generator_generation_workers worker
+    processes, appending them to each model's output file. With one worker
+    the tasks run in this process, seeded as they would be in a pool, so
+    the output is the same."""
+    logger = logging.getLogger("%s.use_language_models_in_parallel" % APP_NAME)
+    workers = settings.generator_generation_workers
+    if seed is None:
+        seed = random.getrandbits(32)
+    logger.debug("entry. workers: %s, seed: %s" % (workers, seed))
+
+    deduplicators = [get_sentence_deduplicator(lm, settings) for lm in language_models]
+    tasks = ((round_index * len(language_models) + model_index, model_index, number_of_sentences, seed)
+             for round_index in xrange(number_of_rounds)
+             for model_index in xrange(len(language_models)))
+    sinks = [get_sentence_sink(lm, settings) for lm in language_models]
+    constraints = get_generation_constraints(settings)
+    arguments = (get_worker_language_models(language_models, constraints, settings), constraints)
+    pool = None
+    if workers <= 1:
+        initialize_generation_worker(*arguments)
+        results = itertools.imap(generate_sentences_task, tasks)
+    else:
+        pool = multiprocessing.Pool(workers, initialize_generation_worker, arguments)
+        results = pool.imap(generate_sentences_task, tasks, chunksize=4)
+    try:
+        for (model_index, sentences) in results:
+            write_sentences(sinks[model_index], sentences, deduplicators[model_index])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for sink in sinks:
+            sink.close()
+    report_duplicates(language_models, deduplicators)
+# -----------------------------------------------------------------------------
+
+def load_processed_texts(settings):
+    """Load the processed biographies and return the interesting English
+    ones, shuffled."""
+    logger = logging.getLogger("%s.load_processed_texts" % APP_NAME)
+    logger.debug("entry.")
 
     # -------------------------------------------------------------------------
     #   If the JSON processed data doesn't exist then you haven't run
@@ -99,11 +287,31 @@ def main():
     random.shuffle(relevant_biographies)
     # -------------------------------------------------------------------------
 
-    language_models = [get_trained_language_model(cls, relevant_biographies, settings)
-                       for cls in LANGUAGE_MODELS]
-    for i in xrange(10000):
-        for language_model in language_models:
-            use_language_model(language_model, settings)
+    return relevant_biographies
+
+def load_language_models(settings, processed_texts=None):
+    """Return a trained instance of each of LANGUAGE_MODELS, trained on
+    processed_texts, by default the processed biographies, or loaded from a
+    snapshot."""
+    logger = logging.getLogger("%s.load_language_models" % APP_NAME)
+    logger.debug("entry.")
+    if processed_texts is None:
+        processed_texts = load_processed_texts(settings)
+    corpus_fingerprint = get_corpus_fingerprint(processed_texts)
+    return [get_trained_language_model(cls, processed_texts, settings, corpus_fingerprint)
+            for cls in LANGUAGE_MODELS]
+
+def main():
+    logger = logging.getLogger("%s.main" % APP_NAME)
+    logger.debug("entry.")
+
+    settings = Settings()
+    processed_texts = load_processed_texts(settings)
+    if settings.generator_use_kfold_cross_validation:
+        for cls in LANGUAGE_MODELS:
+            cross_validate(cls, processed_texts, settings)
+    language_models = load_language_models(settings, processed_texts)
+    use_language_models_in_parallel(language_models, settings, 10000)
 
 if __name__ == "__main__":
     random.seed(4)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import Queue
+import random
+import threading
+import collections
+import urlparse
+import BaseHTTPServer
+
+from settings import Settings
+from generator_language_model import load_language_models, get_generation_constraints
+from SentencePool import SentencePool
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+APP_NAME = "serve"
+
+# Number of recent request latencies kept for the percentiles in /stats.
+RECENT_LATENCIES = 1000
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#   Logging.
+# -----------------------------------------------------------------------------
+import logging
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+class RequestStatistics(object):
+    """Thread-safe request, sentence and latency counters, overall and per
+    model."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.models = {}
+
+    def record(self, model_key, number_of_sentences, elapsed):
+        with self.lock:
+            statistics = self.models.get(model_key)
+            if statistics is None:
+                statistics = {"requests": 0,
+                              "sentences": 0,
+                              "total_seconds": 0.0,
+                              "maximum_seconds": 0.0,
+                              "recent_seconds": collections.deque(maxlen=RECENT_LATENCIES)}
+                self.models[model_key] = statistics
+            statistics["requests"] += 1
+            statistics["sentences"] += number_of_sentences
+            statistics["total_seconds"] += elapsed
+            statistics["maximum_seconds"] = max(statistics["maximum_seconds"], elapsed)
+            statistics["recent_seconds"].append(elapsed)
+
+    def get_report(self):
+        with self.lock:
+            uptime = time.time() - self.start_time
+            report = {"uptime_seconds": uptime, "models": {}}
+            for (model_key, statistics) in self.models.iteritems():
+                recent = sorted(statistics["recent_seconds"])
+                report["models"][model_key] = {
+                    "requests": statistics["requests"],
+                    "sentences": statistics["sentences"],
+                    "mean_latency_ms": 1000 * statistics["total_seconds"] / statistics["requests"],
+                    "median_latency_ms": 1000 * get_percentile(recent, 0.5),
+                    "p95_latency_ms": 1000 * get_percentile(recent, 0.95),
+                    "maximum_latency_ms": 1000 * statistics["maximum_seconds"],
+                    "sentences_per_second": statistics["sentences"] / uptime,
+                    "sentences_per_generation_second": statistics["sentences"] / max(statistics["total_seconds"], 1e-9)}
+            return report
+
+def get_percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class ThreadPoolMixIn(object):
+    """Mix-in for a SocketServer server that handles requests on a fixed
+    number of worker threads, rather than on a new thread per request as
+    SocketServer.ThreadingMixIn does, so that a burst of requests cannot
+    start any number of threads. Accepted requests wait in a queue as long
+    as the number of threads; while it is full no more are accepted."""
+
+    def start_workers(self, number_of_threads):
+        self.request_queue = Queue.Queue(number_of_threads)
+        self.workers = []
+        for i in xrange(number_of_threads):
+            worker = threading.Thread(target=self.process_queued_requests)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop_workers(self):
+        """Stop the worker threads once they have handled the requests
+        already queued."""
+        for worker in self.workers:
+            self.request_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def process_request(self, request, client_address):
+        self.request_queue.put((request, client_address))
+
+    def process_queued_requests(self):
+        """Handle queued requests until given None, as
+        SocketServer.ThreadingMixIn.process_request_thread() handles
+        one."""
+        while True:
+            queued_request = self.request_queue.get()
+            if queued_request is None:
+                return
+            (request, client_address) = queued_request
+            try:
+                self.finish_request(request, client_address)
+                self.shutdown_request(request)
+            except:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+
+class SentenceServer(ThreadPoolMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server handling requests on server_worker_threads threads,
+    holding the trained language models keyed as in the builder's
+    filename_to_key, and, if server_use_sentence_pool is set, a
+    SentencePool for each."""
+
+    def __init__(self, address, language_models, settings):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SentenceRequestHandler)
+        self.language_models = language_models
+        self.settings = settings
+        self.constraints = get_generation_constraints(settings)
+        self.statistics = RequestStatistics()
+        self.pools = {}
+        if settings.server_use_sentence_pool:
+            for (model_key, lm) in language_models.iteritems():
+                self.pools[model_key] = SentencePool(lm,
+                                                     settings.server_pool_low_watermark,
+                                                     settings.server_pool_high_watermark,
+                                                     settings.server_pool_batch_size,
+                                                     self.constraints)
+        self.start_workers(settings.server_worker_threads)
+
+    def start_pools(self):
+        for pool in self.pools.itervalues():
+            pool.start()
+
+    def stop_pools(self):
+        for pool in self.pools.itervalues():
+            pool.stop()
+
+    def generate(self, model_key, number_of_sentences):
+        if model_key in self.pools:
+            return self.pools[model_key].pop_many(number_of_sentences)
+        return self.language_models[model_key].generate_many(number_of_sentences,
+                                                             constraints=self.constraints)
+
+    def get_report(self):
+        report = self.statistics.get_report()
+        if self.pools:
+            report["pools"] = dict((model_key, pool.get_statistics())
+                                   for (model_key, pool) in self.pools.iteritems())
+        return report
+
+class SentenceRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves:
+
+    -   /generate?model=<key>&n=<count>: a JSON object with n generated
+        sentences from the model, taken from its pool if there is one.
+    -   /stats: a JSON object with per-model request counts, latencies and
+        throughput, and the pools' counters.
+    """
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == "/generate":
+            self.handle_generate(urlparse.parse_qs(url.query))
+        elif url.path == "/stats":
+            self.send_json(200, self.server.get_report())
+        else:
+            self.send_json(404, {"error": "unknown path: '%s'" % url.path})
+
+    def handle_generate(self, query):
+        settings = self.server.settings
+        model_key = query.get("model", [None])[0]
+        if model_key not in self.server.language_models:
+            self.send_json(404, {"error": "unknown model: '%s'" % model_key,
+                                 "models": sorted(self.server.language_models)})
+            return
+        try:
+            number_of_sentences = int(query.get("n", ["1"])[0])
+        except ValueError:
+            number_of_sentences = -1
+        if not 1 <= number_of_sentences <= settings.server_maximum_sentences_per_request:
+            self.send_json(400, {"error": "n must be between 1 and %s" %
+                                          settings.server_maximum_sentences_per_request})
+            return
+
+        start_time = time.time()
+        sentences = self.server.generate(model_key, number_of_sentences)
+        elapsed = time.time() - start_time
+        self.server.statistics.record(model_key, len(sentences), elapsed)
+        self.send_json(200, {"model": model_key,
+                             "sentences": sentences,
+                             "latency_ms": 1000 * elapsed})
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj, indent=2)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger = logging.getLogger("%s.SentenceRequestHandler" % APP_NAME)
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+def get_language_models_by_key(language_models, settings):
+    """Key each language model as build_json does, by the key of its output
+    file in the builder's filename_to_key, or else by its class name."""
+    filename_to_key = settings.builder_filename_to_key
+    return dict((filename_to_key.get("%s.txt" % lm.__class__.__name__, lm.__class__.__name__), lm)
+                for lm in language_models)
+
+def main():
+    logger = logging.getLogger("%s.main" % APP_NAME)
+    logger.debug("entry.")
+
+    settings = Settings()
+    language_models = get_language_models_by_key(load_language_models(settings), settings)
+
+    address = (settings.server_host, settings.server_port)
+    server = SentenceServer(address, language_models, settings)
+
+    # Build the sampling tables up front rather than on the first request,
+    # generating as requests do, so that only the tables they use are built.
+    for lm in language_models.itervalues():
+        lm.generate_many(1, constraints=server.constraints)
+    server.start_pools()
+    logger.info("serving %s on http://%s:%s/" % (", ".join(sorted(language_models)), address[0], address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop_pools()
+        server.stop_workers()
+        server.server_close()
+
+if __name__ == "__main__":
+    random.seed(4)
+    main()
@@ -45,6 +45,10 @@ class Settings(object):
     def generator_kfold_testing_proportion(self):
         return self.yaml_object['generator']['kfold_testing_proportion']
 
+    @property
+    def generator_kfold_workers(self):
+        return self.yaml_object['generator']['kfold_workers']
+
     @property
     def generator_non_kfold_cross_validation_proportion(self):
         return self.yaml_object['generator']['non_kfold_cross_validation_proportion']
@@ -53,6 +57,81 @@ class Settings(object):
     def generator_non_kfold_testing_proportion(self):
         return self.yaml_object['generator']['non_kfold_testing_proportion']
 
+    @property
+    def generator_training_workers(self):
+        return self.yaml_object['generator']['training_workers']
+
+    @property
+    def generator_count_store(self):
+        return self.yaml_object['generator']['count_store']
+
+    @property
+    def generator_use_snapshots(self):
+        return self.yaml_object['generator']['use_snapshots']
+
+    @property
+    def generator_snapshot_directory(self):
+        relative_path = self.yaml_object['generator']['snapshot_directory']
+        return os.path.abspath(os.path.join(__file__, os.pardir, relative_path))
+
+    @property
+    def generator_use_generation_constraints(self):
+        return self.yaml_object['generator']['use_generation_constraints']
+
+    @property
+    def generator_maximum_sentence_tokens(self):
+        return self.yaml_object['generator']['maximum_sentence_tokens']
+
+    @property
+    def generator_generation_workers(self):
+        return self.yaml_object['generator']['generation_workers']
+
+    @property
+    def generator_use_mapped_models(self):
+        return self.yaml_object['generator']['use_mapped_models']
+
+    @property
+    def generator_mapped_model_directory(self):
+        relative_path = self.yaml_object['generator']['mapped_model_directory']
+        return os.path.abspath(os.path.join(__file__, os.pardir, relative_path))
+
+    @property
+    def generator_deduplicate_sentences(self):
+        return self.yaml_object['generator']['deduplicate_sentences']
+
+    @property
+    def generator_deduplication_expected_sentences(self):
+        return self.yaml_object['generator']['deduplication_expected_sentences']
+
+    @property
+    def generator_deduplication_error_rate(self):
+        return self.yaml_object['generator']['deduplication_error_rate']
+
+    @property
+    def generator_output_gzip(self):
+        return self.yaml_object['generator']['output_gzip']
+
+    @property
+    def generator_output_rotate_bytes(self):
+        return self.yaml_object['generator']['output_rotate_bytes']
+
+    @property
+    def generator_output_rotate_sentences(self):
+        return self.yaml_object['generator']['output_rotate_sentences']
+
+    @property
+    def generator_output_backup_count(self):
+        return self.yaml_object['generator']['output_backup_count']
+
+    @property
+    def generator_collect_metrics(self):
+        return self.yaml_object['generator']['collect_metrics']
+
+    @property
+    def generator_metrics_filepath(self):
+        relative_path = self.yaml_object['generator']['metrics_filepath']
+        return os.path.abspath(os.path.join(__file__, os.pardir, relative_path))
+
     @property
     def builder_data_directory(self):
         relative_path = self.yaml_object['builder']['data_directory']
@@ -79,6 +158,71 @@ class Settings(object):
     def builder_re_reject(self):
         return self.yaml_object['builder']['re_reject']
 
+    @property
+    def server_host(self):
+        return self.yaml_object['server']['host']
+
+    @property
+    def server_port(self):
+        return self.yaml_object['server']['port']
+
+    @property
+    def server_maximum_sentences_per_request(self):
+        return self.yaml_object['server']['maximum_sentences_per_request']
+
+    @property
+    def server_worker_threads(self):
+        return self.yaml_object['server']['worker_threads']
+
+    @property
+    def server_use_sentence_pool(self):
+        return self.yaml_object['server']['use_sentence_pool']
+
+    @property
+    def server_pool_low_watermark(self):
+        return self.yaml_object['server']['pool_low_watermark']
+
+    @property
+    def server_pool_high_watermark(self):
+        return self.yaml_object['server']['pool_high_watermark']
+
+    @property
+    def server_pool_batch_size(self):
+        return self.yaml_object['server']['pool_batch_size']
+
+    @property
+    def benchmark_numbers_of_texts(self):
+        return self.yaml_object['benchmark']['numbers_of_texts']
+
+    @property
+    def benchmark_vocabulary_size(self):
+        return self.yaml_object['benchmark']['vocabulary_size']
+
+    @property
+    def benchmark_number_of_tags(self):
+        return self.yaml_object['benchmark']['number_of_tags']
+
+    @property
+    def benchmark_sentences_per_text(self):
+        return self.yaml_object['benchmark']['sentences_per_text']
+
+    @property
+    def benchmark_words_per_sentence(self):
+        return self.yaml_object['benchmark']['words_per_sentence']
+
+    @property
+    def benchmark_seed(self):
+        return self.yaml_object['benchmark']['seed']
+
+    @property
+    def benchmark_generated_sentences(self):
+        return self.yaml_object['benchmark']['generated_sentences']
+
+    @property
+    def benchmark_results_filepath(self):
+        relative_path = self.yaml_object['benchmark']['results_filepath']
+        return os.path.abspath(os.path.join(__file__, os.pardir, relative_path))
+
     @property
     def deploy_s3_bucket_name(self):
         return self.yaml_object['deploy']['s3_bucket_name']
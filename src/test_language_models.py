@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import unittest
+
+import numpy
+
+import LanguageModel
+from settings import Settings
+from benchmark import make_synthetic_corpus
+
+# -----------------------------------------------------------------------------
+#   Constants.
+# -----------------------------------------------------------------------------
+NUMBER_OF_TEXTS = 300
+VOCABULARY_SIZE = 1000
+# -----------------------------------------------------------------------------
+
+def make_settings(**generator_settings):
+    """Settings from settings.yaml, with a smaller synthetic corpus and any
+    generator settings given overridden."""
+    settings = Settings()
+    settings.yaml_object["benchmark"]["vocabulary_size"] = VOCABULARY_SIZE
+    settings.yaml_object["generator"]["collect_metrics"] = False
+    settings.yaml_object["generator"]["training_workers"] = 1
+    settings.yaml_object["generator"].update(generator_settings)
+    return settings
+
+class LinearInterpolationLanguageModelTest(unittest.TestCase):
+    def get_column_sums(self, lm, context):
+        """Sum over the vocabulary of each order's probability of a token
+        following context, a list of words."""
+        words = sorted(phrase[0] for phrase in lm.vocabulary
+                       if phrase[0] not in lm.sentinels)
+        sentences = [context + [word] for word in words] + [context]
+        (probabilities, chunk_sentences) = lm.get_order_probabilities(sentences)
+        # The chunk scoring each word is the last but one of its sentence,
+        # before the stop symbol, and the stop symbol's is the last of all.
+        last_chunks = numpy.flatnonzero(numpy.diff(numpy.append(chunk_sentences, len(sentences))))
+        token_chunks = numpy.append(last_chunks[:-1] - 1, last_chunks[-1])
+        return probabilities[token_chunks].sum(axis=0)
+
+    def test_order_probabilities_sum_to_one(self):
+        for count_store in ["dict", "numpy", "trie"]:
+            settings = make_settings(count_store=count_store,
+                                     non_kfold_cross_validation_proportion=0.1)
+            processed_texts = make_synthetic_corpus(NUMBER_OF_TEXTS, settings)
+            for language_model_cls in [LanguageModel.BigramLinearInterpolationLanguageModel,
+                                       LanguageModel.TrigramLinearInterpolationLanguageModel]:
+                lm = language_model_cls(processed_texts, settings)
+                lm.train()
+                self.assertTrue(lm.rare_type_counts)
+                first_sentence = [word for (word, tag) in processed_texts[0].tagged_sentences[0]]
+                for context in [[], first_sentence[:lm.ngram_count - 1]]:
+                    numpy.testing.assert_allclose(self.get_column_sums(lm, context),
+                                                  numpy.ones(lm.ngram_count))
+
+class GenerateManyTest(unittest.TestCase):
+    def test_no_sentences(self):
+        settings = make_settings()
+        processed_texts = make_synthetic_corpus(NUMBER_OF_TEXTS, settings)
+        for language_model_cls in [LanguageModel.HMMTrigramMaximumLikelihoodModel,
+                                   LanguageModel.TrigramMaximumLikelihoodLanguageModel,
+                                   LanguageModel.TrigramLinearInterpolationLanguageModel,
+                                   LanguageModel.TrigramKneserNeyLanguageModel]:
+            lm = language_model_cls(processed_texts, settings)
+            lm.start_symbol = processed_texts[0].START_SYMBOL
+            lm.stop_symbol = processed_texts[0].STOP_SYMBOL
+            lm.train_from_counts(lm.count_training_set(processed_texts, lm.ngram_attribute, lm.count_emissions))
+            self.assertEqual(lm.generate_many(0), [])
+            self.assertEqual(lm.generate_many(0, seed=1), [])
+            self.assertEqual(len(lm.generate_many(3, seed=1)), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,11 @@ import random
 import re
 import string
 import functools
+import bisect
+import collections
+import math
+import hashlib
+import struct
 
 import models
 
@@ -16,6 +21,8 @@ import models
 # -----------------------------------------------------------------------------
 APP_NAME = "utilities"
 re_leading_space_before_punctuation = re.compile("\s+(%s)" % "|".join([re.escape(elem) for elem in string.punctuation]))
+MEMOIZE_DEFAULT_MAXSIZE = 65536
+_memoize_missing = object()
 # -----------------------------------------------------------------------------
 
 # -----------------------------------------------------------------------------
@@ -31,15 +38,124 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 # -----------------------------------------------------------------------------
 
-def memoize(func):
-    cache = {}
+class LRUCache(object):
+    """A cache holding at most maxsize entries, evicting the least recently
+    used entry when full, and counting its hits, misses and evictions."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drop every entry. The hit, miss and eviction counts are kept."""
+        self.entries.clear()
+
+    def get_statistics(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self.entries),
+                "maxsize": self.maxsize}
+
+class BloomFilter(object):
+    """A set of strings in a fixed amount of memory that may wrongly report
+    an item as present, with probability about error_rate once
+    expected_count items have been added, but never wrongly reports one as
+    absent.
+
+    The bit array is sized for expected_count and error_rate up front.
+    Each item sets number_of_hashes bits, whose positions are derived from
+    one SHA-1 digest by double hashing."""
+
+    def __init__(self, expected_count, error_rate):
+        assert(expected_count > 0 and 0 < error_rate < 1)
+        self.number_of_bits = int(math.ceil(-expected_count * math.log(error_rate) / (math.log(2) ** 2)))
+        self.number_of_hashes = max(1, int(round(self.number_of_bits / float(expected_count) * math.log(2))))
+        self.bits = bytearray((self.number_of_bits + 7) // 8)
+        self.count = 0
+
+    def get_positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode("utf-8")
+        (h1, h2) = struct.unpack("<QQ", hashlib.sha1(item).digest()[:16])
+        return [(h1 + i * h2) % self.number_of_bits for i in xrange(self.number_of_hashes)]
+
+    def add(self, item):
+        """Add item. Returns True if item was (probably) already present."""
+        present = True
+        for position in self.get_positions(item):
+            (index, mask) = (position >> 3, 1 << (position & 7))
+            if not self.bits[index] & mask:
+                present = False
+                self.bits[index] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.get_positions(item))
+
+    def __len__(self):
+        return self.count
+
+def memoize(func=None, maxsize=MEMOIZE_DEFAULT_MAXSIZE):
+    """Memoize a method on its arguments. Use as @memoize or
+    @memoize(maxsize=...).
+
+    Each instance gets its own LRUCache, stored on the instance under
+    "_memoize_<method name>", so the cache is bounded and goes away with
+    the instance instead of keeping it alive. See get_memoize_caches() and
+    clear_memoize_caches().
+    """
+    if func is None:
+        return functools.partial(memoize, maxsize=maxsize)
+    cache_name = "_memoize_%s" % func.__name__
     @functools.wraps(func)
-    def wrap(*args):
-        if args not in cache:
-            cache[args] = func(*args)
-        return cache[args]
+    def wrap(self, *args):
+        cache = self.__dict__.get(cache_name)
+        if cache is None:
+            cache = self.__dict__[cache_name] = LRUCache(maxsize)
+        value = cache.get(args, _memoize_missing)
+        if value is _memoize_missing:
+            value = func(self, *args)
+            cache.put(args, value)
+        return value
     return wrap
 
+def get_memoize_caches(obj):
+    """Dictionary of cache name to LRUCache for each memoized method that
+    has been called on obj."""
+    return dict((name, value) for (name, value) in vars(obj).iteritems()
+                if isinstance(value, LRUCache))
+
+def clear_memoize_caches(obj):
+    for cache in get_memoize_caches(obj).itervalues():
+        cache.clear()
+
 def weighted_choice(choices):
    total = sum(w for c, w in choices)
    r = random.uniform(0, total)
@@ -50,6 +166,39 @@ def weighted_choice(choices):
       upto += w
    assert False, "Shouldn't get here"
 
+class CumulativeDistribution(object):
+    """A fixed set of weighted choices with the running total of the weights
+    precomputed, so that each draw is one random number and a binary search
+    rather than the linear scan done by weighted_choice().
+
+    choices is an iterable of (choice, weight) pairs, as for weighted_choice().
+    """
+
+    def __init__(self, choices):
+        self.items = []
+        self.cumulative_weights = []
+        total = 0
+        for (c, w) in choices:
+            total += w
+            self.items.append(c)
+            self.cumulative_weights.append(total)
+        self.total = total
+
+    def __len__(self):
+        return len(self.items)
+
+    def choice(self):
+        assert(len(self.items) != 0)
+        r = random.random() * self.total
+        return self.items[bisect.bisect_right(self.cumulative_weights, r)]
+
+    def iter_choices(self):
+        """Yield the (choice, weight) pairs the distribution was built from."""
+        previous_total = 0
+        for (c, total) in zip(self.items, self.cumulative_weights):
+            yield (c, total - previous_total)
+            previous_total = total
+
 def strip_leading_spaces_on_punctuation(input_string):
     return re_leading_space_before_punctuation.sub(r'\1', input_string)
 